@@ -22,13 +22,9 @@ Reference
 
 '''
 import re
-import numpy
 import bisect
 import itertools
 
-from CGAT import NCL as ncl
-from CGATCore import IOTools as IOTools
-
 Headers = [
     "contig", "start", "end",
     "name", "score", "strand",
@@ -419,6 +415,7 @@ def readAndIndex(infile, with_values=False, per_track=False):
        key is a contig. If `per_track` is set, the dictionary has an
        additional first level for the track.
     """
+    from CGAT import NCL as ncl
 
     if with_values:
         idx_factory = ncl.NCL
@@ -489,6 +486,7 @@ def binIntervals(iterator, num_bins=5, method="equal-bases", bin_edges=None):
        list of bin edges
 
     """
+    import numpy
 
     data = []
     beds = list(iterator)
@@ -607,6 +605,8 @@ def getNumColumns(filename):
     ncolumns : int
        The number of columns. If the file is empty, 0 is returned.
     '''
+    from CGATCore import IOTools
+
     with IOTools.openFile(filename) as inf:
         for line in inf:
             if line.startswith("#"):
@@ -9,6 +9,16 @@ single entry and a series of iterators to iterate of :term:`PSL`
 formatted files (:func:`iterator`, :func:`iterator_target_overlap`,
 ...).
 
+:class:`Match` stores its fields in slots. The block coordinates are
+kept as the strings read from the file and converted to lists when
+they are first accessed, so that records that are only filtered and
+written out are never decoded.
+
+For large files, :func:`fast_iterator` returns the same objects using
+the compiled parser in :mod:`CGAT.cblat`. :func:`iterator_batch`
+returns columns of many records at a time as numpy arrays, which is
+convenient for computing aggregate statistics.
+
 Reference
 ---------
 
@@ -70,8 +80,26 @@ class Match:
 
     The fields mQueryFrom/To and mSbjctFrom/To are always on the forward
     strand.
+
+    The block coordinates mBlockSizes, mQueryBlockStarts and
+    mSbjctBlockStarts are decoded from the unparsed fields in
+    ``_blocks`` on first access.
     """
 
+    __slots__ = ("mNMatches", "mNMismatches", "mNRepMatches", "mNns",
+                 "mQueryNGapsCounts", "mQueryNGapsBases",
+                 "mSbjctNGapsCounts", "mSbjctNGapsBases",
+                 "strand",
+                 "mQueryId", "mQueryLength", "mQueryFrom", "mQueryTo",
+                 "mSbjctId", "mSbjctLength", "mSbjctFrom", "mSbjctTo",
+                 "mNBlocks",
+                 "mQueryCoverage", "mSbjctCoverage", "mPid",
+                 "_blocks",
+                 "_block_sizes", "_query_block_starts",
+                 "_sbjct_block_starts",
+                 # allow additional attributes, such as alignments
+                 "__dict__")
+
     def __init__(self):
         self.mNMatches = 0
         self.mNMismatches = 0
@@ -91,9 +119,54 @@ class Match:
         self.mSbjctFrom = 0
         self.mSbjctTo = 0
         self.mNBlocks = 0
-        self.mBlockSizes = []
-        self.mQueryBlockStarts = []
-        self.mSbjctBlockStarts = []
+        self._blocks = None
+        self._block_sizes = []
+        self._query_block_starts = []
+        self._sbjct_block_starts = []
+
+    def _decodeBlocks(self):
+        '''convert unparsed block fields to lists.'''
+        block_sizes, query_block_starts, sbjct_block_starts = self._blocks
+        self._blocks = None
+        self._block_sizes = list(map(int, block_sizes[:-1].split(",")))
+        self._query_block_starts = list(
+            map(int, query_block_starts[:-1].split(",")))
+        self._sbjct_block_starts = list(
+            map(int, sbjct_block_starts[:-1].split(",")))
+
+    def _getBlockSizes(self):
+        if self._blocks is not None:
+            self._decodeBlocks()
+        return self._block_sizes
+
+    def _setBlockSizes(self, value):
+        if self._blocks is not None:
+            self._decodeBlocks()
+        self._block_sizes = value
+
+    def _getQueryBlockStarts(self):
+        if self._blocks is not None:
+            self._decodeBlocks()
+        return self._query_block_starts
+
+    def _setQueryBlockStarts(self, value):
+        if self._blocks is not None:
+            self._decodeBlocks()
+        self._query_block_starts = value
+
+    def _getSbjctBlockStarts(self):
+        if self._blocks is not None:
+            self._decodeBlocks()
+        return self._sbjct_block_starts
+
+    def _setSbjctBlockStarts(self, value):
+        if self._blocks is not None:
+            self._decodeBlocks()
+        self._sbjct_block_starts = value
+
+    mBlockSizes = property(_getBlockSizes, _setBlockSizes)
+    mQueryBlockStarts = property(_getQueryBlockStarts, _setQueryBlockStarts)
+    mSbjctBlockStarts = property(_getSbjctBlockStarts, _setSbjctBlockStarts)
 
     def convertCoordinates(self):
         """convert coordinates.
@@ -225,11 +298,7 @@ class Match:
         self.mSbjctFrom = int(sbjct_from)
         self.mSbjctTo = int(sbjct_to)
         self.mNBlocks = int(nblocks)
-        self.mBlockSizes = list(map(int, block_sizes[:-1].split(",")))
-        self.mQueryBlockStarts = list(
-            map(int, query_block_starts[:-1].split(",")))
-        self.mSbjctBlockStarts = list(
-            map(int, sbjct_block_starts[:-1].split(",")))
+        self._blocks = (block_sizes, query_block_starts, sbjct_block_starts)
 
         # this makes sure that the block positions are rescaled
         if self.mQueryLength != 0:
@@ -278,6 +347,16 @@ class Match:
                         self.mBlockSizes))
 
     def __str__(self):
+        if self._blocks is not None:
+            block_sizes, query_block_starts, sbjct_block_starts = \
+                self._blocks
+        else:
+            block_sizes = ",".join(map(str, self._block_sizes)) + ","
+            query_block_starts = ",".join(
+                map(str, self._query_block_starts)) + ","
+            sbjct_block_starts = ",".join(
+                map(str, self._sbjct_block_starts)) + ","
+
         return "\t".join(map(str, (
             self.mNMatches,
             self.mNMismatches,
@@ -297,9 +376,9 @@ class Match:
             self.mSbjctFrom,
             self.mSbjctTo,
             self.mNBlocks,
-            ",".join(map(str, self.mBlockSizes)) + ",",
-            ",".join(map(str, self.mQueryBlockStarts)) + ",",
-            ",".join(map(str, self.mSbjctBlockStarts)) + ",")))
+            block_sizes,
+            query_block_starts,
+            sbjct_block_starts)))
 
     def getMapQuery2Target(self):
         """return a map between query to target.
@@ -428,13 +507,11 @@ class Match:
         for qstart, tstart, size in b[1:]:
             yield (last_tend, tstart)
             last_tend = tstart + size
-        raise StopIteration
 
     def iterator_exons(self):
 
         for qstart, tstart, size in self.getBlocks():
             yield tstart, tstart + size
-        raise StopIteration
 
     def iterator_introns(self):
 
@@ -443,19 +520,16 @@ class Match:
         for qstart, tstart, size in b[1:]:
             yield (last_tend, tstart)
             last_tend = tstart + size
-        raise StopIteration
 
     def iterator_query_exons(self):
 
         for qstart, tstart, size in self.getBlocks():
             yield qstart, qstart + size
-        raise StopIteration
 
     def iterator_sbjct_exons(self):
 
         for qstart, tstart, size in self.getBlocks():
             yield tstart, tstart + size
-        raise StopIteration
 
     def iterator_query_introns(self):
 
@@ -464,7 +538,6 @@ class Match:
         for qstart, tstart, size in b[1:]:
             yield (last_qend, qstart)
             last_qend = qstart + size
-        raise StopIteration
 
     def getHeader(self):
 
@@ -481,6 +554,8 @@ class Match:
 
 class MatchPSLX(Match):
 
+    __slots__ = ("mQuerySequence", "mSbjctSequence")
+
     def __init__(self):
         Match.__init__(self)
         self.mQuerySequence = []
@@ -582,7 +657,7 @@ def _iterate(infile):
     while 1:
         line = infile.readline()
         if not line:
-            raise StopIteration
+            return
 
         if line[0] == "#":
             continue
@@ -626,7 +701,7 @@ def iterator2(infile):
     while 1:
         line = infile.readline()
         if not line:
-            raise StopIteration
+            return
         if line[0] == "#":
             continue
         if line.startswith("match"):
@@ -646,7 +721,7 @@ def iterator(infile):
     while 1:
         line = infile.readline()
         if not line:
-            raise StopIteration
+            return
         if line[0] == "#":
             continue
         if line.startswith("match"):
@@ -660,13 +735,43 @@ def iterator(infile):
         yield match
 
 
+def fast_iterator(infile):
+    """iterate over the contents of a psl file using the compiled
+    parser in :mod:`CGAT.cblat`.
+
+    The entries are of type :class:`Match` and are identical to
+    those returned by :func:`iterator`, which is used if the
+    compiled parser is not available.
+    """
+    try:
+        from CGAT import cblat
+    except ImportError:
+        return iterator(infile)
+    return cblat.iterator(infile)
+
+
+def iterator_batch(infile, batch_size=100000):
+    """iterate over the contents of a psl file in batches of
+    *batch_size* records.
+
+    Each batch is a dictionary mapping the column names in
+    :data:`FIELDS` to numpy arrays. Numerical columns are integer
+    arrays and names and strands are object arrays. The columns
+    ``blockSizes``, ``qStarts`` and ``tStarts`` contain the blocks
+    of all records in a batch concatenated. The blocks of a record
+    can be selected using the cumulative sum of ``blockCount``.
+    """
+    from CGAT import cblat
+    return cblat.iterator_batch(infile, batch_size)
+
+
 def iterator_pslx(infile):
     """iterate over the contents of a pslx file.
     """
     while 1:
         line = infile.readline()
         if not line:
-            raise StopIteration
+            return
         if line[0] == "#":
             continue
         if line.startswith("match"):
@@ -806,8 +911,6 @@ def iterator_per_query(iterator_psl):
     for x in list(data.values()):
         yield x
 
-    raise StopIteration
-
 FIELDS = ("matches",
           "misMatches",
           "repMatches",
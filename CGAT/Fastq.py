@@ -6,6 +6,11 @@ This module provides an iterator of :term:`fastq` formatted files
 score format (:func:`iterate_guess`) or converting them
 (:func:`iterate_convert`) while iterating through a file.
 
+For large files, :func:`iterate_batch` reads blocks of records into
+a :class:`RecordBatch`, which keeps the text of all records in a single
+numpy byte array. Quality scores in a batch are converted between
+formats through lookup tables (see :func:`iterate_batch_convert`).
+
 :func:`guessFormat` inspects a fastq file to guess the quality score format
 and :func:`getOffset` returns the numeric offset for quality score conversion
 for a particular quality score format.
@@ -20,6 +25,7 @@ Reference
 '''
 
 import string
+import numpy
 
 from math import log
 
@@ -121,7 +127,7 @@ class Record:
         if self.format == "sanger":
             self.quals = "".join([chr(33 + x) for x in quals])
         elif self.format == "illumina-1.8":
-            return [chr(33 + x) for x in quals]
+            self.quals = "".join([chr(33 + x) for x in quals])
         elif self.format == "solexa":
             log10x = log(10.0, 10) / 10.0
             q = [int(10.0 * (log(10 ** (x * log10x) - 1.0, 10)))
@@ -133,6 +139,218 @@ class Record:
             self.quals = " ".join(map(str, quals))
 
 
+# cache of quality score conversion tables, see getConversionTable
+CONVERSION_TABLES = {}
+
+
+def getConversionTable(source, target):
+    '''return a lookup table converting quality score characters
+    from format `source` to format `target`.
+
+    The table is built by applying :meth:`Record.toPhred` and
+    :meth:`Record.fromPhred` to each of the 256 byte values, so
+    that converting a batch gives the same result as converting
+    each record separately.
+
+    Returns
+    -------
+    table : numpy.ndarray
+       int16 array of length 256 with the converted character
+       for each byte value. Values that can not be converted or
+       that would be converted to non-ASCII characters are set to -1.
+
+    Raises
+    ------
+    ValueError
+       If the conversion is not from one character to one character,
+       for example for the ``integer`` format.
+    '''
+    key = (source, target)
+    if key in CONVERSION_TABLES:
+        return CONVERSION_TABLES[key]
+
+    if source not in RANGES or target not in RANGES:
+        raise ValueError(
+            "can not convert quality scores from %s to %s" % key)
+
+    table = numpy.empty(256, dtype=numpy.int16)
+    table.fill(-1)
+    for x in range(256):
+        record = Record("", "N", chr(x))
+        record.format = source
+        try:
+            record.fromPhred(record.toPhred(), target)
+        except (ValueError, OverflowError):
+            continue
+        if len(record.quals) == 1 and ord(record.quals) < 128:
+            table[x] = ord(record.quals)
+
+    CONVERSION_TABLES[key] = table
+    return table
+
+
+def _sliceRanges(ranges, start=None, stop=None):
+    '''apply the python slice ``[start:stop]`` to each (start, end)
+    range in `ranges`.'''
+    lengths = ranges[:, 1] - ranges[:, 0]
+
+    def _resolve(x, default):
+        if x is None:
+            return default
+        elif x < 0:
+            return numpy.maximum(lengths + x, 0)
+        else:
+            return numpy.minimum(x, lengths)
+
+    first = _resolve(start, 0)
+    last = numpy.maximum(_resolve(stop, lengths), first)
+    return numpy.column_stack((ranges[:, 0] + first, ranges[:, 0] + last))
+
+
+class RecordBatch:
+    """A batch of :term:`fastq` formatted records.
+
+    The text of all records is stored in a single numpy byte
+    array. Identifiers, sequences and quality scores are
+    given as (start, end) offsets into this array. Operations
+    on a batch work on all records at once.
+
+    Attributes
+    ----------
+    data : numpy.ndarray
+       uint8 array with the text of the records.
+    identifiers : numpy.ndarray
+       (n, 2) array of offsets of the sequence identifiers.
+    seqs : numpy.ndarray
+       (n, 2) array of offsets of the sequences.
+    quals : numpy.ndarray
+       (n, 2) array of offsets of the quality scores.
+    format : string
+       Quality score format. Can be one of ``sanger``,
+       ``illumina-1.8``, ``solexa`` or ``phred64``.
+
+    """
+
+    def __init__(self, data, identifiers, seqs, quals, format=None):
+        self.data, self.identifiers, self.seqs, self.quals = (
+            data, identifiers, seqs, quals)
+        self.format = format
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def __iter__(self):
+        '''iterate over records in batch as :class:`Record` objects.'''
+        data = self.data
+        for identifier, seq, quals in zip(self.identifiers,
+                                          self.seqs,
+                                          self.quals):
+            record = Record(
+                data[identifier[0]:identifier[1]].tobytes().decode("utf-8"),
+                data[seq[0]:seq[1]].tobytes().decode("utf-8"),
+                data[quals[0]:quals[1]].tobytes().decode("utf-8"))
+            record.format = self.format
+            yield record
+
+    def __str__(self):
+        '''return batch as text. Each record is terminated
+        by a newline.'''
+        n = len(self)
+        data = numpy.concatenate(
+            (self.data, numpy.array([ord("@"), ord("\n"), ord("+")],
+                                    dtype=numpy.uint8)))
+        at, newline, plus = len(self.data), len(self.data) + 1, \
+            len(self.data) + 2
+
+        # each record is composed of the pieces
+        # @, identifier, \n, seq, \n, +, \n, quals, \n
+        starts = numpy.empty((n, 9), dtype=numpy.int64)
+        lengths = numpy.ones((n, 9), dtype=numpy.int64)
+        starts[:] = newline
+        starts[:, 0] = at
+        starts[:, 5] = plus
+        for column, ranges in ((1, self.identifiers),
+                               (3, self.seqs),
+                               (7, self.quals)):
+            starts[:, column] = ranges[:, 0]
+            lengths[:, column] = ranges[:, 1] - ranges[:, 0]
+
+        starts, lengths = starts.ravel(), lengths.ravel()
+        offsets = numpy.cumsum(lengths) - lengths
+        index = numpy.arange(lengths.sum(), dtype=numpy.int64) + \
+            numpy.repeat(starts - offsets, lengths)
+        return data[index].tobytes().decode("utf-8")
+
+    def getQualityMask(self):
+        '''return a boolean mask selecting the quality score
+        characters in :attr:`data`.'''
+        mask = numpy.zeros(len(self.data) + 1, dtype=numpy.int8)
+        numpy.add.at(mask, self.quals[:, 0], 1)
+        numpy.add.at(mask, self.quals[:, 1], -1)
+        return numpy.cumsum(mask[:-1]) > 0
+
+    def getQualityRanges(self):
+        '''return the minimum and maximum quality score character
+        for each record.
+
+        Records without quality scores have a minimum of 255 and
+        a maximum of 0.
+        '''
+        if len(self) == 0:
+            return (numpy.zeros(0, dtype=numpy.uint8),
+                    numpy.zeros(0, dtype=numpy.uint8))
+        # reduce over segments starting at the quality scores and at
+        # the end of each quality string, keeping only the former.
+        index = self.quals.ravel()
+        empty = self.quals[:, 1] <= self.quals[:, 0]
+        mins = numpy.minimum.reduceat(self.data, index)[::2]
+        maxs = numpy.maximum.reduceat(self.data, index)[::2]
+        mins[empty] = 255
+        maxs[empty] = 0
+        return mins, maxs
+
+    def guessFormat(self):
+        '''return quality score formats compatible with all
+        records in the batch - might return several if ambiguous.'''
+        mins, maxs = self.getQualityRanges()
+        mi, ma = mins.min(), maxs.max()
+        r = []
+        for format, v in RANGES.items():
+            m1, m2 = v
+            if mi >= m1 and ma <= m2:
+                r.append(format)
+        return r
+
+    def convert(self, format):
+        '''convert quality scores of all records to `format`.
+
+        Raises
+        ------
+        ValueError
+            If a quality score can not be converted.
+        '''
+        assert self.format is not None, "format needs to be set for conversion"
+        table = getConversionTable(self.format, format)
+        mask = self.getQualityMask()
+        converted = table[self.data[mask]]
+        if numpy.any(converted < 0):
+            raise ValueError(
+                "quality scores can not be converted from %s to %s" %
+                (self.format, format))
+        self.data[mask] = converted
+        self.format = format
+
+    def trim(self, trim3, trim5=0):
+        """remove nucleotides/quality scores from the 3' and 5' ends."""
+        self.seqs = _sliceRanges(self.seqs, trim5, -trim3)
+        self.quals = _sliceRanges(self.quals, trim5, -trim3)
+
+    def trim5(self, trim5=0):
+        """remove nucleotides/quality scores from the 5' ends."""
+        self.seqs = _sliceRanges(self.seqs, trim5)
+        self.quals = _sliceRanges(self.quals, trim5)
+
+
 def iterate(infile):
     '''iterate over contents of fastq file.'''
 
@@ -154,6 +372,72 @@ def iterate(infile):
         yield Record(line1[1:-1], line2[:-1], line4[:-1])
 
 
+def _parseBatch(lines):
+    '''build a :class:`RecordBatch` from a list of lines.'''
+
+    text = "".join(lines)
+    if not text.endswith("\n"):
+        text += "\n"
+    data = numpy.frombuffer(text.encode("utf-8"), dtype=numpy.uint8).copy()
+    ends = numpy.flatnonzero(data == ord("\n"))
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    starts, ends = starts.reshape(-1, 4), ends.reshape(-1, 4)
+
+    invalid = numpy.flatnonzero(data[starts[:, 0]] != ord("@"))
+    if len(invalid) > 0:
+        raise ValueError("parsing error: expected '@' in line %s" %
+                         lines[4 * invalid[0]])
+    invalid = numpy.flatnonzero(data[starts[:, 2]] != ord("+"))
+    if len(invalid) > 0:
+        raise ValueError("parsing error: expected '+' in line %s" %
+                         lines[4 * invalid[0] + 2])
+
+    return RecordBatch(
+        data,
+        numpy.column_stack((starts[:, 0] + 1, ends[:, 0])),
+        numpy.column_stack((starts[:, 1], ends[:, 1])),
+        numpy.column_stack((starts[:, 3], ends[:, 3])))
+
+
+def iterate_batch(infile, batch_size=1000000):
+    '''iterate over contents of fastq file in batches.
+
+    Arguments
+    ---------
+    infile : File
+       File or file-like object to iterate over
+    batch_size : int
+       Approximate number of bytes to read for each batch.
+
+    Yields
+    ------
+    batch
+        An object of type :class:`RecordBatch`.
+
+    Raises
+    ------
+    ValueError
+        If a record is malformed or incomplete.
+    '''
+
+    remainder = []
+    while 1:
+        lines = infile.readlines(batch_size)
+        if not lines:
+            break
+        lines = remainder + lines
+        nlines = len(lines) - len(lines) % 4
+        remainder = lines[nlines:]
+        if nlines > 0:
+            yield _parseBatch(lines[:nlines])
+
+    if remainder:
+        if not remainder[0].startswith('@'):
+            raise ValueError(
+                "parsing error: expected '@' in line %s" % remainder[0])
+        raise ValueError("incomplete entry for %s" % remainder[0])
+
+
 def iterate_guess(infile, max_tries=10000, guess=None):
     '''iterate over contents of fastq file.
 
@@ -298,6 +582,103 @@ def iterate_convert(infile, format, max_tries=10000, guess=None):
         yield r
 
 
+def iterate_batch_convert(infile, format, max_tries=10000, guess=None,
+                          batch_size=1000000):
+    '''iterate over contents of fastq file in batches.
+
+    The quality score format is guessed and all subsequent records
+    are converted to `format`. This is the batch equivalent of
+    :func:`iterate_convert` and chooses the same quality score
+    format.
+
+    Arguments
+    ---------
+    infile : File
+       File or file-like object to iterate over
+    format : string
+       Quality score format to convert all records into.
+    max_tries : int
+       Number of records to examine for guessing the quality score
+       format.
+    guess : string
+       Default format. This format will be chosen in the quality
+       score format is ambiguous. The method checks if the `guess`
+       is compatible with the records read so far.
+    batch_size : int
+       Approximate number of bytes to read for each batch.
+
+    Yields
+    ------
+    batch
+        An object of type :class:`RecordBatch`.
+
+    Raises
+    ------
+    ValueError
+        If the ranges of the fastq records are not compatible,
+        are incompatible with guess or are ambiguous.
+
+    '''
+
+    formats = list(RANGES.keys())
+    quals = set(formats)
+    cache = []
+    myiter = iterate_batch(infile, batch_size)
+    # running minimum and maximum of quality scores
+    lowest, highest = 255, 0
+    c = 0
+    for batch in myiter:
+        cache.append(batch)
+        if len(batch) == 0:
+            continue
+        mins, maxs = batch.getQualityRanges()
+        mins = numpy.minimum(numpy.minimum.accumulate(mins), lowest)
+        maxs = numpy.maximum(numpy.maximum.accumulate(maxs), highest)
+        # formats compatible with the records up to each record
+        compatible = numpy.array(
+            [(mins >= RANGES[x][0]) & (maxs <= RANGES[x][1])
+             for x in formats])
+        counts = compatible.sum(axis=0)
+        # the record-wise iteration stops at the first record that
+        # leaves at most one format or exceeds max_tries
+        stop = (counts <= 1) | (numpy.arange(c, c + len(batch)) > max_tries)
+        if stop.any():
+            last = numpy.flatnonzero(stop)[0]
+            quals = set([x for x, y in zip(formats, compatible[:, last])
+                         if y])
+            break
+        quals = set([x for x, y in zip(formats, compatible[:, -1]) if y])
+        lowest, highest = mins[-1], maxs[-1]
+        c += len(batch)
+
+    if len(quals) == 0:
+        raise ValueError("could not guess format - ranges incompatible.")
+    elif len(quals) == 1:
+        ref_format = list(quals)[0]
+    elif quals.issubset(set(["solexa", "phred64"])):
+        # guessFormat will call phred64 reads as phred64 AND solexa
+        # if both still remain after max_tries, assume phred64
+        ref_format = "phred64"
+    elif guess in quals:
+        E.warn("multiple input formats possible: %s. Continuing with %s" %
+               (", ".join(quals), guess))
+        ref_format = guess
+    else:
+        raise ValueError(
+            "could not guess format - could be one of %s. "
+            "If you know the format use the --format option" % str(quals))
+
+    for batch in cache:
+        batch.format = ref_format
+        batch.convert(format)
+        yield batch
+
+    for batch in myiter:
+        batch.format = ref_format
+        batch.convert(format)
+        yield batch
+
+
 def guessFormat(infile, max_lines=10000, raises=True):
     '''guess format of FASTQ File.
 
@@ -13,8 +13,10 @@ import re
 import math
 import random
 import collections
+import multiprocessing
 
 import scipy
+import scipy.sparse
 import scipy.stats
 import scipy.special
 import numpy
@@ -1094,56 +1096,216 @@ def outputResults(outfile,
         outfile.write("\n")
 
 
-def getSamples(gene2go, foreground, background, options, test_ontology,
-               go2info):
+def buildGene2GOMatrix(gene2go, genes):
+    '''build a sparse incidence matrix between *genes* and the GO
+    categories they are assigned to.
 
-    sample_size = options.sample
-    # List of all minimum probabilities in simulation
-    simulation_min_pvalues = []
-    E.info("sampling: calculating %i samples: " % (sample_size))
+    Rows are in the order of *genes*, columns are the GO categories
+    found in *genes* in sorted order. Multiple assignments of a gene
+    to the same category are counted as in :func:`GetGOFrequencies`.
 
-    counts = {}
-    prob_overs = {}
-    prob_unders = {}
+    returns a tuple containing:
+    * a :class:`scipy.sparse.csr_matrix` of counts
+    * a list of GO identifiers for each column
+    * a boolean array flagging genes with GO assignments
+    '''
+    go_ids = sorted(set(
+        [go.mGOId for gene_id in genes if gene_id in gene2go
+         for go in gene2go[gene_id]]))
+    go2column = dict([(y, x) for x, y in enumerate(go_ids)])
+
+    rows, columns = [], []
+    has_go = numpy.zeros(len(genes), dtype=numpy.bool_)
+    for row, gene_id in enumerate(genes):
+        if gene_id not in gene2go:
+            continue
+        has_go[row] = True
+        for go in gene2go[gene_id]:
+            rows.append(row)
+            columns.append(go2column[go.mGOId])
 
-    samples = {}
+    # duplicate entries are summed on conversion to csr
+    matrix = scipy.sparse.coo_matrix(
+        (numpy.ones(len(rows), dtype=numpy.int32), (rows, columns)),
+        shape=(len(genes), len(go_ids))).tocsr()
 
-    options.stdlog.write("# ")
-    options.stdlog.flush()
+    return matrix, go_ids, has_go
 
-    for x in range(sample_size):
 
-        if options.loglevel >= 1:
-            options.stdlog.write(".")
-            options.stdlog.flush()
+def sampleGOCounts(matrix, has_go, sample_size, num_samples, rng):
+    '''count GO categories in *num_samples* random samples of
+    *sample_size* rows from the incidence *matrix* built by
+    :func:`buildGene2GOMatrix`.
 
-        # get shuffled array of genes from background
-        sample_genes = random.sample(background, len(foreground))
+    Rows are drawn without replacement using the numpy
+    RandomState *rng*.
 
-        go_results = AnalyseGO(gene2go, sample_genes, background)
+    returns a tuple containing:
+    * an array of counts of shape (num_samples, number of categories)
+    * an array with the number of genes with GO assignments in each sample
+    '''
+    nrows = matrix.shape[0]
+    if sample_size > nrows:
+        raise ValueError(
+            "sample larger than population: %i > %i" % (sample_size, nrows))
+
+    # the smallest sample_size of a set of uniform random numbers
+    # gives a random sample without replacement in each row
+    rows = rng.random_sample((num_samples, nrows)).argpartition(
+        sample_size - 1, axis=1)[:, :sample_size]
+
+    indicator = scipy.sparse.csr_matrix(
+        (numpy.ones(rows.size, dtype=numpy.int32),
+         rows.ravel(),
+         numpy.arange(0, rows.size + 1, sample_size)),
+        shape=(num_samples, nrows))
+
+    counts = (indicator * matrix).toarray()
+    totals = has_go[rows].sum(axis=1)
+
+    return counts, totals
+
+
+def computeGOProbabilities(sample_counts, sample_totals,
+                           background_counts, background_total,
+                           cache=None):
+    '''compute probabilities of over- and under-representation
+    for a matrix of category counts.
+
+    *sample_counts* is an array of counts of shape (number of samples,
+    number of categories), *sample_totals* the number of genes with
+    GO assignments in each sample and *background_counts* the counts of
+    each category in the background. The probabilities are identical
+    to those of :meth:`GOResult.UpdateProbabilities`, but are computed
+    only once for each distinct combination of counts. Results are
+    stored in the dictionary *cache*, if given.
+
+    returns a tuple of two arrays of the same shape as *sample_counts*.
+    '''
+    if cache is None:
+        cache = {}
+
+    sample_counts = numpy.asarray(sample_counts, dtype=numpy.int64)
+    sample_totals = numpy.asarray(sample_totals, dtype=numpy.int64)
+    background_counts = numpy.asarray(background_counts, dtype=numpy.int64)
+
+    # encode (scount, stotal, bcount) combinations as a single key
+    radix = int(max(background_total, background_counts.max())) + 1
+    keys = (sample_counts * radix +
+            sample_totals[:, numpy.newaxis]) * radix + \
+        background_counts[numpy.newaxis, :]
+
+    unique_keys, inverse = numpy.unique(keys, return_inverse=True)
+
+    overs = numpy.empty(len(unique_keys), dtype=numpy.float64)
+    unders = numpy.empty(len(unique_keys), dtype=numpy.float64)
+
+    for x, key in enumerate(unique_keys):
+        key = int(key)
+        if key not in cache:
+            scount, rest = divmod(key, radix * radix)
+            stotal, bcount = divmod(rest, radix)
+            if scount == 0:
+                pover = 1.0
+            else:
+                pover = hypergeometric_Q(scount - 1,
+                                         bcount,
+                                         background_total - bcount,
+                                         stotal)
+            punder = hypergeometric_P(scount,
+                                      bcount,
+                                      background_total - bcount,
+                                      stotal)
+            cache[key] = (pover, punder)
+        overs[x], unders[x] = cache[key]
+
+    inverse = inverse.reshape(keys.shape)
+    return overs[inverse], unders[inverse]
+
+
+def sampleGOChunk(args):
+    '''compute counts and probabilities for a chunk of sample batches.
+
+    Each batch uses its own random number generator seeded by the
+    global seed and the batch index so that the results do not
+    depend on how batches are distributed across processes.
+    '''
+    (matrix, has_go, background_counts, background_total,
+     sample_size, seed, batches) = args
 
-        pairs = list(go_results.mResults.items())
+    cache = {}
+    results = []
+    for batch_index, num_samples in batches:
+        rng = numpy.random.RandomState([seed, batch_index])
+        counts, totals = sampleGOCounts(
+            matrix, has_go, sample_size, num_samples, rng)
+        overs, unders = computeGOProbabilities(
+            counts, totals, background_counts, background_total,
+            cache=cache)
+        results.append((counts, overs, unders))
+    return results
 
-        for k, v in pairs:
-            if k not in counts:
-                counts[k] = []
-                prob_overs[k] = []
-                prob_unders[k] = []
 
-            counts[k].append(v.mSampleCountsCategory)
-            prob_overs[k].append(v.mProbabilityOverRepresentation)
-            prob_unders[k].append(v.mProbabilityUnderRepresentation)
+def getSamples(gene2go, foreground, background, options, test_ontology,
+               go2info, batch_size=100):
+    '''compute GO enrichment statistics for random samples of genes
+    from the *background* of the same size as the *foreground*.
 
-            simulation_min_pvalues.append(v.mPValue)
+    The gene-to-GO assignments of the background are stored in
+    a sparse matrix and samples are processed in batches of
+    *batch_size*. Batches are distributed across
+    ``options.num_threads`` processes.
 
-    if options.loglevel >= 1:
-        sys.stdout.write("\n")
-        sys.stdout.flush()
+    returns a dictionary of :class:`GOSample` objects for each
+    category and a sorted array of all P-Values in the simulation.
+    '''
+    sample_size = options.sample
+    num_threads = getattr(options, "num_threads", 1)
+
+    matrix, go_ids, has_go = buildGene2GOMatrix(gene2go, background)
+    background_counts = numpy.asarray(matrix.sum(axis=0)).ravel()
+    background_total = int(has_go.sum())
+
+    if getattr(options, "random_seed", None) is not None:
+        seed = options.random_seed
+    else:
+        seed = random.randint(0, 2 ** 31 - 1)
+
+    batches = [(x, min(batch_size, sample_size - y))
+               for x, y in enumerate(range(0, sample_size, batch_size))]
+
+    E.info("sampling: calculating %i samples in %i batches using "
+           "%i processes: background=%i genes, %i categories" %
+           (sample_size, len(batches), num_threads,
+            matrix.shape[0], matrix.shape[1]))
+
+    chunks = [(matrix, has_go, background_counts, background_total,
+               len(foreground), seed, batches[x::num_threads])
+              for x in range(num_threads)]
+
+    if num_threads > 1:
+        pool = multiprocessing.Pool(num_threads)
+        results = pool.map(sampleGOChunk, chunks)
+        pool.close()
+        pool.join()
+    else:
+        results = list(map(sampleGOChunk, chunks))
+
+    # restore batch order
+    results = [results[x % num_threads][x // num_threads]
+               for x in range(len(batches))]
+
+    counts = numpy.concatenate([x[0] for x in results])
+    prob_overs = numpy.concatenate([x[1] for x in results])
+    prob_unders = numpy.concatenate([x[2] for x in results])
+
+    E.info("sampling: sorting %i P-Values" % prob_overs.size)
 
-    E.info("sampling: sorting %i P-Values" % len(simulation_min_pvalues))
+    simulation_min_pvalues = numpy.sort(
+        numpy.minimum(prob_overs, prob_unders), axis=None)
 
-    simulation_min_pvalues.sort()
-    simulation_min_pvalues = numpy.array(simulation_min_pvalues)
+    prob_overs.sort(axis=0)
+    prob_unders.sort(axis=0)
 
     samples = {}
 
@@ -1159,34 +1321,32 @@ def getSamples(gene2go, foreground, background, options, test_ontology,
                              "CI95lower", "CI95upper",
                              "pover", "punder", "goid",
                              "category", "description")) + "\n")
-    for k in sorted(list(counts.keys())):
 
-        c = counts[k]
+    for column, k in enumerate(go_ids):
 
-        prob_overs[k].sort()
-        prob_unders[k].sort()
+        c = counts[:, column]
 
-        s = GOSample(min(c),
-                     max(c),
-                     scipy.mean(c),
+        s = GOSample(c.min(),
+                     c.max(),
+                     numpy.mean(c),
                      numpy.std(c),
-                     numpy.array(prob_overs[k]),
-                     numpy.array(prob_unders[k]),
-                     counts[k])
+                     prob_overs[:, column],
+                     prob_unders[:, column],
+                     list(c))
 
         samples[k] = s
 
         outfile.write("%s\t%i\t%i\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%s\n" %
                       (k,
-                       min(c),
-                       max(c),
-                       scipy.mean(c),
-                       scipy.median(c),
+                       c.min(),
+                       c.max(),
+                       numpy.mean(c),
+                       numpy.median(c),
                        numpy.std(c),
                        scipy.stats.scoreatpercentile(c, 5),
                        scipy.stats.scoreatpercentile(c, 95),
-                       min(prob_overs[k]),
-                       min(prob_unders[k]),
+                       prob_overs[0, column],
+                       prob_unders[0, column],
                        go2info[k]))
 
     if options.output_filename_pattern:
@@ -1283,15 +1443,11 @@ def computeFDRs(go_results,
 
             # calculate values for FDR:
             # nfdr = number of entries with P-Value better than node.
-            a = 0
-            while a < len(simulation_min_pvalues) and \
-                    simulation_min_pvalues[a] < pvalue:
-                a += 1
+            a = int(numpy.searchsorted(simulation_min_pvalues, pvalue,
+                                       side="left"))
             a = float(a) / float(sample_size)
-            b = 0
-            while b < len(observed_min_pvalues) and \
-                    observed_min_pvalues[b] < pvalue:
-                b += 1
+            b = int(numpy.searchsorted(observed_min_pvalues, pvalue,
+                                       side="left"))
 
             if b > 0:
                 fdr = min(1.0, float(a) / float(b))
@@ -14,6 +14,16 @@ type :func:`pysam.GTFProxy`.
 The class defined in this model :class:`Entry` is useful for re-formatting
 records.
 
+A compiled parser yielding lazily parsed, memory efficient
+equivalents of :class:`Entry` is available through
+:func:`fast_iterator`. Its output can be used in all of the iterators
+below. :func:`benchmarkParsers` compares its speed to the default
+parser.
+
+Coordinates and identifiers of a :term:`gtf` file can be cached
+on disk in a compact, columnar format for repeated loading
+(:func:`readGenesetCache` and :class:`GenesetCache`).
+
 Apart from basic iteration, this module provides the following utilities:
 
 * Additional iterators for grouping/modifying :term:`GTF` formatted files:
@@ -36,11 +46,17 @@ Apart from basic iteration, this module provides the following utilities:
 """
 
 import collections
+import os
+import tempfile
+import timeit
+import zipfile
+import numpy
 from CGAT import Intervals as Intervals
 from CGAT import Genomics as Genomics
 from CGAT import IndexedGenome as IndexedGenome
 import pysam
 from CGATCore import IOTools as IOTools
+from CGATCore import Experiment as E
 
 
 def iterator(infile):
@@ -48,6 +64,41 @@ def iterator(infile):
     return pysam.tabix_iterator(infile, pysam.asGTF())
 
 
+def fast_iterator(infile):
+    """return an iterator over all entries in a file using the
+    compiled parser in :mod:`CGAT.cgtf`.
+
+    The entries are of type :class:`CGAT.cgtf.Entry` and behave
+    like :class:`Entry`. Attributes other than gene_id and
+    transcript_id are parsed only when accessed.
+    """
+    from CGAT import cgtf
+    return cgtf.iterator(infile)
+
+
+def benchmarkParsers(filename, number=1):
+    """time parsing of *filename* with the different parsers.
+
+    Each parser is run *number* times. The time to output
+    each record as a string is included, as this requires
+    all attributes to be parsed.
+
+    Returns a dictionary mapping parser name to time in seconds.
+    """
+    def _run(f):
+        with IOTools.open_file(filename) as inf:
+            for gtf in f(inf):
+                str(gtf)
+
+    parsers = (("entry", track_iterator),
+               ("pysam", iterator),
+               ("compiled", fast_iterator))
+
+    return collections.OrderedDict(
+        (name, timeit.timeit(lambda: _run(f), number=number))
+        for name, f in parsers)
+
+
 def track_iterator(infile):
     """a simple iterator over all entries in a file."""
     # note: taken from GFF.py
@@ -1068,3 +1119,250 @@ class Entry:
                 self.strand == other.strand and
                 (abs(self.end - other.end) < max_slippage or
                  abs(self.start - other.start < max_slippage)))
+
+
+# suffix of geneset cache files, see readGenesetCache
+GENESET_CACHE_SUFFIX = ".cgatidx"
+GENESET_CACHE_VERSION = 1
+
+
+class GenesetCache(object):
+    """columnar representation of the coordinates and identifiers
+    in a :term:`gtf` formatted file.
+
+    Records are stored as numpy arrays. String values (contig,
+    feature, gene_id and transcript_id) are interned, i.e., stored
+    as integer codes into a table of unique values. Other columns
+    (source, score, frame) and optional attributes are not kept.
+
+    Use :func:`readGenesetCache` to obtain a cache for a file.
+
+    Attributes
+    ----------
+    contig : numpy.array
+       Codes into :attr:`contigs`.
+    start : numpy.array
+       Start coordinates (0-based, half-open).
+    end : numpy.array
+       End coordinates.
+    strand : numpy.array
+       Strand as single characters.
+    feature : numpy.array
+       Codes into :attr:`features`.
+    gene_id : numpy.array
+       Codes into :attr:`gene_ids`.
+    transcript_id : numpy.array
+       Codes into :attr:`transcript_ids`.
+    """
+
+    columns = ("contig", "start", "end", "strand",
+               "feature", "gene_id", "transcript_id")
+    tables = ("contigs", "features", "gene_ids", "transcript_ids")
+
+    def __init__(self, **kwargs):
+        for key in self.columns + self.tables:
+            setattr(self, key, kwargs[key])
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def fromIterator(cls, gtf_iterator):
+        """build cache from an iterator of GTF records."""
+
+        def _intern(table, value):
+            try:
+                return table[value]
+            except KeyError:
+                table[value] = len(table)
+                return table[value]
+
+        contigs, features, gene_ids, transcript_ids = {}, {}, {}, {}
+        contig, start, end, strand = [], [], [], []
+        feature, gene_id, transcript_id = [], [], []
+
+        for gtf in gtf_iterator:
+            contig.append(_intern(contigs, gtf.contig))
+            start.append(gtf.start)
+            end.append(gtf.end)
+            strand.append(gtf.strand or ".")
+            feature.append(_intern(features, gtf.feature))
+            gene_id.append(_intern(gene_ids, str(gtf.gene_id)))
+            transcript_id.append(
+                _intern(transcript_ids, str(gtf.transcript_id)))
+
+        def _table(table):
+            values = sorted(table, key=table.get)
+            return numpy.array(values, dtype=numpy.str_)
+
+        return cls(contig=numpy.array(contig, dtype=numpy.int32),
+                   start=numpy.array(start, dtype=numpy.int64),
+                   end=numpy.array(end, dtype=numpy.int64),
+                   strand=numpy.array(strand, dtype="U1"),
+                   feature=numpy.array(feature, dtype=numpy.int32),
+                   gene_id=numpy.array(gene_id, dtype=numpy.int32),
+                   transcript_id=numpy.array(transcript_id,
+                                             dtype=numpy.int32),
+                   contigs=_table(contigs),
+                   features=_table(features),
+                   gene_ids=_table(gene_ids),
+                   transcript_ids=_table(transcript_ids))
+
+    @classmethod
+    def load(cls, filename):
+        """load cache from *filename*.
+
+        Raises ValueError if the file has been written by an
+        incompatible version.
+        """
+        with numpy.load(filename, allow_pickle=False) as data:
+            if int(data["version"]) != GENESET_CACHE_VERSION:
+                raise ValueError(
+                    "geneset cache %s has version %i, expected %i" %
+                    (filename, int(data["version"]), GENESET_CACHE_VERSION))
+            return cls(**dict((key, data[key]) for key in
+                              cls.columns + cls.tables))
+
+    def save(self, filename):
+        """save cache to *filename*.
+
+        The cache is written to a temporary file first and then
+        renamed, so that concurrent readers never see a partial file.
+        """
+        dirname = os.path.dirname(os.path.abspath(filename))
+        handle, tmpfile = tempfile.mkstemp(dir=dirname,
+                                           suffix=GENESET_CACHE_SUFFIX)
+        try:
+            with os.fdopen(handle, "wb") as outf:
+                numpy.savez(outf,
+                            version=numpy.array(GENESET_CACHE_VERSION),
+                            **dict((key, getattr(self, key)) for key in
+                                   self.columns + self.tables))
+            os.chmod(tmpfile, 0o644)
+            os.rename(tmpfile, filename)
+        except Exception:
+            os.unlink(tmpfile)
+            raise
+
+    def _groups(self, codes):
+        """return list of index arrays grouping records by *codes*.
+
+        Groups are sorted by their first record.
+        """
+        if len(codes) == 0:
+            return []
+        order = numpy.argsort(codes, kind="mergesort")
+        boundaries = numpy.flatnonzero(numpy.diff(codes[order])) + 1
+        groups = numpy.split(order, boundaries)
+        groups.sort(key=lambda x: x[0])
+        return groups
+
+    def toEntry(self, idx):
+        """return record *idx* as a :class:`Entry`."""
+        entry = Entry()
+        entry.contig = str(self.contigs[self.contig[idx]])
+        entry.feature = str(self.features[self.feature[idx]])
+        entry.start = int(self.start[idx])
+        entry.end = int(self.end[idx])
+        entry.strand = str(self.strand[idx])
+        entry.gene_id = str(self.gene_ids[self.gene_id[idx]])
+        entry.transcript_id = str(
+            self.transcript_ids[self.transcript_id[idx]])
+        return entry
+
+    def iterator(self):
+        """iterate over records as :class:`Entry` objects in file order."""
+        for idx in range(len(self)):
+            yield self.toEntry(idx)
+
+    def _transcripts(self):
+        """return list of index arrays grouping records by contig
+        and transcript id.
+
+        A transcript id on several contigs, such as genes in the
+        pseudo-autosomal regions of chrX and chrY, gives one
+        transcript per contig.
+        """
+        codes = (self.transcript_id.astype(numpy.int64) *
+                 max(len(self.contigs), 1) + self.contig)
+        return self._groups(codes)
+
+    def transcript_iterator(self):
+        """iterate over transcripts.
+
+        Returns lists of :class:`Entry` objects with the same contig
+        and transcript id. In contrast to :func:`transcript_iterator`,
+        records do not need to be consecutive.
+        """
+        for group in self._transcripts():
+            yield [self.toEntry(x) for x in group]
+
+    def gene_iterator(self):
+        """iterate over genes.
+
+        Returns lists of transcripts, each a list of :class:`Entry`
+        objects, with the same gene id.
+        """
+        transcripts = self._transcripts()
+        by_gene = collections.defaultdict(list)
+        for group in transcripts:
+            by_gene[self.gene_id[group[0]]].append(group)
+
+        for group in self._groups(self.gene_id):
+            yield [[self.toEntry(x) for x in transcript]
+                   for transcript in by_gene[self.gene_id[group[0]]]]
+
+    def getRanges(self, by="transcript_id"):
+        """return the genomic extent of each transcript or gene.
+
+        Returns a tuple of numpy arrays (codes, contig, strand, start,
+        end) with one element per transcript or gene. *codes* are
+        indices into :attr:`transcript_ids` or :attr:`gene_ids`.
+        """
+        codes = getattr(self, by)
+        order = numpy.argsort(codes, kind="mergesort")
+        sorted_codes = codes[order]
+        first = numpy.concatenate(
+            ([0], numpy.flatnonzero(numpy.diff(sorted_codes)) + 1))
+        return (sorted_codes[first],
+                self.contig[order][first],
+                self.strand[order][first],
+                numpy.minimum.reduceat(self.start[order], first),
+                numpy.maximum.reduceat(self.end[order], first))
+
+
+def readGenesetCache(filename, rebuild=False):
+    """return a :class:`GenesetCache` for the :term:`gtf` formatted
+    file *filename*.
+
+    The cache is stored in a sidecar file next to *filename* with
+    the suffix ``.cgatidx``. If the sidecar exists and is newer than
+    *filename*, it is loaded. Otherwise the gtf file is parsed
+    and the sidecar is (re-)built. If *rebuild* is set, the
+    sidecar is always rebuilt.
+
+    If the sidecar can not be written, the cache is built in memory
+    only.
+    """
+    cache_filename = filename + GENESET_CACHE_SUFFIX
+
+    if not rebuild and os.path.exists(cache_filename) and \
+       os.path.getmtime(cache_filename) >= os.path.getmtime(filename):
+        try:
+            return GenesetCache.load(cache_filename)
+        except (ValueError, IOError, KeyError, EOFError,
+                zipfile.BadZipFile) as msg:
+            E.warn("could not load geneset cache %s, rebuilding: %s" %
+                   (cache_filename, msg))
+
+    E.info("building geneset cache for %s" % filename)
+    with IOTools.open_file(filename) as inf:
+        cache = GenesetCache.fromIterator(iterator(inf))
+
+    try:
+        cache.save(cache_filename)
+    except (IOError, OSError) as msg:
+        E.warn("could not write geneset cache %s: %s" %
+               (cache_filename, msg))
+
+    return cache
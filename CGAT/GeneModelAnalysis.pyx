@@ -326,6 +326,133 @@ cdef __add( numpy.ndarray[DTYPE_INT_t, ndim=1]counts, positions, int offset, int
         for pos from 0 <= pos < length:
             counts[pos] += 1
 
+##------------------------------------------------------
+class CachedAlignmentFile(object):
+    '''a :term:`bam` formatted file that keeps the reads of the
+    current locus in memory.
+
+    Counters working on bam files fetch the reads of a gene or
+    transcript, often several times for the same gene. The locus is
+    set with :meth:`setLocus`, usually by :func:`iterateLoci`. The
+    reads in the locus are read from the file once when they are
+    first requested and all subsequent requests within the locus are
+    served from memory. Requests outside the locus are passed on
+    to the file.
+
+    Reads are returned in the same order as by
+    :meth:`pysam.AlignmentFile.fetch`. Other attributes are those of
+    the underlying :class:`pysam.AlignmentFile`.
+    '''
+
+    # maximum number of reads in a locus to keep in memory
+    max_reads = 1000000
+
+    def __init__(self, samfile):
+        self.samfile = samfile
+        self.contig = None
+        self.start = 0
+        self.end = 0
+        # None: not loaded, False: locus not cached
+        self.reads = None
+        self.starts = None
+        self.ends = None
+        self.max_span = 0
+        self.counter = E.Counter()
+
+    def __getattr__(self, key):
+        if key == "samfile":
+            raise AttributeError(key)
+        return getattr(self.samfile, key)
+
+    def gettid(self, contig):
+        return self.samfile.gettid(contig)
+
+    def setLocus(self, contig, start, end):
+        '''set the current locus to *contig*:*start*-*end*.'''
+        if self.reads is not None and contig == self.contig and \
+           self.start <= start and end <= self.end:
+            return
+        self.contig, self.start, self.end = contig, start, end
+        self.reads = None
+
+    def load(self):
+        '''read all reads in the current locus.'''
+        cdef AlignedSegment read
+        cdef long read_start, read_end
+        cdef long max_span = 0
+        cdef int max_reads = self.max_reads
+
+        reads, starts, ends = [], [], []
+        for read in self.samfile.fetch(self.contig, self.start, self.end):
+            read_start = read.pos
+            # use the same end as htslib: reads without
+            # aligned bases have length 1
+            if read.aend is None or read.aend == read_start:
+                read_end = read_start + 1
+            else:
+                read_end = read.aend
+            reads.append(read)
+            starts.append(read_start)
+            ends.append(read_end)
+            max_span = max(max_span, read_end - read_start)
+            if len(reads) > max_reads:
+                self.counter.loci_uncached += 1
+                self.reads = False
+                return
+
+        self.counter.loci_cached += 1
+        self.counter.reads_loaded += len(reads)
+        self.reads, self.starts, self.ends = reads, starts, ends
+        self.max_span = max_span
+
+    def fetch(self, contig=None, start=None, end=None):
+        '''return reads overlapping *contig*:*start*-*end*.'''
+
+        if start is None or end is None or contig != self.contig or \
+           start < self.start or end > self.end:
+            self.counter.fetch_file += 1
+            return self.samfile.fetch(contig, start, end)
+
+        if self.reads is None:
+            self.load()
+
+        if self.reads is False:
+            self.counter.fetch_file += 1
+            return self.samfile.fetch(contig, start, end)
+
+        cdef long qstart = start
+        cdef long first = bisect.bisect_left(self.starts,
+                                             qstart - self.max_span)
+        cdef long last = bisect.bisect_left(self.starts, end)
+        cdef long x
+        ends = self.ends
+        reads = self.reads
+        result = [reads[x] for x in range(first, last) if ends[x] > qstart]
+
+        self.counter.fetch_cache += 1
+        self.counter.reads_served += len(result)
+        return result
+
+
+def iterateLoci(gtf_iterator, samfiles):
+    '''iterate over gene models in *gtf_iterator* and set the locus
+    of each :class:`CachedAlignmentFile` in *samfiles* to the
+    current gene.
+
+    Consecutive gene models of the same gene, for example the
+    transcripts of a gene, share the locus.
+    '''
+    for key, models in itertools.groupby(
+            gtf_iterator, key=lambda x: (x[0].contig, x[0].gene_id)):
+        models = list(models)
+        start = min([min([x.start for x in gffs]) for gffs in models])
+        end = max([max([x.end for x in gffs]) for gffs in models])
+        for samfile in samfiles:
+            samfile.setLocus(key[0], start, end)
+        for gffs in models:
+            yield gffs
+
+
 ##------------------------------------------------------
 class CounterReadCoverage(Counter):
     '''compute read coverage for all exons in a transcript. 
@@ -3057,9 +3184,11 @@ class ClassifierRNASeqSplicing(Counter):
         transcripts = {}
         transcript_intervals = IndexedGenome.Quicksect()
 
-        f = IOTools.openFile(filename_gff[0])
+        # only coordinates, features and identifiers are required,
+        # so the reference can be loaded from the geneset cache.
+        cache = GTF.readGenesetCache(filename_gff[0])
 
-        for t in GTF.transcript_iterator(GTF.iterator(f)):
+        for t in cache.transcript_iterator():
             t.sort(key=lambda x: x.start)
             transcript_id, gene_id = t[0].transcript_id, t[0].gene_id
             map_transcript2gene[transcript_id] = gene_id
@@ -3068,8 +3197,6 @@ class ClassifierRNASeqSplicing(Counter):
             transcript_intervals.add(
                 t[0].contig, t[0].start, t[-1].end, transcript_id)
 
-        f.close()
-
         E.info("loaded data from %s" % (filename_gff[0]))
 
         self.transcripts = transcripts
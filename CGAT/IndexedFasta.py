@@ -15,6 +15,16 @@ region chr12:10,000-10,100 is::
    fasta = IndexedFasta("hg19")
    fasta.getSequence("chr12", "+", 10000, 10100)
 
+Uncompressed CGAT indexed fasta files can be accessed through a
+memory map by supplying ``mmap=True`` to the factory function
+(see :class:`MMapIndexedFasta`). This avoids copying for
+many small random accesses and permits retrieving many regions
+in a single call::
+
+   fasta = IndexedFasta("hg19", mmap=True)
+   fasta.getSequences([("chr12", "+", 10000, 10100),
+                       ("chr1", "-", 500, 600)])
+
 To index a file, use the :mod:`scripts/index_fasta` command line utility or the
 :func:`createDatabase` function::
 
@@ -48,6 +58,7 @@ import zlib
 import gzip
 import tempfile
 import io
+import mmap
 from CGATCore import Experiment as E
 import CGATCore.IOTools as IOTools
 import CGAT.Genomics as Genomics
@@ -58,6 +69,11 @@ from six import StringIO
 
 IS_PY3 = sys.version_info.major >= 3
 
+if IS_PY3:
+    BYTES_COMPLEMENT = bytes.maketrans(b"ACGTacgt", b"TGCAtgca")
+else:
+    BYTES_COMPLEMENT = string.maketrans("ACGTacgt", "TGCAtgca")
+
 
 class Uncompressor:
 
@@ -94,6 +110,199 @@ class Uncompressor:
         return u[r:r + end - start]
 
 
+# lookup tables for 2-bit packing of nucleotides. These are built on
+# first use so that importing this module does not require numpy.
+_TWOBIT_TABLES = None
+
+
+def _getTwoBitTables():
+    """return lookup tables for 2-bit packing of nucleotides.
+
+    The encoding table maps characters to 2-bit codes. Any character
+    other than ACGT is stored as A and recorded in a run-length table
+    of N. The decoding table contains the decoded characters of each
+    byte, one row per byte value.
+    """
+    global _TWOBIT_TABLES
+    if _TWOBIT_TABLES is None:
+        import numpy
+        encode = numpy.zeros(256, dtype=numpy.uint8)
+        for x, c in enumerate("ACGT"):
+            encode[ord(c)] = x
+            encode[ord(c.lower())] = x
+
+        decode = numpy.array(
+            [bytearray("".join("ACGT"[(x >> shift) & 3]
+                               for shift in (6, 4, 2, 0)), "ascii")
+             for x in range(256)], dtype=numpy.uint8)
+        _TWOBIT_TABLES = (encode, decode)
+    return _TWOBIT_TABLES
+
+
+class TwoBitPacker:
+
+    """write nucleotide sequences in 2-bit packed format.
+
+    Each contig is stored as a block of packed nucleotides (4 per
+    byte, first base in the most significant bits) followed by two
+    run-length tables of half-open intervals, one for ``N`` and one
+    for soft-masked (lower case) residues. Each table is an unsigned
+    32-bit count followed by the start, end pairs.
+
+    Characters other than ``ACGTN`` (in either case) are stored as ``N``.
+    """
+
+    def __init__(self, outfile, chunk_size=1000000):
+        self.mFile = outfile
+        self.mChunkSize = chunk_size
+        self.mRegexMask = re.compile("[a-z]+")
+        self.mRegexN = re.compile("[^ACGT]+")
+        self.mRegexAmbiguous = re.compile("[^ACGTN]")
+        self.mEncode = _getTwoBitTables()[0]
+        self._reset()
+
+    def _reset(self):
+        self.mBuffer = []
+        self.mBufferSize = 0
+        self.mPosition = 0
+        self.mNRuns = []
+        self.mMaskRuns = []
+        self.mNAmbiguous = 0
+
+    def _addRuns(self, runs, regex, s):
+        offset = self.mPosition
+        for m in regex.finditer(s):
+            start, end = m.start() + offset, m.end() + offset
+            if runs and runs[-1][1] == start:
+                runs[-1][1] = end
+            else:
+                runs.append([start, end])
+
+    def _pack(self, s):
+        """pack sequence *s* and write to file. The length of s
+        needs to be a multiple of 4 unless it is the last chunk.
+        """
+        import numpy
+        self._addRuns(self.mMaskRuns, self.mRegexMask, s)
+        s = s.upper()
+        self._addRuns(self.mNRuns, self.mRegexN, s)
+        self.mNAmbiguous += len(self.mRegexAmbiguous.findall(s))
+
+        codes = self.mEncode[numpy.frombuffer(s.encode("ascii"),
+                                              dtype=numpy.uint8)]
+        rest = len(codes) % 4
+        if rest:
+            codes = numpy.concatenate(
+                (codes, numpy.zeros(4 - rest, dtype=numpy.uint8)))
+        codes = codes.reshape(-1, 4)
+        packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | \
+            (codes[:, 2] << 2) | codes[:, 3]
+        self.mFile.write(packed.astype(numpy.uint8).tobytes())
+        self.mPosition += len(s)
+
+    def add(self, s):
+        """add sequence *s* to current contig."""
+        self.mBuffer.append(s)
+        self.mBufferSize += len(s)
+        if self.mBufferSize >= self.mChunkSize:
+            s = "".join(self.mBuffer)
+            rest = len(s) % 4
+            if rest:
+                self._pack(s[:-rest])
+                self.mBuffer = [s[-rest:]]
+            else:
+                self._pack(s)
+                self.mBuffer = []
+            self.mBufferSize = rest
+
+    def finish(self):
+        """write remaining sequence and run-length tables of the
+        current contig.
+
+        Returns the number of ambiguous characters that have been
+        stored as ``N``.
+        """
+        import numpy
+        if self.mBuffer:
+            self._pack("".join(self.mBuffer))
+
+        for runs in (self.mNRuns, self.mMaskRuns):
+            self.mFile.write(struct.pack("<I", len(runs)))
+            if runs:
+                data = numpy.array(runs, dtype="<u4")
+                self.mFile.write(data.tobytes())
+
+        nambiguous = self.mNAmbiguous
+        self._reset()
+        return nambiguous
+
+
+class TwoBitUnpacker:
+
+    """read fragments from a 2-bit packed database written
+    by :class:`TwoBitPacker`.
+
+    Only the bytes covering a fragment are read and decoded.
+    The run-length tables of a contig are loaded on first access.
+    """
+
+    def __init__(self, filename):
+        self.mFile = open(filename, "rb")
+        self.mRuns = {}
+        self.mDecode = _getTwoBitTables()[1]
+
+    def _readRuns(self):
+        import numpy
+        n = struct.unpack("<I", self.mFile.read(4))[0]
+        runs = numpy.frombuffer(self.mFile.read(8 * n),
+                                dtype="<u4").reshape(-1, 2)
+        return (runs[:, 0].astype(numpy.int64),
+                runs[:, 1].astype(numpy.int64))
+
+    def _getRuns(self, pos_seq, lsequence):
+        if pos_seq not in self.mRuns:
+            self.mFile.seek(pos_seq + (lsequence + 3) // 4)
+            self.mRuns[pos_seq] = (self._readRuns(), self._readRuns())
+        return self.mRuns[pos_seq]
+
+    def _selectRuns(self, runs, start, end):
+        """return a boolean mask of positions in start:end covered
+        by *runs*."""
+        import numpy
+        starts, ends = runs
+        covered = numpy.zeros(end - start + 1, dtype=numpy.int32)
+        # runs are sorted and non-overlapping, so only runs between
+        # the last one starting at or before start and the first one
+        # starting at or after end can overlap.
+        first = max(0, numpy.searchsorted(starts, start, side="right") - 1)
+        last = numpy.searchsorted(starts, end, side="left")
+        a = numpy.maximum(starts[first:last], start) - start
+        b = numpy.minimum(ends[first:last], end) - start
+        keep = a < b
+        numpy.add.at(covered, a[keep], 1)
+        numpy.add.at(covered, b[keep], -1)
+        return numpy.cumsum(covered[:-1]) > 0
+
+    def read(self, pos_seq, lsequence, start, end):
+        """read sequence from start:end of a contig starting at
+        file position *pos_seq* with length *lsequence*.
+        """
+        import numpy
+        first_byte = start // 4
+        last_byte = (end + 3) // 4
+        self.mFile.seek(pos_seq + first_byte)
+        data = numpy.frombuffer(self.mFile.read(last_byte - first_byte),
+                                dtype=numpy.uint8)
+        offset = start % 4
+        s = self.mDecode[data].ravel()[offset:offset + end - start]
+
+        nruns, mask_runs = self._getRuns(pos_seq, lsequence)
+        s[self._selectRuns(nruns, start, end)] = ord("N")
+        # all characters are upper case letters
+        s[self._selectRuns(mask_runs, start, end)] |= 0x20
+        return s.tobytes().decode("ascii")
+
+
 def writeFragments(outfile_fasta,
                    outfile_index,
                    fragments,
@@ -357,7 +566,13 @@ class MultipleFastaIterator:
             if filename != "-":
                 infile.close()
 
-        raise StopIteration
+
+def _finishTwoBit(packer, identifier):
+    """finish a contig in a 2-bit packed database."""
+    nambiguous = packer.finish()
+    if nambiguous:
+        E.warn("%s: %i ambiguous characters have been stored as N" %
+               (identifier, nambiguous))
 
 
 def createDatabase(db, iterator,
@@ -379,6 +594,11 @@ def createDatabase(db, iterator,
 
     Dictzip is treated as an uncompressed file.
 
+    The compression ``twobit`` stores nucleotides in a 2-bit packed
+    format (see :class:`TwoBitPacker`) with the data and index written
+    to db.packed and db.pdx. This format does not require random
+    access points, as any fragment can be decoded directly.
+
     regex_identifier: pattern to extract identifier from description line.
     If None, the part until the first white-space character is used.
 
@@ -434,14 +654,26 @@ def createDatabase(db, iterator,
             mangler = RLE.compress
             db_name = db + ".rle"
             write_chunks = True
+        elif compression == "twobit":
+            if translator:
+                raise ValueError(
+                    "twobit compression can not be combined "
+                    "with a translator")
+            mangler = None
+            db_name = db + ".packed"
+            write_chunks = False
         else:
             raise ValueError("unknown compression library: %s" % compression)
 
-        index_name = db + ".cdx"
+        if compression == "twobit":
+            index_name = db + ".pdx"
+        else:
+            index_name = db + ".cdx"
 
-        if write_chunks and random_access_points is None \
-           or random_access_points <= 0:
-            raise ValueError("specify chunksize in --random-access-points")
+            if write_chunks and random_access_points is None \
+               or random_access_points <= 0:
+                raise ValueError(
+                    "specify chunksize in --random-access-points")
 
     else:
         def mangler(x):
@@ -464,6 +696,9 @@ def createDatabase(db, iterator,
         outfile_fasta = dictzip.open(
             db_name, "wb", buffersize=1000000, chunksize=random_access_points)
         compression = None
+    elif compression == "twobit":
+        outfile_fasta = open(db_name, "wb")
+        packer = TwoBitPacker(outfile_fasta)
     else:
         outfile_fasta = open(db_name, "w")
 
@@ -524,13 +759,16 @@ def createDatabase(db, iterator,
 
                     fragments = []
                     lfragment = 0
+                elif compression == "twobit":
+                    _finishTwoBit(packer, last_identifier)
                 else:
                     outfile_fasta.write("\n")
 
                 outfile_index.write("\t%i\n" % lsequence)
 
             identifier_pos = outfile_fasta.tell()
-            outfile_fasta.write(mangler(">%s\n" % out_identifier))
+            if compression != "twobit":
+                outfile_fasta.write(mangler(">%s\n" % out_identifier))
             sequence_pos = outfile_fasta.tell()
 
             outfile_index.write("%s\t%i" % (out_identifier,
@@ -565,12 +803,16 @@ def createDatabase(db, iterator,
                                       write_all=False)
                 fragments = [rest]
                 lfragment = len(rest)
+        elif compression == "twobit":
+            packer.add(s)
         else:
             outfile_fasta.write(mangler(s))
 
     if write_chunks:
         writeFragments(outfile_fasta, outfile_index, fragments, mangler,
                        size=random_access_points, write_all=True)
+    elif compression == "twobit":
+        _finishTwoBit(packer, last_identifier)
     else:
         outfile_fasta.write("\n")
 
@@ -584,6 +826,7 @@ def createDatabase(db, iterator,
 
 NAME_MAP = {
     'uncompressed': ('fasta', 'idx', False),
+    'twobit': ('packed', 'pdx', False),
     'lzo': ('lzo',   'cdx', True),
     'dictzip': ('dz',    'idx', False),
     'zlib': ('zlib',  'cdx', True),
@@ -593,7 +836,7 @@ NAME_MAP = {
 }
 
 PREFERENCES = (
-    'uncompressed', 'lzo', 'dictzip', 'zlib', 'gzip', 'bzip2', 'debug')
+    'uncompressed', 'twobit', 'lzo', 'dictzip', 'zlib', 'gzip', 'bzip2', 'debug')
 
 
 class CGATIndexedFasta:
@@ -646,6 +889,8 @@ class CGATIndexedFasta:
         """
         if self.mMethod == "uncompressed":
             self.mDatabaseFile = open(self.mDbname, "r")
+        elif self.mMethod == "twobit":
+            self.mDatabaseFile = TwoBitUnpacker(self.mDbname)
         elif self.mMethod == "dictzip":
             from . import dictzip
             self.mDatabaseFile = dictzip.GzipFile(self.mDbname)
@@ -905,7 +1150,11 @@ class CGATIndexedFasta:
 
         p = AString()
 
-        if self.mNoSeek:
+        if self.mMethod == "twobit":
+            p.fromstring(
+                self.mDatabaseFile.read(pos_seq, lsequence,
+                                        first_pos, last_pos))
+        elif self.mNoSeek:
             # read directly from position
             p.fromstring(
                 self.mDatabaseFile.read(block_size, data[3],
@@ -1065,10 +1314,188 @@ class PysamIndexedFasta(CGATIndexedFasta):
         return sequence
 
 
+class MMapIndexedFasta(CGATIndexedFasta):
+
+    """an uncompressed CGAT indexed fasta file accessed through
+    a memory map.
+
+    The sequence file is mapped read-only into memory. Fragments
+    on the forward strand are returned as slices of the map without
+    intermediate copies (see :meth:`getBuffer`), which makes this
+    backend suitable for a large number of small random accesses.
+    As the pages are shared through the operating system's page
+    cache, multiple processes can access the same database without
+    each holding a copy.
+
+    Only uncompressed databases (``.fasta``/``.idx``) are supported.
+    """
+
+    def __init__(self, dbname):
+
+        CGATIndexedFasta.__init__(self, dbname)
+
+        if self.mMethod != "uncompressed":
+            raise ValueError(
+                "memory mapped access requires an uncompressed database, "
+                "but %s is compressed with %s" % (dbname, self.mMethod))
+
+        self.mMap = None
+        self.mView = None
+
+    def _loadIndex(self, compress=False):
+        """load index and map the sequence file into memory."""
+
+        CGATIndexedFasta._loadIndex(self, compress=compress)
+
+        # replace text file handle opened by the base class
+        self.mDatabaseFile.close()
+        self.mDatabaseFile = open(self.mDbname, "rb")
+        self.mMap = mmap.mmap(self.mDatabaseFile.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        self.mView = memoryview(self.mMap)
+
+    def _getRange(self, contig, strand, start, end, converter):
+        """return file positions of a fragment.
+
+        Returns a tuple of (first_pos, last_pos, is_reverse) with
+        first_pos and last_pos being absolute offsets into the
+        sequence file.
+        """
+        contig = self.getToken(contig)
+
+        data = self.mIndex[contig]
+        pos_id, pos_seq, lsequence = struct.unpack("QQi", data)
+
+        if end == 0:
+            end = lsequence
+
+        if end > lsequence:
+            raise ValueError(
+                "3' coordinate on %s out of bounds: %i > %i" %
+                (contig, end, lsequence))
+
+        if start < 0:
+            raise ValueError(
+                "5' coordinate on %s out of bounds: %i < 0" % (contig, start))
+
+        is_reverse = str(strand) in ("-", "0", "-1")
+
+        if converter:
+            first_pos, last_pos = converter(start, end,
+                                            str(strand) in ("+", "1"),
+                                            lsequence)
+        elif self.mConverter:
+            first_pos, last_pos = self.mConverter(start, end,
+                                                  str(strand) in ("+", "1"),
+                                                  lsequence)
+        else:
+            first_pos, last_pos = start, end
+            if is_reverse:
+                first_pos, last_pos = lsequence - \
+                    last_pos, lsequence - first_pos
+
+        assert first_pos <= last_pos, \
+            "first position %i is larger than last position %i " % \
+            (first_pos, last_pos)
+
+        return first_pos + pos_seq, last_pos + pos_seq, is_reverse
+
+    def getBuffer(self,
+                  contig,
+                  strand="+",
+                  start=0,
+                  end=0,
+                  converter=None):
+        """return a genomic fragment as a buffer.
+
+        Fragments on the forward strand are returned as a read-only
+        :py:class:`memoryview` into the memory map without copying.
+        Fragments on the reverse strand need to be reverse-complemented
+        and are returned as :py:class:`bytes`.
+        """
+        if not self.mIsLoaded:
+            self._loadIndex()
+
+        first_pos, last_pos, is_reverse = self._getRange(
+            contig, strand, start, end, converter)
+
+        if is_reverse:
+            return self.mMap[first_pos:last_pos][::-1].translate(
+                BYTES_COMPLEMENT)
+        else:
+            return self.mView[first_pos:last_pos]
+
+    def getSequence(self,
+                    contig,
+                    strand="+",
+                    start=0,
+                    end=0,
+                    converter=None,
+                    as_array=False):
+        """get a genomic fragment.
+
+        See :meth:`CGATIndexedFasta.getSequence`.
+        """
+        b = self.getBuffer(contig, strand, start, end, converter)
+
+        if self.mTranslator:
+            return self.mTranslator.translate(bytes(b).decode("ascii"))
+        elif as_array:
+            return AString(bytes(b).decode("ascii"))
+        else:
+            return bytes(b).decode("ascii")
+
+    def getSequences(self, regions, converter=None, as_buffer=False):
+        """return a list of genomic fragments.
+
+        *regions* is an iterable of tuples (contig, strand, start,
+        end). Sequences are returned in the same order as regions.
+
+        If *as_buffer* is True, return buffers as in
+        :meth:`getBuffer`, otherwise return strings.
+        """
+        if not self.mIsLoaded:
+            self._loadIndex()
+
+        view, m = self.mView, self.mMap
+        result = []
+        for contig, strand, start, end in regions:
+            first_pos, last_pos, is_reverse = self._getRange(
+                contig, strand, start, end, converter)
+            if is_reverse:
+                b = m[first_pos:last_pos][::-1].translate(BYTES_COMPLEMENT)
+            elif as_buffer:
+                b = view[first_pos:last_pos]
+            else:
+                b = m[first_pos:last_pos]
+            if not as_buffer:
+                b = b.decode("ascii")
+            result.append(b)
+        return result
+
+    def close(self):
+        """release the memory map and close the sequence file."""
+        if self.mMap is not None:
+            self.mView.release()
+            self.mMap.close()
+            self.mDatabaseFile.close()
+            self.mMap = None
+            self.mView = None
+            self.mIsLoaded = False
+
+
 def IndexedFasta(dbname, *args, **kwargs):
-    '''factory function for IndexedFasta objects.'''
+    '''factory function for IndexedFasta objects.
 
-    if (os.path.exists(dbname) or os.path.exists(dbname + ".fa")) \
+    If *mmap* is set to True, an uncompressed CGAT indexed
+    database is accessed through :class:`MMapIndexedFasta`.
+    '''
+
+    use_mmap = kwargs.pop("mmap", False)
+
+    if use_mmap:
+        return MMapIndexedFasta(dbname, *args, **kwargs)
+    elif (os.path.exists(dbname) or os.path.exists(dbname + ".fa")) \
             and (os.path.exists(dbname + ".fai") or
                  os.path.exists(dbname + ".fa.fai")):
         return PysamIndexedFasta(dbname, *args, **kwargs)
@@ -1204,6 +1631,20 @@ def benchmarkRandomFragment(fasta, size):
     return s
 
 
+def benchmarkRandomFragments(fasta, size, num_fragments):
+    """returns *num_fragments* random fragments of size.
+
+    Fragments are retrieved in a single call through
+    :meth:`MMapIndexedFasta.getSequences` if available.
+    """
+    regions = [fasta.getRandomCoordinates(size)
+               for x in range(num_fragments)]
+    if hasattr(fasta, "getSequences"):
+        return fasta.getSequences(regions)
+    else:
+        return [fasta.getSequence(*x) for x in regions]
+
+
 def verify(fasta1, fasta2, num_iterations, fragment_size,
            stdout=sys.stdout, quiet=False):
     """verify two databases.
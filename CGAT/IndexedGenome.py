@@ -33,13 +33,37 @@ The basic usage is::
    print index.contains("chr1", 1000, 2000)
    print index.get("chr1", 10000, 20000)
 
-The index is built in memory.
+The index is built in memory. An index can be saved to disk with
+:meth:`IndexedGenome.save` and opened again with
+:meth:`IndexedGenome.open`::
+
+   index.save("intervals.index")
+   index = IndexedGenome.open("intervals.index")
+
+Many queries on the same contig can be done with a single call to
+:meth:`IndexedGenome.getBatch` or :meth:`IndexedGenome.countBatch`::
+
+   indptr, intervals = index.getBatch("chr1", starts, ends)
+   counts = index.countBatch("chr1", starts, ends)
+
+An index opened from disk is read-only. The intervals are queried
+from the files directly and the values are stored in a memory-mapped
+table, so that several processes can share the same index without
+each holding a copy in memory.
+
+A :class:`Quicksect` index is saved by pickling its intervals and
+is rebuilt in memory when it is opened.
 
 Reference
 ---------
 
 '''
+import os
+import mmap
+import pickle
+import numpy
 from CGAT import NCL as ncl
+from CGAT.NCL import cnestedlist
 from bx.intervals.intersection import Intersecter, Interval
 
 
@@ -50,6 +74,9 @@ class IndexedGenome:
 
     index_factory = ncl.NCL
 
+    # store values when saving the index
+    has_values = True
+
     def __init__(self):
         self.mIndex = {}
 
@@ -78,16 +105,126 @@ class IndexedGenome:
 
         return self.mIndex[contig].find(start, end)
 
+    def getBatch(self, contig, starts, ends):
+        '''return intervals overlapping with each of the intervals
+        on *contig* given by the arrays *starts* and *ends*.
+
+        Returns a tuple ``(indptr, intervals)``. *intervals* is an array
+        with the columns ``start``, ``end`` and ``id``. The intervals
+        overlapping query interval ``i`` are in the rows
+        ``indptr[i]:indptr[i+1]``. The values of the intervals can be
+        obtained with :meth:`getValues`. No intervals are returned for
+        contigs not in the index.
+        '''
+        if contig not in self.mIndex:
+            return emptyBatch(len(starts))
+
+        return self.mIndex[contig].findBatch(starts, ends)
+
+    def countBatch(self, contig, starts, ends):
+        '''return an array with the number of intervals overlapping
+        with each of the intervals on *contig* given by the arrays
+        *starts* and *ends*.'''
+        if contig not in self.mIndex:
+            return numpy.zeros(len(starts), dtype=numpy.int64)
+
+        return self.mIndex[contig].countBatch(starts, ends)
+
+    def getValues(self, contig, ids):
+        '''return the values of intervals on *contig* with *ids*
+        as returned by :meth:`getBatch`.
+
+        If the index does not store values, the *ids* are returned.
+        '''
+        if not self.has_values:
+            return list(ids)
+        values = self.mIndex[contig].mValues
+        return [values[x] for x in ids]
+
     def __len__(self):
         '''return number of contigs.'''
         return len(self.mIndex)
 
+    def save(self, path):
+        '''save index to directory *path*.
+
+        Each contig is saved as a nested containment list. The values
+        are pickled and stored in a single table shared by all
+        contigs. Values that are the same object are stored once.
+        An index opened with :meth:`open` can be saved again.
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        offsets = [0]
+        values = {}
+        outf_contigs = open(os.path.join(path, "contigs.tsv"), "w")
+        outf_values = open(os.path.join(path, "values.pickle"), "wb")
+
+        for x, contig in enumerate(sorted(self.mIndex.keys())):
+            index = self.mIndex[contig]
+            tuples = index.mTuples
+            if self.has_values:
+                ids = []
+                for start, end, idx in tuples:
+                    # values in a table of an opened index are
+                    # unpickled on access, so use their position
+                    # in the table to identify them
+                    if isinstance(index.mValues, ValueTable):
+                        key = (id(index.mValues), idx)
+                    else:
+                        key = id(index.mValues[idx])
+                    if key not in values:
+                        data = pickle.dumps(index.mValues[idx],
+                                            pickle.HIGHEST_PROTOCOL)
+                        outf_values.write(data)
+                        offsets.append(offsets[-1] + len(data))
+                        values[key] = len(values)
+                    ids.append(values[key])
+                tuples = [(start, end, y)
+                          for (start, end, idx), y in zip(tuples, ids)]
+
+            filestem = "contig%i" % x
+            db = cnestedlist.IntervalDB()
+            db.fromlist(tuples)
+            db.write_binaries(
+                os.path.join(path, filestem).encode("utf-8"))
+            outf_contigs.write("%s\t%s\t%i\n" %
+                               (contig, filestem, len(tuples)))
+
+        outf_contigs.close()
+        outf_values.close()
+        numpy.save(os.path.join(path, "values.offsets.npy"),
+                   numpy.array(offsets, dtype=numpy.int64))
+
+    @classmethod
+    def open(cls, path):
+        '''open an index saved with :meth:`save` in directory *path*.
+
+        The returned index can be queried, but no intervals can
+        be added.
+        '''
+        index = cls()
+        if cls.has_values:
+            values = ValueTable(path)
+        else:
+            values = None
+
+        with open(os.path.join(path, "contigs.tsv")) as inf:
+            for line in inf:
+                contig, filestem, nintervals = line[:-1].split("\t")
+                index.mIndex[contig] = NCLFile(
+                    os.path.join(path, filestem), values)
+        return index
+
 
 class Simple(IndexedGenome):
 
     '''index intervals without storing a value.'''
     index_factory = ncl.NCLSimple
 
+    has_values = False
+
     def __init__(self, *args, **kwargs):
         IndexedGenome.__init__(self, *args, **kwargs)
 
@@ -109,26 +246,101 @@ class Quicksect(IndexedGenome):
 
     def __init__(self, *args, **kwargs):
         IndexedGenome.__init__(self, *args, **kwargs)
+        self.mValues = {}
+        self.mIntervals = {}
 
     def add(self, contig, start, end, value):
 
         if contig not in self.mIndex:
             self.mIndex[contig] = self.index_factory()
-        self.mIndex[contig].add_interval(Interval(start, end, value))
+            self.mValues[contig] = []
+            self.mIntervals[contig] = []
+        # intervals store the position of the value in mValues
+        values = self.mValues[contig]
+        self.mIndex[contig].add_interval(Interval(start, end, len(values)))
+        self.mIntervals[contig].append((start, end))
+        values.append(value)
+
+    def getBatch(self, contig, starts, ends):
+        '''return intervals overlapping with each of the intervals
+        on *contig* given by the arrays *starts* and *ends*.
+
+        see :meth:`IndexedGenome.getBatch` for the return value.
+        '''
+        if contig not in self.mIndex:
+            return emptyBatch(len(starts))
+
+        index = self.mIndex[contig]
+        indptr = numpy.zeros(len(starts) + 1, dtype=numpy.int64)
+        hits = []
+        for x, (start, end) in enumerate(zip(starts, ends)):
+            if start < end:
+                hits.extend([(i.start, i.end, i.value)
+                             for i in index.find(start, end)])
+            indptr[x + 1] = len(hits)
+        intervals = numpy.array(hits, dtype=numpy.intc).reshape(-1, 3)
+        return indptr, intervals
+
+    def countBatch(self, contig, starts, ends):
+        '''return an array with the number of intervals overlapping
+        with each of the intervals on *contig* given by the arrays
+        *starts* and *ends*.'''
+        return numpy.diff(self.getBatch(contig, starts, ends)[0])
+
+    def getValues(self, contig, ids):
+        '''return the values of intervals on *contig* with *ids*
+        as returned by :meth:`getBatch`.'''
+        values = self.mValues[contig]
+        return [values[x] for x in ids]
+
+    def save(self, path):
+        '''save index to directory *path*.
+
+        The intervals and their values are pickled.
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        with open(os.path.join(path, "quicksect.pickle"), "wb") as outf:
+            pickle.dump(self.__getstate__(), outf, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def open(cls, path):
+        '''open an index saved with :meth:`save` in directory *path*.
+
+        Unlike indices based on nested containment lists, the index
+        is rebuilt in memory and intervals can be added.
+        '''
+        index = cls()
+        with open(os.path.join(path, "quicksect.pickle"), "rb") as inf:
+            index.__setstate__(pickle.load(inf))
+        return index
+
+    def __getstate__(self):
+        return dict([(contig, (self.mIntervals[contig], self.mValues[contig]))
+                     for contig in self.mIndex])
+
+    def __setstate__(self, state):
+        self.__init__()
+        for contig, (intervals, values) in sorted(state.items()):
+            for (start, end), value in zip(intervals, values):
+                self.add(contig, start, end, value)
 
     def get(self, contig, start, end):
         '''return intervals overlapping with key.'''
         if contig not in self.mIndex:
             raise KeyError("contig %s not in index" % contig)
 
-        return [(x.start, x.end, x.value)
+        values = self.mValues[contig]
+        return [(x.start, x.end, values[x.value])
                 for x in self.mIndex[contig].find(start, end)]
 
     def before(self, contig, start, end, num_intervals=1, max_dist=2500):
         '''get closest interval before *start*.'''
         if contig not in self.mIndex:
             raise KeyError("contig %s not in index" % contig)
-        return [(x.start, x.end, x.value)
+        values = self.mValues[contig]
+        return [(x.start, x.end, values[x.value])
                 for x in self.mIndex[contig].before_interval(
                     Interval(start, end),
                     num_intervals=1,
@@ -138,8 +350,138 @@ class Quicksect(IndexedGenome):
         '''get closest interval after *end*.'''
         if contig not in self.mIndex:
             raise KeyError("contig %s not in index" % contig)
-        return [(x.start, x.end, x.value)
+        values = self.mValues[contig]
+        return [(x.start, x.end, values[x.value])
                 for x in self.mIndex[contig].after_interval(
                     Interval(start, end),
                     num_intervals=1,
                     max_dist=max_dist)]
+
+
+def emptyBatch(nqueries):
+    '''return the result of a batch query with *nqueries* query
+    intervals without any overlapping intervals, see
+    :meth:`IndexedGenome.getBatch`.'''
+    return (numpy.zeros(nqueries + 1, dtype=numpy.int64),
+            numpy.empty((0, 3), dtype=numpy.intc))
+
+
+class NCLFile(object):
+
+    '''intervals of a contig in an index saved with
+    :meth:`IndexedGenome.save`.
+
+    The file handles are opened separately in each process, as
+    the files are read with seek and read operations. Handles
+    inherited from a parent process are closed.
+    '''
+
+    def __init__(self, filestem, values=None):
+        self.mFilestem = filestem
+        self.mValues = values
+        self.mDatabase = None
+        self.mPid = None
+
+    def add(self, *args):
+        raise ValueError("can not add to an index opened from disk")
+
+    @property
+    def mTuples(self):
+        """list of (start, end, id) tuples of all intervals.
+
+        The intervals are read from the files directly.
+        """
+        with open(self.mFilestem + ".size") as inf:
+            n, ntop, div, nlists, nii = map(int, inf.read().split())
+        # records of start, end, id and sublist. The top level list
+        # and large sublists are padded to a multiple of div.
+        records = numpy.fromfile(self.mFilestem + ".idb",
+                                 dtype=numpy.intc).reshape(-1, 4)
+        rows = [records[:ntop]]
+        if nlists > 0:
+            sublists = numpy.fromfile(self.mFilestem + ".subhead",
+                                      dtype=numpy.intc).reshape(-1, 2)
+            rows.extend(records[start:start + length]
+                        for start, length in sublists)
+        rows = numpy.concatenate(rows)
+        if len(rows) != n:
+            raise ValueError(
+                "expected %i intervals in %s, but found %i" %
+                (n, self.mFilestem, len(rows)))
+        return [(int(start), int(end), int(idx))
+                for start, end, idx in rows[:, :3]]
+
+    def _getDatabase(self):
+        pid = os.getpid()
+        if self.mPid != pid:
+            self.close()
+            self.mDatabase = cnestedlist.IntervalFileDB(
+                self.mFilestem.encode("utf-8"))
+            self.mPid = pid
+        return self.mDatabase
+
+    def close(self):
+        """close the file handles."""
+        if self.mDatabase is not None:
+            self.mDatabase.close()
+        self.mDatabase = None
+        self.mPid = None
+
+    def find(self, start, end):
+        """find intervals overlapping *start* and *end*."""
+        if start < 0:
+            raise ValueError(
+                "only positive coordinates are accepted (%i<0)" % start)
+        iterator = self._getDatabase().find_overlap(start, end)
+        if self.mValues is None:
+            return iterator
+        return ncl.IteratorWithValues(self.mValues, iterator)
+
+    def findBatch(self, starts, ends):
+        """find intervals overlapping with each of the intervals given
+        by the arrays *starts* and *ends*, see
+        :meth:`IndexedGenome.getBatch`."""
+        return self._getDatabase().find_overlap_batch(starts, ends)
+
+    def countBatch(self, starts, ends):
+        """count intervals overlapping with each of the intervals given
+        by the arrays *starts* and *ends*."""
+        return self._getDatabase().count_overlap_batch(starts, ends)
+
+    def __getstate__(self):
+        return (self.mFilestem, self.mValues)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+class ValueTable(object):
+
+    '''values of an index saved with :meth:`IndexedGenome.save`.
+
+    Values are unpickled on access from a memory-mapped file.
+    '''
+
+    def __init__(self, path):
+        self.mPath = path
+        self.mOffsets = numpy.load(
+            os.path.join(path, "values.offsets.npy"), mmap_mode="r")
+        with open(os.path.join(path, "values.pickle"), "rb") as inf:
+            if os.fstat(inf.fileno()).st_size > 0:
+                self.mData = mmap.mmap(inf.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            else:
+                self.mData = b""
+
+    def __getitem__(self, key):
+        return pickle.loads(
+            self.mData[self.mOffsets[key]:self.mOffsets[key + 1]])
+
+    def __len__(self):
+        return len(self.mOffsets) - 1
+
+    def __getstate__(self):
+        return self.mPath
+
+    def __setstate__(self, path):
+        self.__init__(path)
@@ -69,6 +69,24 @@ class NCLSimple(object):
         self._commit()
         return self.mDatabase.find_overlap(start, end)
 
+    def findBatch(self, starts, ends):
+        """find intervals in database overlapping with each of the
+        intervals given by the arrays *starts* and *ends*.
+
+        returns a tuple ``(indptr, intervals)``, see
+        :meth:`cnestedlist.IntervalDB.find_overlap_batch`.
+        """
+        self._commit()
+        return self.mDatabase.find_overlap_batch(starts, ends)
+
+    def countBatch(self, starts, ends):
+        """return an array with the number of intervals in database
+        overlapping with each of the intervals given by the arrays
+        *starts* and *ends*.
+        """
+        self._commit()
+        return self.mDatabase.count_overlap_batch(starts, ends)
+
     def _commit(self):
         """commit database if changed."""
         if self.mIsDirty:
@@ -1,5 +1,6 @@
 #cython: embedsignature=True
 cimport cython
+import numpy
 
 ###############################
 # Could not make .pxd file to be found in gpipe/setup.py, so including it here:
@@ -277,6 +278,27 @@ cdef class IntervalDB:
     free_interval_iterator(it_alloc)
     return l
         
+  def find_overlap_batch(self,starts,ends):
+    """find intervals in database overlapping with each of the
+    query intervals given by the arrays *starts* and *ends*.
+
+    returns a tuple ``(indptr, intervals)``. *intervals* is an array
+    with the columns ``start``, ``end`` and ``id``. The intervals
+    overlapping query interval ``i`` are in the rows
+    ``indptr[i]:indptr[i+1]``. Empty query intervals do not
+    overlap any interval.
+    """
+    self.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    return find_batch(self,None,starts,ends,0)
+
+  def count_overlap_batch(self,starts,ends):
+    """return an array with the number of intervals in database
+    overlapping with each of the query intervals given by the
+    arrays *starts* and *ends*.
+    """
+    self.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    return find_batch(self,None,starts,ends,1)
+
   def check_nonempty(self):
     """return True if the database is empty."""
     if self.im:
@@ -364,6 +386,23 @@ cdef class IntervalFileDB:
     free_interval_iterator(it_alloc)
     return l
 
+  def find_overlap_batch(self,starts,ends):
+    """find intervals in database overlapping with each of the
+    query intervals given by the arrays *starts* and *ends*.
+
+    see :meth:`IntervalDB.find_overlap_batch` for the return value.
+    """
+    self.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    return find_batch(None,self,starts,ends,0)
+
+  def count_overlap_batch(self,starts,ends):
+    """return an array with the number of intervals in database
+    overlapping with each of the query intervals given by the
+    arrays *starts* and *ends*.
+    """
+    self.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    return find_batch(None,self,starts,ends,1)
+
   def check_nonempty(self):
     if self.db==NULL:
       raise IndexError('empty IntervalFileDB, not searchable!')
@@ -379,6 +418,89 @@ cdef class IntervalFileDB:
       free_interval_dbfile(self.db)
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef find_batch(IntervalDB mdb,IntervalFileDB fdb,starts,ends,int count_only):
+  """find intervals overlapping the query intervals *starts* and *ends*
+  in either the in-memory database *mdb* or the on-disk database *fdb*.
+
+  If *count_only* is set, return an array with the number of overlapping
+  intervals for each query interval. Otherwise, return the intervals as
+  described in :meth:`IntervalDB.find_overlap_batch`.
+  """
+  cdef int [:] qstarts=numpy.ascontiguousarray(starts,dtype=numpy.intc)
+  cdef int [:] qends=numpy.ascontiguousarray(ends,dtype=numpy.intc)
+  cdef int nqueries=qstarts.shape[0]
+  cdef int i,j,nhit
+  cdef long nhits=0,nalloc=1024
+  cdef IntervalIterator *it,*it_alloc
+  cdef IntervalMap im_buf[1024]
+  cdef IntervalMap *hits=NULL
+  cdef IntervalMap *new_hits
+  cdef long long [:] counts
+  cdef int [:,:] intervals
+
+  if qends.shape[0]!=nqueries:
+    raise ValueError('starts and ends must have the same length')
+
+  result=numpy.zeros(nqueries+1-count_only,dtype=numpy.int64)
+  counts=result
+  if not count_only:
+    hits=interval_map_alloc(nalloc)
+    if hits==NULL:
+      raise MemoryError('out of memory')
+
+  it_alloc=interval_iterator_alloc()
+  try:
+    for i from 0 <= i < nqueries:
+      nhit=0
+      if qstarts[i]<qends[i]:
+        it=reset_interval_iterator(it_alloc) # REUSE ITERATOR FOR EACH QUERY
+        while it:
+          if mdb is not None:
+            find_intervals(it,qstarts[i],qends[i],mdb.im,mdb.ntop,
+                           mdb.subheader,mdb.nlists,im_buf,1024,
+                           &(nhit),&(it)) # GET NEXT BUFFER CHUNK
+          else:
+            find_file_intervals(it,qstarts[i],qends[i],
+                                fdb.db[0].ii,fdb.db[0].nii,
+                                fdb.db[0].subheader,fdb.db[0].nlists,
+                                &(fdb.db[0].subheader_file),
+                                fdb.db[0].ntop,fdb.db[0].div,
+                                fdb.db[0].ifile_idb,im_buf,1024,
+                                &(nhit),&(it)) # GET NEXT BUFFER CHUNK
+          if not count_only:
+            if nhits+nhit>nalloc: # EXPAND HIT BUFFER
+              while nhits+nhit>nalloc:
+                nalloc=2*nalloc
+              new_hits=<IntervalMap *>realloc(hits,nalloc*sizeof(IntervalMap))
+              if new_hits==NULL:
+                raise MemoryError('out of memory')
+              hits=new_hits
+            memcpy(hits+nhits,im_buf,nhit*sizeof(IntervalMap))
+          nhits=nhits+nhit
+      if count_only:
+        counts[i]=nhits
+        nhits=0
+      else:
+        counts[i+1]=nhits
+
+    if count_only:
+      return result
+
+    a=numpy.empty((nhits,3),dtype=numpy.intc)
+    intervals=a
+    for j from 0 <= j < nhits:
+      intervals[j,0]=hits[j].start
+      intervals[j,1]=hits[j].end
+      intervals[j,2]=hits[j].target_id
+    return result,a
+  finally:
+    free_interval_iterator(it_alloc)
+    if hits:
+      free(hits)
+
+
 cdef class IntervalFileDBIterator:
   """disk based intervalDB."""
 
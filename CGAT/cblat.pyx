@@ -0,0 +1,306 @@
+'''cblat.pyx - compiled parser for PSL formatted files
+====================================================
+
+This module provides a compiled parser for :term:`psl` formatted
+files. :func:`iterator` returns :class:`Blat.Match` objects and can
+be used in place of :func:`Blat.iterator`. :func:`iterator_batch`
+returns the columns of many records at a time as numpy arrays.
+
+Fields are located and integers are converted directly on the bytes
+of a line without splitting it into a list of strings first. The
+block coordinates of :class:`Blat.Match` objects are kept as strings
+and only decoded when they are accessed.
+
+Reference
+---------
+
+'''
+import numpy
+from libc.stdint cimport int64_t
+from CGAT.Blat import Match, ParsingError, FIELDS
+
+# number of columns in a psl formatted line
+cdef enum:
+    NFIELDS = 21
+    NINTS = 15
+
+# columns with integer values
+INT_FIELDS = (0, 1, 2, 3, 4, 5, 6, 7, 10, 11, 12, 14, 15, 16, 17)
+
+
+cdef inline bint _isSpace(char c):
+    return c == ' ' or c == '\t' or c == '\n' or c == '\r' or \
+        c == '\x0b' or c == '\x0c'
+
+
+cdef int _splitFields(const char * s,
+                      Py_ssize_t length,
+                      Py_ssize_t * starts,
+                      Py_ssize_t * ends):
+    '''find the first NFIELDS white-space separated fields in *s*.
+
+    Returns the number of fields found.
+    '''
+    cdef Py_ssize_t i = 0
+    cdef int n = 0
+    while n < NFIELDS:
+        while i < length and _isSpace(s[i]):
+            i += 1
+        if i >= length:
+            break
+        starts[n] = i
+        while i < length and not _isSpace(s[i]):
+            i += 1
+        ends[n] = i
+        n += 1
+    return n
+
+
+cdef int64_t _parseInt(const char * s,
+                       Py_ssize_t start,
+                       Py_ssize_t end) except? -1:
+    '''convert field from *start* to *end* in *s* to an integer.'''
+    cdef Py_ssize_t i = start
+    cdef int64_t value = 0
+    cdef int sign = 1
+
+    if i < end and (s[i] == '-' or s[i] == '+'):
+        if s[i] == '-':
+            sign = -1
+        i += 1
+
+    if i == end:
+        raise ValueError("invalid literal for int(): '%s'" %
+                         s[start:end].decode())
+
+    while i < end:
+        if s[i] < '0' or s[i] > '9':
+            raise ValueError("invalid literal for int(): '%s'" %
+                             s[start:end].decode())
+        value = value * 10 + (s[i] - 48)
+        i += 1
+
+    return sign * value
+
+
+cdef Py_ssize_t _parseList(const char * s,
+                           Py_ssize_t start,
+                           Py_ssize_t end,
+                           int64_t * values,
+                           Py_ssize_t max_values) except -1:
+    '''convert comma-separated list of integers to *values*.
+
+    At most *max_values* are stored. Returns the number of values
+    in the list.
+    '''
+    cdef Py_ssize_t i = start
+    cdef Py_ssize_t last = start
+    cdef Py_ssize_t n = 0
+
+    while i <= end:
+        if i == end or s[i] == ',':
+            # trailing comma or empty list
+            if i == last:
+                if i == end:
+                    break
+                raise ValueError("empty value in list '%s'" %
+                                 s[start:end].decode())
+            if n < max_values:
+                values[n] = _parseInt(s, last, i)
+            n += 1
+            last = i + 1
+        i += 1
+
+    return n
+
+
+cdef _buildMatch(bytes line):
+    '''build a :class:`Blat.Match` from a psl formatted *line*.'''
+    cdef const char * s = line
+    cdef Py_ssize_t starts[NFIELDS]
+    cdef Py_ssize_t ends[NFIELDS]
+    cdef int n = _splitFields(s, len(line), starts, ends)
+
+    if n < NFIELDS:
+        raise ParsingError("parsing error: %i fields" % n,
+                           line.decode())
+
+    cdef int64_t nmatches = _parseInt(s, starts[0], ends[0])
+    cdef int64_t nmismatches = _parseInt(s, starts[1], ends[1])
+    cdef int64_t query_length = _parseInt(s, starts[10], ends[10])
+    cdef int64_t sbjct_length = _parseInt(s, starts[14], ends[14])
+
+    match = Match.__new__(Match)
+    match.mNMatches = nmatches
+    match.mNMismatches = nmismatches
+    match.mNRepMatches = _parseInt(s, starts[2], ends[2])
+    match.mNns = _parseInt(s, starts[3], ends[3])
+    match.mQueryNGapsCounts = _parseInt(s, starts[4], ends[4])
+    match.mQueryNGapsBases = _parseInt(s, starts[5], ends[5])
+    match.mSbjctNGapsCounts = _parseInt(s, starts[6], ends[6])
+    match.mSbjctNGapsBases = _parseInt(s, starts[7], ends[7])
+    match.strand = s[starts[8]:ends[8]].decode()
+    match.mQueryId = s[starts[9]:ends[9]].decode()
+    match.mQueryLength = query_length
+    match.mQueryFrom = _parseInt(s, starts[11], ends[11])
+    match.mQueryTo = _parseInt(s, starts[12], ends[12])
+    match.mSbjctId = s[starts[13]:ends[13]].decode()
+    match.mSbjctLength = sbjct_length
+    match.mSbjctFrom = _parseInt(s, starts[15], ends[15])
+    match.mSbjctTo = _parseInt(s, starts[16], ends[16])
+    match.mNBlocks = _parseInt(s, starts[17], ends[17])
+    match._blocks = (s[starts[18]:ends[18]].decode(),
+                     s[starts[19]:ends[19]].decode(),
+                     s[starts[20]:ends[20]].decode())
+
+    if query_length != 0:
+        match.mQueryCoverage = 100.0 * \
+            (nmismatches + nmatches) / query_length
+    else:
+        match.mQueryCoverage = 0
+
+    if sbjct_length != 0:
+        match.mSbjctCoverage = 100.0 * \
+            (nmismatches + nmatches) / sbjct_length
+    else:
+        match.mSbjctCoverage = 0
+
+    if nmatches + nmismatches > 0:
+        match.mPid = 100.0 * nmatches / (nmatches + nmismatches)
+    else:
+        match.mPid = 100.0
+
+    return match
+
+
+def _iterate_lines(infile):
+    '''iterate over data lines in a psl file.
+
+    Comments, empty lines and headers are skipped.
+    '''
+    cdef str line
+    cdef int x
+
+    it = iter(infile)
+    for line in it:
+        if line[0] == "#":
+            continue
+        if line.startswith("match"):
+            continue
+        if line.startswith("psLayout version 3"):
+            for x in range(4):
+                next(it, None)
+            continue
+        if len(line.strip()) == 0:
+            continue
+        yield line
+
+
+def iterator(infile):
+    """iterate over :term:`psl` formatted entries in *infile*.
+
+    Yields objects of type :class:`Blat.Match`.
+    """
+    cdef str line
+    for line in _iterate_lines(infile):
+        yield _buildMatch(line.encode())
+
+
+def _buildBatch(int_values, block_values, strands, query_ids, sbjct_ids,
+                Py_ssize_t n, Py_ssize_t nblocks):
+    '''return dictionary of columns for *n* records.'''
+    batch = {}
+    for x, column in enumerate(INT_FIELDS):
+        batch[FIELDS[column]] = int_values[x, :n]
+    batch[FIELDS[8]] = numpy.array(strands, dtype=object)
+    batch[FIELDS[9]] = numpy.array(query_ids, dtype=object)
+    batch[FIELDS[13]] = numpy.array(sbjct_ids, dtype=object)
+    for x, column in enumerate((18, 19, 20)):
+        batch[FIELDS[column]] = block_values[x, :nblocks]
+    return batch
+
+
+def iterator_batch(infile, Py_ssize_t batch_size=100000):
+    """iterate over :term:`psl` formatted entries in *infile* in
+    batches of *batch_size* records.
+
+    Yields dictionaries mapping column names in :data:`Blat.FIELDS`
+    to numpy arrays, see :func:`Blat.iterator_batch`.
+    """
+    if batch_size <= 0:
+        raise ValueError("batch size needs to be positive")
+
+    cdef int int_columns[NINTS]
+    int_columns[:] = INT_FIELDS
+
+    cdef Py_ssize_t starts[NFIELDS]
+    cdef Py_ssize_t ends[NFIELDS]
+    cdef Py_ssize_t n = 0
+    cdef Py_ssize_t nblocks = 0
+    cdef Py_ssize_t capacity = batch_size
+    cdef Py_ssize_t block_count, found
+    cdef int nfields, x
+    cdef bytes b
+    cdef const char * s
+    cdef int64_t[:, ::1] int_view
+    cdef int64_t[:, ::1] block_view
+
+    int_values = numpy.zeros((NINTS, batch_size), dtype=numpy.int64)
+    int_view = int_values
+    block_values = numpy.zeros((3, capacity), dtype=numpy.int64)
+    block_view = block_values
+    strands, query_ids, sbjct_ids = [], [], []
+
+    for line in _iterate_lines(infile):
+        b = line.encode()
+        s = b
+        nfields = _splitFields(s, len(b), starts, ends)
+        if nfields < NFIELDS:
+            raise ParsingError("parsing error: %i fields" % nfields, line)
+
+        for x from 0 <= x < NINTS:
+            int_view[x, n] = _parseInt(s,
+                                       starts[int_columns[x]],
+                                       ends[int_columns[x]])
+
+        strands.append(s[starts[8]:ends[8]].decode())
+        query_ids.append(s[starts[9]:ends[9]].decode())
+        sbjct_ids.append(s[starts[13]:ends[13]].decode())
+
+        block_count = int_view[NINTS - 1, n]
+        if block_count < 0:
+            raise ParsingError("negative block count", line)
+
+        if nblocks + block_count > capacity:
+            capacity = max(2 * capacity, nblocks + block_count)
+            resized = numpy.zeros((3, capacity), dtype=numpy.int64)
+            resized[:, :nblocks] = block_values[:, :nblocks]
+            block_values = resized
+            block_view = block_values
+
+        for x from 0 <= x < 3:
+            found = _parseList(s, starts[18 + x], ends[18 + x],
+                               &block_view[x, 0] + nblocks, block_count)
+            if found != block_count:
+                raise ParsingError(
+                    "expected %i blocks, but found %i" %
+                    (block_count, found), line)
+
+        nblocks += block_count
+        n += 1
+
+        if n == batch_size:
+            yield _buildBatch(int_values, block_values,
+                              strands, query_ids, sbjct_ids,
+                              n, nblocks)
+            n = nblocks = 0
+            int_values = numpy.zeros((NINTS, batch_size), dtype=numpy.int64)
+            int_view = int_values
+            block_values = numpy.zeros((3, capacity), dtype=numpy.int64)
+            block_view = block_values
+            strands, query_ids, sbjct_ids = [], [], []
+
+    if n > 0:
+        yield _buildBatch(int_values, block_values,
+                          strands, query_ids, sbjct_ids,
+                          n, nblocks)
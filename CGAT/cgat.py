@@ -26,16 +26,30 @@ for a list of all available tools.
 To get help for a specific tool, type::
 
     cgat <tool> --help
+
+To time the start-up of a tool and list the slowest imports, type::
+
+    cgat --time-startup <tool>
+
+The list of tools and their keywords is read from a registry
+(:file:`cgat_index.json`) that is built at install time. If the
+registry is missing or scripts have been added or removed, the
+scripts are scanned instead.
 '''
 
 import os
 import sys
 import re
 import glob
-import imp
+import json
+import importlib
 import collections
-import CGATCore.IOTools as IOTools
-import CGAT
+
+# location of the scripts and the pre-built script registry
+SCRIPTS_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                           "scripts")
+INDEX_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                          "cgat_index.json")
 
 
 def mapKeyword2Script(path):
@@ -45,7 +59,7 @@ def mapKeyword2Script(path):
 
     for script in glob.glob(os.path.join(path, "*.py")):
         s = os.path.basename(script)[:-3]
-        with IOTools.openFile(script, 'r') as inf:
+        with open(script, 'r') as inf:
             data = [x for x in inf.readlines(10000) if x.startswith(':Tags:')]
             if data:
                 keywords = [x.strip() for x in data[0][6:].split(' ')]
@@ -56,6 +70,107 @@ def mapKeyword2Script(path):
     return map_keyword2script
 
 
+def listScripts(path):
+    '''return sorted list of script names in *path*.'''
+    return sorted([x[:-3] for x in os.listdir(path) if x.endswith(".py")])
+
+
+def scanScripts(path):
+    '''return a registry of scripts and keywords in *path*.'''
+    return {"scripts": listScripts(path),
+            "keywords": mapKeyword2Script(path)}
+
+
+def buildScriptIndex(path=SCRIPTS_DIR, filename=INDEX_FILE):
+    '''build the script registry for scripts in *path* and
+    save it in *filename*.
+
+    This function is called at install time. The registry is written
+    to a temporary file first and then renamed, so that concurrent
+    readers never see a partial file.
+    '''
+    import tempfile
+
+    index = scanScripts(path)
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    handle, tmpfile = tempfile.mkstemp(dir=dirname, suffix=".json")
+    try:
+        with os.fdopen(handle, "w") as outf:
+            json.dump(index, outf, indent=0, sort_keys=True)
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, filename)
+    except Exception:
+        os.unlink(tmpfile)
+        raise
+
+    return index
+
+
+def loadScriptIndex(path=SCRIPTS_DIR, filename=INDEX_FILE):
+    '''return the script registry.
+
+    The registry is read from *filename* if it lists the same
+    scripts as are present in *path*, otherwise it is rebuilt from
+    the scripts. Checking the registry requires a single directory
+    listing, but changes to the keywords of existing scripts
+    are not detected.
+    '''
+    try:
+        with open(filename) as inf:
+            index = json.load(inf)
+        if index["scripts"] == listScripts(path):
+            return index
+    except (OSError, IOError, ValueError, KeyError):
+        pass
+
+    try:
+        return buildScriptIndex(path, filename)
+    except (OSError, IOError):
+        # installation directory might not be writable
+        return scanScripts(path)
+
+
+def timeStartup(command, outfile=sys.stdout, nslowest=20):
+    '''time start-up of *command*.
+
+    The tool is run with ``--help`` in a separate interpreter
+    using python's ``-X importtime`` option. The total wall clock
+    time and the *nslowest* imports by cumulative time are written
+    to *outfile*.
+    '''
+    import subprocess
+    import time
+
+    start = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, "-X", "importtime", "-m", "CGAT.cgat",
+         command, "--help"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+    stdout, stderr = proc.communicate()
+    elapsed = time.time() - start
+
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            imports.append((int(fields[1]), fields[2].strip()))
+        except (ValueError, IndexError):
+            continue
+
+    imports.sort(reverse=True)
+    outfile.write("command\tstatus\ttime_ms\n")
+    outfile.write("%s\t%i\t%i\n" %
+                  (command, proc.returncode, elapsed * 1000))
+    outfile.write("\nmodule\tcumulative_us\n")
+    for cumulative, module in imports[:nslowest]:
+        outfile.write("%s\t%i\n" % (module, cumulative))
+
+
 def printListInColumns(l, ncolumns):
     '''output list *l* in *ncolumns*.'''
     ll = len(l)
@@ -90,13 +205,11 @@ def main(argv=None):
 
     argv = sys.argv
 
-    path = os.path.join(os.path.abspath(os.path.dirname(CGAT.__file__)),
-                        "scripts")
-
     if len(argv) == 1 or argv[1] == "--help" or argv[1] == "-h":
         print((globals()["__doc__"]))
 
-        map_keyword2script = mapKeyword2Script(path)
+        index = loadScriptIndex()
+        map_keyword2script = index["keywords"]
 
         if len(argv) <= 2:
 
@@ -108,8 +221,7 @@ def main(argv=None):
         if 'all' in argv[2:]:
             print("The list of all available commands is:\n")
             print(("%s\n" % printListInColumns(
-                sorted([os.path.basename(x)[:-3]
-                        for x in glob.glob(os.path.join(path, "*.py"))]),
+                sorted(index["scripts"]),
                 3)))
 
         else:
@@ -121,12 +233,18 @@ def main(argv=None):
                         3)))
         return
 
+    if argv[1] == "--time-startup":
+        if len(argv) != 3:
+            raise ValueError("usage: cgat --time-startup <tool>")
+        timeStartup(argv[2])
+        return
+
     command = argv[1]
 
     command = re.sub("-", "_", command)
-    
-    (file, pathname, description) = imp.find_module(command, [path, ])
-    module = imp.load_module(command, file, pathname, description)
+
+    # only the requested tool is imported
+    module = importlib.import_module("CGAT.scripts.%s" % command)
     # remove 'cgat' from sys.argv
     del sys.argv[0]
     module.main(sys.argv)
@@ -0,0 +1,347 @@
+'''cgtf.pyx - compiled parser for GTF formatted files
+=====================================================
+
+This module provides a compiled equivalent of :class:`GTF.Entry`
+and an iterator over :term:`gtf` formatted files that can be used
+in place of :func:`GTF.iterator`, for example as input to
+:func:`GTF.transcript_iterator` or :func:`GTF.gene_iterator`.
+
+The main differences to :class:`GTF.Entry` are:
+
+* records are stored in a fixed C structure without a per-instance
+  dictionary.
+* only the ``gene_id`` and ``transcript_id`` attributes are extracted
+  when a line is read. The remaining attributes are parsed when they
+  are first accessed, for example through :attr:`Entry.attributes`,
+  ``entry["gene_name"]`` or ``entry.gene_name``.
+
+The string representation is identical to that of :class:`GTF.Entry`.
+
+Reference
+---------
+
+'''
+from cpython.object cimport PyObject_GenericSetAttr
+import collections
+from CGAT.GTF import ParsingError
+
+
+cdef _parseField(str f):
+    '''parse a single attribute field into name and value.
+
+    The conversion rules follow :meth:`GTF.Entry.parseInfo`.
+    '''
+    cdef list d = [x.strip() for x in f.split(" ")]
+
+    n, v = d[0], " ".join(d[1:])
+    if len(d) > 2:
+        v = d[1:]
+
+    if v[0] == '"' and v[-1] == '"':
+        v = v[1:-1]
+    else:
+        # try to convert to a value
+        try:
+            v = float(v)
+            v = int(v)
+        except ValueError:
+            pass
+        except TypeError:
+            pass
+
+    return n, v
+
+
+cdef list _splitFields(str attributes):
+    '''split attribute column into fields, see
+    :meth:`GTF.Entry.parseInfo`.'''
+    # remove comments
+    attributes = attributes.split("#")[0]
+    return [x.strip() for x in
+            attributes[:attributes.rfind(";")].split("; ")]
+
+
+cdef class Entry:
+    """representation of a :term:`GTF` formatted entry.
+
+    See :class:`GTF.Entry` for a description of the attributes.
+
+    Attributes that are not one of the fixed GTF fields are
+    looked up in or stored to the attribute dictionary, so that
+    ``entry.gene_name`` is equivalent to ``entry["gene_name"]``.
+    """
+
+    cdef public object contig
+    cdef public object source
+    cdef public object feature
+    cdef public object frame
+    cdef public long start
+    cdef public long end
+    cdef public object score
+    cdef public object strand
+    cdef public object gene_id
+    cdef public object transcript_id
+    # attributes other than gene_id and transcript_id, parsed on demand
+    cdef object _attributes
+    # unparsed attribute fields
+    cdef list _fields
+
+    def __init__(self):
+        self.contig = "."
+        self.source = "."
+        self.feature = "."
+        self.frame = "."
+        self.start = 0
+        self.end = 0
+        self.score = "."
+        self.strand = "."
+        self.gene_id = None
+        self.transcript_id = None
+        self._attributes = collections.OrderedDict()
+        self._fields = None
+
+    def read(self, str line):
+        """read gff entry from line in GTF/GFF format.
+
+        <seqname> <source> <feature> <start> <end> <score> \
+              <strand> <frame> [attributes] [comments]
+        """
+        cdef list data = line[:-1].split("\t")
+        cdef str f
+
+        if len(data) < 9:
+            raise ValueError("parsing error in line `%s`" % line)
+
+        self.contig, self.source, self.feature = data[0], data[1], data[2]
+        self.start = int(data[3]) - 1
+        self.end = int(data[4])
+        self.score, self.strand, self.frame = data[5], data[6], data[7]
+
+        self.gene_id = None
+        self.transcript_id = None
+        self._attributes = None
+        self._fields = _splitFields(data[8])
+
+        # only extract identifiers, other attributes are parsed lazily
+        for f in self._fields:
+            if f.startswith("gene_id"):
+                n, v = _parseField(f)
+                if n == "gene_id":
+                    self.gene_id = v
+            elif f.startswith("transcript_id"):
+                n, v = _parseField(f)
+                if n == "transcript_id":
+                    self.transcript_id = v
+
+        if not self.gene_id:
+            raise ParsingError("missing attribute 'gene_id' in line %s" % line)
+        if not self.transcript_id:
+            raise ParsingError(
+                "missing attribute 'transcript_id' in line %s" % line)
+
+    cdef object _getAttributes(self):
+        cdef str f
+        if self._attributes is None:
+            self._attributes = collections.OrderedDict()
+            for f in self._fields:
+                n, v = _parseField(f)
+                if n != "gene_id" and n != "transcript_id":
+                    self._attributes[n] = v
+            self._fields = None
+        return self._attributes
+
+    property attributes:
+        """dictionary of additional attributes."""
+
+        def __get__(self):
+            return self._getAttributes()
+
+        def __set__(self, value):
+            self._attributes = value
+            self._fields = None
+
+    def getAttributeField(self, full=True):
+        aa = []
+        for k, v in list(self._getAttributes().items()):
+            if isinstance(v, str):
+                aa.append('%s "%s"' % (k, v))
+            elif isinstance(v, list) or isinstance(v, tuple):
+                aa.append('%s "%s"' % (k, " ".join(v)))
+            else:
+                aa.append('%s %s' % (k, str(v)))
+
+        if full:
+            return "; ".join(['gene_id "%s"' % self.gene_id,
+                              'transcript_id "%s"' % self.transcript_id] +
+                             aa)
+        else:
+            return "; ".join(aa)
+
+    def __str__(self):
+        if self.score is None:
+            score = "."
+        else:
+            score = str(self.score)
+
+        return "\t".join(map(str, (self.contig, self.source,
+                                   self.feature,
+                                   self.start + 1, self.end,
+                                   score,
+                                   self.strand,
+                                   self.frame,
+                                   self.getAttributeField()))) + ";"
+
+    def invert(self, lcontig):
+        """invert genomic coordinates from forward to reverse coordinates and
+        back.
+        """
+        if self.strand in ("-", "0", "-1"):
+            x = min(self.start, self.end)
+            y = max(self.start, self.end)
+
+            self.start = lcontig - y
+            self.end = lcontig - x
+
+    def fromGTF(self, other, gene_id=None, transcript_id=None):
+        """fill record from other GFF/GTF entry.
+
+        The optional attributes are not copied.
+        """
+        self.contig = other.contig
+        self.source = other.source
+        self.feature = other.feature
+        self.start = other.start
+        self.end = other.end
+        self.score = other.score
+        self.strand = other.strand
+        self.frame = other.frame
+        if gene_id is not None:
+            self.gene_id = gene_id
+        else:
+            self.gene_id = other.gene_id
+        if transcript_id is not None:
+            self.transcript_id = transcript_id
+        else:
+            self.transcript_id = other.transcript_id
+
+        if self.frame is None:
+            self.frame = "."
+        if self.strand is None:
+            self.strand = "."
+
+        return self
+
+    def copy(self, other):
+        """fill from other entry.
+
+        This method works if other is :class:`GTF.Entry`,
+        :class:`Entry` or :class:`pysam.GTFProxy`.
+        """
+        self.fromGTF(other)
+        self.attributes = collections.OrderedDict(other.asDict().items())
+        # from gff - remove gene_id and transcript_id from attributes
+        try:
+            del self._attributes["gene_id"]
+            del self._attributes["transcript_id"]
+        except KeyError:
+            pass
+
+        return self
+
+    def asDict(self):
+        '''return attributes as a dictionary.'''
+        return self._getAttributes()
+
+    def clearAttributes(self):
+        self.attributes = collections.OrderedDict()
+
+    def addAttribute(self, key, value=None):
+        self._getAttributes()[key] = value
+
+    def __setitem__(self, key, value):
+        self.addAttribute(key, value)
+
+    def __getitem__(self, key):
+        return self._getAttributes()[key]
+
+    def __contains__(self, key):
+        return key in self._getAttributes()
+
+    def __getattr__(self, key):
+        try:
+            return self._getAttributes()[key]
+        except KeyError:
+            raise AttributeError(
+                "'Entry' object has no attribute '%s'" % key)
+
+    def __setattr__(self, key, value):
+        try:
+            PyObject_GenericSetAttr(self, key, value)
+        except AttributeError:
+            self.addAttribute(key, value)
+
+    def __reduce__(self):
+        return (_rebuildEntry, (self.contig, self.source, self.feature,
+                                self.start, self.end, self.score,
+                                self.strand, self.frame,
+                                self.gene_id, self.transcript_id,
+                                self._getAttributes()))
+
+    def __lt__(self, other):
+        # note: does compare by strand as well!
+        return (self.contig, self.strand, self.start) < \
+            (other.contig, other.strand, other.start)
+
+    def hasOverlap(self, other, min_overlap=0):
+        """returns true, if overlap with other entry.
+        """
+        return (self.contig == other.contig and
+                self.strand == other.strand and
+                min(self.end, other.end) -
+                max(self.start, other.start) > min_overlap)
+
+    def isIdentical(self, other, max_slippage=0):
+        """returns true, if self and other overlap completely.
+        """
+        return (self.contig == other.contig and
+                self.strand == other.strand and
+                abs(self.end - other.end) < max_slippage and
+                abs(self.start - other.start < max_slippage))
+
+    def isHalfIdentical(self, other, max_slippage=0):
+        """returns true, if self and other overlap.
+        """
+        return (self.contig == other.contig and
+                self.strand == other.strand and
+                (abs(self.end - other.end) < max_slippage or
+                 abs(self.start - other.start < max_slippage)))
+
+
+def _rebuildEntry(contig, source, feature, start, end, score,
+                  strand, frame, gene_id, transcript_id, attributes):
+    cdef Entry e = Entry()
+    e.contig, e.source, e.feature = contig, source, feature
+    e.start, e.end, e.score = start, end, score
+    e.strand, e.frame = strand, frame
+    e.gene_id, e.transcript_id = gene_id, transcript_id
+    e._attributes = attributes
+    return e
+
+
+def iterator(infile):
+    """iterate over :term:`gtf` formatted entries in *infile*.
+
+    Comment lines, empty lines and track lines are skipped.
+    Yields objects of type :class:`Entry`.
+    """
+    cdef Entry gff
+    cdef str line
+
+    for line in infile:
+        if line[0] == "#" or line.startswith("track"):
+            continue
+        if len(line.strip()) == 0:
+            continue
+        gff = Entry()
+        gff.read(line)
+        yield gff
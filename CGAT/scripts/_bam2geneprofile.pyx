@@ -14,6 +14,22 @@ import numpy
 CountResult = collections.namedtuple(
     "Counts", "upstream upstream_utr cds downstream_utr downstream")
 
+
+# The BAM range counters collect coverage in a difference array:
+# each read adds +1 at its first and -1 after its last position.
+# The coverage is the cumulative sum of the difference array.
+cdef inline void addRange(long long [:] diff, int rstart, int rend):
+    '''add range [rstart, rend) to difference array *diff*.'''
+    if rstart < rend:
+        diff[rstart] += 1
+        diff[rend] -= 1
+
+
+cdef addCoverage(counts, long long [:] diff):
+    '''add coverage in difference array *diff* to *counts*.'''
+    counts += numpy.cumsum(numpy.asarray(diff)[:-1])
+
+
 class RangeCounter:
     
     def __init__(self, countfiles, 
@@ -24,6 +40,8 @@ class RangeCounter:
         self.countfiles = countfiles
         self.controlfiles = controlfiles
         self.control_factor = control_factor 
+        # indices to resample counts, see getSampleIndices()
+        self.sample_indices = {}
         if self.control_factor is None:
             if self.controlfiles is not None:
                 # count number of tags in each file for normalization purposes
@@ -52,6 +70,35 @@ class RangeCounter:
         raise NotImplementedError(
             'implementations of RangeCounter need to implement getTotal')
 
+    def getSampleIndices(self, lunnormed, length):
+        '''return indices to resample counts of length *lunnormed*
+        to *length*.
+
+        Indices are computed once for each combination of
+        lengths.
+        '''
+        key = (lunnormed, length)
+        if key in self.sample_indices:
+            return self.sample_indices[key]
+
+        lnormed = float(length)
+        lunnormed = float(lunnormed)
+        if lunnormed > lnormed:
+            # compress by taking only counts at certain points within intervals
+            take = numpy.unique( numpy.array( numpy.floor( 
+                        numpy.arange( 0, lunnormed - 1, lunnormed / lnormed ) ), dtype = int ) )
+        elif lunnormed == lnormed:
+            # same size, no scaling
+            take = numpy.arange( 0, lnormed, dtype = int )
+        else:
+            # expand by taking more counts
+            take = numpy.array( numpy.arange(0, lunnormed, lunnormed / lnormed ), dtype = int )[:length]
+
+        assert len(take) == length, "size of arrays unequal: %i != %i from %i" % (len(take), length, lunnormed)
+
+        self.sample_indices[key] = take
+        return take
+
     def getCounts(self, contig, ranges, length=0):
         '''count from a set of ranges.
 
@@ -66,23 +113,8 @@ class RangeCounter:
 
         # subsample for length
         if length > 0:
-            lnormed = float(length)
-            lunnormed = float(len(self.counts))
-            if lunnormed == 0: return numpy.zeros(0)
-            # E.debug( "normed length = %i, unnormed length =%i " % (lnormed, lunnormed) )
-            if lunnormed > lnormed:
-                # compress by taking only counts at certain points within intervals
-                take = numpy.unique( numpy.array( numpy.floor( 
-                            numpy.arange( 0, lunnormed - 1, lunnormed / lnormed ) ), dtype = int ) )
-            elif lunnormed == lnormed:
-                # same size, no scaling
-                take = numpy.arange( 0, lnormed, dtype = int )
-            else:
-                # expand by taking more counts
-                take = numpy.array( numpy.arange(0, lunnormed, lunnormed / lnormed ), dtype = int )[:length]
-                
-            assert len(take) == length, "size of arrays unequal: %i != %i from %i" % (len(take), length, lunnormed)
-
+            if len(self.counts) == 0: return numpy.zeros(0)
+            take = self.getSampleIndices(len(self.counts), length)
             self.counts = self.counts[take]
             if self.controlfiles:
                 self.counts_bg = self.counts_bg[take]
@@ -121,15 +153,12 @@ class RangeCounterBAM(RangeCounter):
         if len(ranges) == 0: return
 
         # collect pileup profile in region bounded by start and end.
-        cdef int i
-        cdef int xstart, xend, rstart, rend, start, end
-        cdef int interval_width
+        cdef int rstart, rend, start, end
         cdef int current_offset
         cdef AlignedSegment read
-        cdef int shift_extend
-        cdef int work_offset
-        cdef int pos
         cdef int length
+        cdef long long [:] diff = numpy.zeros(len(counts) + 1,
+                                              dtype=numpy.int64)
 
         cdef AlignmentFile samfile
 
@@ -145,15 +174,17 @@ class RangeCounterBAM(RangeCounter):
                     continue
 
                 for read in samfile.fetch(contig, start, end):
-                    rstart = max(start, read.pos) - start + current_offset
                     # skip unmapped reads that are assigend a position.
                     if read.aend is None:
                         continue
+                    rstart = max(start, read.pos) - start + current_offset
                     rend = min( end, read.aend) - start + current_offset
-                    for i from rstart <= i < rend: counts[i] += 1
+                    addRange(diff, rstart, rend)
 
                 current_offset += length
 
+        addCoverage(counts, diff)
+
     def getTotal(self, samfile):
         '''return total number of mapped tags in samfile.'''
         return samfile.mapped
@@ -200,15 +231,13 @@ class RangeCounterBAMShift(RangeCounterBAM):
         if len(ranges) == 0: return
 
         # collect pileup profile in region bounded by start and end.
-        cdef int i
         cdef int xstart, xend, rstart, rend, start, end
-        cdef int interval_width
         cdef int current_offset
         cdef AlignedSegment read
         cdef int shift_extend
-        cdef int work_offset
-        cdef int pos
         cdef int length
+        cdef long long [:] diff = numpy.zeros(len(counts) + 1,
+                                              dtype=numpy.int64)
 
         # shifting:
         # forward strand reads:
@@ -252,10 +281,12 @@ class RangeCounterBAMShift(RangeCounterBAM):
 
                     rend = min( length, rstart + extend ) + current_offset
                     rstart = max( 0, rstart ) + current_offset
-                    for i from rstart <= i < rend: counts[i] += 1
+                    addRange(diff, rstart, rend)
 
                 current_offset += length
 
+        addCoverage(counts, diff)
+
 class RangeCounterBAMMerge(RangeCounterBAM):
     '''count densities using bam files.
 
@@ -288,14 +319,12 @@ class RangeCounterBAMMerge(RangeCounterBAM):
             return
 
         # collect pileup profile in region bounded by start and end.
-        cdef int i
         cdef int xstart, xend, rstart, rend, start, end
-        cdef int interval_width
         cdef int current_offset
         cdef AlignedSegment read
-        cdef int work_offset
-        cdef int pos
         cdef int length
+        cdef long long [:] diff = numpy.zeros(len(counts) + 1,
+                                              dtype=numpy.int64)
 
         cdef AlignmentFile samfile
         cdef int min_insert_size = self.min_insert_size
@@ -341,11 +370,12 @@ class RangeCounterBAMMerge(RangeCounterBAM):
 
                     rstart += -start + current_offset
                     rend += -start + current_offset
-                    for i from rstart <= i < rend:
-                        counts[i] += 1
+                    addRange(diff, rstart, rend)
 
                 current_offset += length
 
+        addCoverage(counts, diff)
+
 class RangeCounterBAMBaseAccuracy(RangeCounterBAM):
     '''count densities using bam files with base accuracy.
     '''
@@ -362,15 +392,14 @@ class RangeCounterBAMBaseAccuracy(RangeCounterBAM):
             return
 
         # collect pileup profile in region bounded by start and end.
-        cdef int i
-        cdef int xstart, xend, rstart, rend, start, end
-        cdef int interval_width
+        cdef int rstart, rend, start, end
+        cdef int block_start, block_end
         cdef int current_offset
         cdef AlignedSegment read
-        cdef int work_offset
-        cdef int pos
         cdef int length
-        
+        cdef long long [:] diff = numpy.zeros(len(counts) + 1,
+                                              dtype=numpy.int64)
+
         cdef AlignmentFile samfile
 
         for samfile in files:
@@ -384,21 +413,17 @@ class RangeCounterBAMBaseAccuracy(RangeCounterBAM):
                     continue
 
                 for read in samfile.fetch(contig, start, end):
-                    # note: not optimized for speed yet - uses a python list
-                    positions = read.positions
-                    for i in positions:
-                        if i < start: continue
-                        if i >= end: continue
-                        try:
-                            counts[i - start + current_offset] += 1
-                        except IndexError:
-                            print len(counts)
-                            print "i=", i, "start=",start, "end=", end, "current_offset=", current_offset
-                            print "positions=", positions
-                            raise
+                    # count aligned blocks, skipping deletions
+                    # and introns
+                    for block_start, block_end in read.get_blocks():
+                        rstart = max(start, block_start) - start + current_offset
+                        rend = min(end, block_end) - start + current_offset
+                        addRange(diff, rstart, rend)
 
                 current_offset += length
 
+        addCoverage(counts, diff)
+
 class RangeCounterBed(RangeCounter):
 
     def __init__(self, *args, **kwargs):
@@ -680,17 +705,59 @@ class IntervalsCounter:
         for field, l in zip(self.fields, self.lengths):
             outfile.write("%s\t%s\n" % (field, str(Stats.Summary(l))))
 
+    def writeProfile(self, name, counts):
+        '''output *counts* of transcript *name* to the profiles file.'''
+        self.outfile_profiles.write("%s\t%s\n" % (name,
+                                    "\t".join( [ "\t".join( map(str, x) ) for x in counts ] ) ) )
+
     def update(self, gtf):
-        
+
         counted = self.count(gtf)
 
         if counted and self.outfile_profiles:
-            name = gtf[0].transcript_id
-            self.outfile_profiles.write("%s\t%s\n" % (name,
-                                        "\t".join( [ "\t".join( map(str, x) ) for x in self.last_counts ] ) ) )
-        
+            self.writeProfile(gtf[0].transcript_id, self.last_counts)
+
         return counted
 
+    def merge(self, other, profiles=None):
+        '''merge counts collected by *other* into this counter.
+
+        *other* is a counter of the same type and configuration that
+        has counted a different set of transcripts, for example in a
+        separate process. Counters need to be merged in the order of
+        the transcripts.
+
+        If *profiles* is given, it is a list of tuples (name, counts)
+        of the transcripts counted by *other*. These are aggregated
+        one by one so that the result is identical to counting all
+        transcripts with this counter, including floating point
+        round-off and the output of individual profiles. Otherwise,
+        the aggregate counts of *other* are added.
+        '''
+        assert self.fields == other.fields
+
+        for x, l in enumerate(other.lengths):
+            self.lengths[x].extend(l)
+
+        if profiles is None:
+            for x, agg in enumerate(other.aggregate_counts):
+                self.aggregate_counts[x] += agg
+                self.counts[x] += other.counts[x]
+            self.nskipped += other.nskipped
+        else:
+            for name, counts in profiles:
+                self.aggregate(*counts)
+                if self.outfile_profiles:
+                    self.writeProfile(name, counts)
+
+    def __getstate__(self):
+        # the range counter and the profiles file are open
+        # file handles and are not transferred between processes
+        state = self.__dict__.copy()
+        state["counter"] = None
+        state["outfile_profiles"] = None
+        return state
+
     def __str__(self):
         return "%s=%s" % (self.name, ",".join( [str(sum(x)) for x in self.aggregate_counts]) )
 
@@ -1731,9 +1798,14 @@ class TSSCounter( IntervalsCounter ):
         return 1
 
 def countFromGTF(counters,
-                 gtf_iterator):
+                 gtf_iterator,
+                 profiles=None):
     '''compute counts using counters for
     transcripts in gtf_iterator.
+
+    If *profiles* is given, it is a list with one list per
+    counter. The name and counts of each counted transcript are
+    appended to it (see :meth:`IntervalsCounter.merge`).
     '''
 
     c = E.Counter()
@@ -1748,8 +1820,10 @@ def countFromGTF(counters,
         gtf.sort( key = lambda x: x.start )
         c.input += 1
         for x, counter in enumerate(counters):
-            counter.update( gtf )
+            counted = counter.update( gtf )
             counts[x] += 1
+            if counted and profiles is not None:
+                profiles[x].append((name, counter.last_counts))
 
         if iteration % 100 == 0:
             E.debug( "iteration %i: counts=%s" % (iteration, ",".join( map( str, counters) ) ))
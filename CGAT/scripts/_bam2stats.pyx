@@ -3,11 +3,18 @@ from pysam.libchtslib cimport *
 from pysam.libcalignmentfile cimport *
 from pysam.libcfaidx cimport *
 from pysam.libcutils cimport force_str, force_bytes
-from libc.string cimport strchr
-from libc.stdint cimport int8_t
-from libc.stdio cimport puts, printf
+from libc.string cimport strchr, memcpy
+from libc.stdint cimport int8_t, uint8_t, int64_t, uint32_t, uint64_t
+from libc.stdlib cimport malloc, realloc, free
 import collections, array, struct, sys
+import multiprocessing
+import ctypes
+import numpy
 import CGATCore.Experiment as E
+import CGATCore.IOTools as IOTools
+import CGAT.GTF as GTF
+
+cimport numpy
 
 import hashlib
 import base64
@@ -38,47 +45,541 @@ cdef struct CountsType:
     int8_t is_qcfail
     int8_t is_duplicate
 
-def count(AlignmentFile samfile,
-          remove_rna,
-          rna,
-          filename_fastq=None,
-          outfile_details=None):
+
+cdef inline uint64_t hashReadName(const char * name):
+    '''return a 64-bit fingerprint of the read *name*.'''
+    # FNV-1a followed by the splitmix64 finalizer to
+    # spread the bits for the hash table lookup
+    cdef uint64_t h = 14695981039346656037ULL
+    while name[0] != 0:
+        h = (h ^ <uint8_t>name[0]) * 1099511628211ULL
+        name += 1
+    h = (h ^ (h >> 30)) * 0xbf58476d1ce4e5b9ULL
+    h = (h ^ (h >> 27)) * 0x94d049bb133111ebULL
+    return h ^ (h >> 31)
+
+
+cdef inline uint32_t checkReadName(const char * name):
+    '''return a 32-bit check value of the read *name*.
+
+    The check value uses Jenkins' one-at-a-time hash, which is
+    independent of the fingerprint computed by :func:`hashReadName`.
     '''
+    cdef uint32_t h = 0
+    while name[0] != 0:
+        h += <uint8_t>name[0]
+        h += h << 10
+        h ^= h >> 6
+        name += 1
+    h += h << 3
+    h ^= h >> 11
+    h += h << 15
+    return h
+
+
+cdef class ReadNameIndex:
+    '''map read names to consecutive indices.
+
+    Read names are stored as a 64-bit fingerprint and an independent
+    32-bit check value in an open addressing hash table with linear
+    probing. Two names are taken to be the same if both values
+    agree. Each name added receives the next index. If a name is
+    added again, it maps to the new index, as in a python dictionary.
+
+    Names are not kept, so two different names with the same 96-bit
+    hash would be counted as one read. For n reads, the probability
+    of this happening is about n * n / 2 ** 97, which is less than
+    1e-9 for 10 billion reads.
+
+    The index requires 12 bytes per read for the hash values and
+    8 bytes per slot in the hash table, which is kept at most 70% full.
+
+    The index can be moved into shared memory with :meth:`share`
+    so that other processes can use it without a copy.
     '''
-    cdef bint _remove_rna = remove_rna
+    # fingerprints and check values by index
+    cdef uint64_t * fingerprints
+    cdef uint32_t * checks
+    # index for each slot, -1 for empty slots
+    cdef int64_t * slots
+    cdef uint64_t mask
+    cdef int64_t nslots
+    cdef int64_t allocated
+    cdef readonly int64_t size
+    # shared memory holding the index, None if memory has
+    # been allocated by the index
+    cdef object buffers
 
-    cdef AlignedSegment read
+    def __cinit__(self):
+        self.fingerprints = NULL
+        self.checks = NULL
+        self.slots = NULL
+        self.buffers = None
+        self.size = 0
+        self.allocated = 0
+        self.resize(1024)
+
+    def __dealloc__(self):
+        self.release()
+
+    cdef release(self):
+        '''free memory allocated by the index.'''
+        if self.buffers is None:
+            free(self.fingerprints)
+            free(self.checks)
+            free(self.slots)
+        self.fingerprints = NULL
+        self.checks = NULL
+        self.slots = NULL
+
+    cdef attach(self, buffers, int64_t size, int64_t nslots):
+        '''use the index stored in shared memory *buffers*.'''
+        cdef uint64_t[::1] fingerprints = numpy.frombuffer(
+            buffers[0], dtype=numpy.uint64)
+        cdef uint32_t[::1] checks = numpy.frombuffer(
+            buffers[1], dtype=numpy.uint32)
+        cdef int64_t[::1] slots = numpy.frombuffer(
+            buffers[2], dtype=numpy.int64)
+        self.release()
+        self.buffers = buffers
+        self.fingerprints = &fingerprints[0]
+        self.checks = &checks[0]
+        self.slots = &slots[0]
+        self.size = size
+        self.allocated = size
+        self.nslots = nslots
+        self.mask = nslots - 1
+
+    def share(self):
+        '''move the index into shared memory and return its state.
+
+        The state can be passed to processes started with
+        :mod:`multiprocessing`, which attach to the index with
+        :func:`attachReadNameIndex`. The index can not be modified
+        once it is shared.
+        '''
+        cdef uint64_t[::1] fingerprints
+        cdef uint32_t[::1] checks
+        cdef int64_t[::1] slots
+        if self.buffers is None:
+            # arrays have at least one element, so that they
+            # can be accessed through a pointer
+            buffers = (
+                multiprocessing.RawArray(ctypes.c_uint64, max(1, self.size)),
+                multiprocessing.RawArray(ctypes.c_uint32, max(1, self.size)),
+                multiprocessing.RawArray(ctypes.c_int64, self.nslots))
+            fingerprints = numpy.frombuffer(buffers[0], dtype=numpy.uint64)
+            checks = numpy.frombuffer(buffers[1], dtype=numpy.uint32)
+            slots = numpy.frombuffer(buffers[2], dtype=numpy.int64)
+            if self.size > 0:
+                memcpy(&fingerprints[0], self.fingerprints,
+                       self.size * sizeof(uint64_t))
+                memcpy(&checks[0], self.checks,
+                       self.size * sizeof(uint32_t))
+            memcpy(&slots[0], self.slots, self.nslots * sizeof(int64_t))
+            self.attach(buffers, self.size, self.nslots)
+        return (self.buffers, self.size, self.nslots)
+
+    def __len__(self):
+        return self.size
+
+    cdef int resize(self, int64_t nslots) except -1:
+        '''resize hash table to *nslots* slots (a power of two) and
+        re-insert all reads.'''
+        cdef int64_t x
+        free(self.slots)
+        self.slots = <int64_t *>malloc(nslots * sizeof(int64_t))
+        if self.slots == NULL:
+            raise MemoryError(
+                "could not allocate memory for %i slots" % nslots)
+        for x from 0 <= x < nslots:
+            self.slots[x] = -1
+        self.nslots = nslots
+        self.mask = nslots - 1
+        for x from 0 <= x < self.size:
+            self.insert(x)
+        return 0
+
+    cdef void insert(self, int64_t index):
+        cdef uint64_t fingerprint = self.fingerprints[index]
+        cdef uint32_t check = self.checks[index]
+        cdef uint64_t slot = fingerprint & self.mask
+        cdef int64_t other = self.slots[slot]
+        while other >= 0:
+            if self.fingerprints[other] == fingerprint and \
+               self.checks[other] == check:
+                break
+            slot = (slot + 1) & self.mask
+            other = self.slots[slot]
+        self.slots[slot] = index
+
+    cdef int64_t addHashes(self,
+                           uint64_t fingerprint,
+                           uint32_t check) except -1:
+        '''add a read with *fingerprint* and *check* value and
+        return its index.'''
+        cdef uint64_t * fingerprints
+        cdef uint32_t * checks
+        if self.buffers is not None:
+            raise ValueError("a shared read name index can not be modified")
+        if self.size == self.allocated:
+            self.allocated = max(1024, self.allocated * 2)
+            fingerprints = <uint64_t *>realloc(
+                self.fingerprints, self.allocated * sizeof(uint64_t))
+            if fingerprints == NULL:
+                raise MemoryError(
+                    "could not allocate memory for %i read names" %
+                    self.allocated)
+            self.fingerprints = fingerprints
+            checks = <uint32_t *>realloc(
+                self.checks, self.allocated * sizeof(uint32_t))
+            if checks == NULL:
+                raise MemoryError(
+                    "could not allocate memory for %i read names" %
+                    self.allocated)
+            self.checks = checks
+
+        if (self.size + 1) * 10 > self.nslots * 7:
+            self.resize(self.nslots * 2)
+
+        self.fingerprints[self.size] = fingerprint
+        self.checks[self.size] = check
+        self.insert(self.size)
+        self.size += 1
+        return self.size - 1
+
+    cdef int64_t lookupHashes(self, uint64_t fingerprint, uint32_t check):
+        '''return index of the read with *fingerprint* and *check*
+        value or -1 if not present.'''
+        cdef uint64_t slot = fingerprint & self.mask
+        cdef int64_t index = self.slots[slot]
+        while index >= 0:
+            if self.fingerprints[index] == fingerprint and \
+               self.checks[index] == check:
+                return index
+            slot = (slot + 1) & self.mask
+            index = self.slots[slot]
+        return -1
+
+    cdef int64_t add(self, const char * name) except -1:
+        '''add read *name* and return its index.'''
+        return self.addHashes(hashReadName(name), checkReadName(name))
+
+    cdef int64_t lookup(self, const char * name):
+        '''return index of read *name* or -1 if not present.'''
+        return self.lookupHashes(hashReadName(name), checkReadName(name))
+
+    cdef bint isCurrent(self, int64_t index):
+        '''return True if *index* has not been replaced by
+        adding the same name again.'''
+        return self.lookupHashes(self.fingerprints[index],
+                                 self.checks[index]) == index
+
+    def addName(self, name):
+        '''add read *name* and return its index.'''
+        name = force_bytes(name)
+        return self.add(name)
+
+    def getIndex(self, name):
+        '''return the index of read *name* or -1 if not present.'''
+        name = force_bytes(name)
+        return self.lookup(name)
+
+    def __reduce__(self):
+        cdef int64_t x
+        fingerprints = numpy.empty(self.size, dtype=numpy.uint64)
+        checks = numpy.empty(self.size, dtype=numpy.uint32)
+        cdef uint64_t[:] fingerprints_view = fingerprints
+        cdef uint32_t[:] checks_view = checks
+        for x from 0 <= x < self.size:
+            fingerprints_view[x] = self.fingerprints[x]
+            checks_view[x] = self.checks[x]
+        return (_buildReadNameIndex, (fingerprints, checks))
+
+
+def _buildReadNameIndex(fingerprints, checks):
+    '''rebuild a read name index, used for unpickling.
+
+    Reads are added in the original order, so that
+    all reads keep their index.
+    '''
+    cdef ReadNameIndex index = ReadNameIndex()
+    cdef uint64_t[:] fingerprints_view = fingerprints
+    cdef uint32_t[:] checks_view = checks
+    cdef int64_t x
+    for x from 0 <= x < fingerprints_view.shape[0]:
+        index.addHashes(fingerprints_view[x], checks_view[x])
+    return index
+
+
+def attachReadNameIndex(state):
+    '''return a read name index using the shared memory
+    in *state* (see :meth:`ReadNameIndex.share`).'''
+    cdef ReadNameIndex index = ReadNameIndex()
+    buffers, size, nslots = state
+    index.attach(buffers, size, nslots)
+    return index
+
+
+cdef class Histogram:
+    '''histogram of integer values.
 
-    # counters
-    cdef int ninput = 0
-    cdef int nduplicates = 0
+    Values from 0 up to *size* are counted in a numpy array, all
+    other values in a dictionary. Histograms collected from different
+    parts of a file can be combined with :meth:`merge`.
+    '''
+    cdef readonly numpy.ndarray counts
+    cdef readonly object overflow
+    cdef int64_t[:] counts_view
+    cdef int size
+
+    def __init__(self, size=256):
+        self.size = size
+        self.counts = numpy.zeros(size, dtype=numpy.int64)
+        self.counts_view = self.counts
+        self.overflow = collections.defaultdict(int)
+
+    cdef int add(self, int32_t value) except -1:
+        if 0 <= value < self.size:
+            self.counts_view[value] += 1
+        else:
+            self.overflow[value] += 1
+        return 0
+
+    def merge(self, Histogram other):
+        '''add counts in *other* to this histogram.'''
+        if self.size != other.size:
+            raise ValueError("can not merge histograms of different size")
+        self.counts += other.counts
+        for key, value in other.overflow.items():
+            self.overflow[key] += value
+
+    def asDict(self):
+        '''return histogram as a dictionary of observed values.'''
+        result = collections.defaultdict(int)
+        for key in numpy.flatnonzero(self.counts):
+            result[int(key)] = int(self.counts[key])
+        for key, value in self.overflow.items():
+            result[key] += value
+        return result
+
+    def __reduce__(self):
+        return (_buildHistogram, (self.counts, dict(self.overflow)))
+
+
+def _buildHistogram(counts, overflow):
+    '''rebuild a histogram, used for unpickling.'''
+    cdef Histogram histogram = Histogram(len(counts))
+    histogram.counts[:] = counts
+    histogram.overflow.update(overflow)
+    return histogram
+
+
+cdef class AlignmentCounts:
+    '''counts collected from the alignments in a BAM file.
+
+    Counts collected from different parts of a BAM file can
+    be combined with :meth:`merge`.
+
+    Per read counts are kept for all *fastq_nreads* reads. If
+    *sparse* is set, they are kept only for reads that have
+    alignments, which is used for counting parts of a file.
+    '''
+    cdef public int64_t ninput
+    cdef public int64_t nduplicates
     # number of reads overlapping RNA (if rna != None)
-    cdef int nrna = 0
+    cdef public int64_t nrna
     # number of reads not overlap RNA (if rna != None)
-    cdef int n_norna = 0
+    cdef public int64_t n_norna
     # number of reads present after filtering
-    cdef int nfiltered = 0
+    cdef public int64_t nfiltered
+    cdef public int64_t fastq_notfound
+    cdef public int32_t max_hi
+    cdef public numpy.ndarray flags_counts
+    cdef public Histogram nh_filtered
+    cdef public Histogram nh_all
+    cdef public Histogram nm_filtered
+    cdef public Histogram nm_all
+    cdef public Histogram mapq_filtered
+    cdef public Histogram mapq_all
+    # per read counts, one CountsType record per row
+    cdef public numpy.ndarray fastq_counts
+    # in sparse mode, the read index of each row in fastq_counts
+    cdef public numpy.ndarray fastq_indices
+    cdef public bint sparse
+    # number of rows in use in sparse mode
+    cdef public int64_t nrows
+    cdef CountsType * rows
+    cdef int64_t * indices
+
+    def __init__(self, fastq_nreads=0, sparse=False):
+        self.ninput = 0
+        self.nduplicates = 0
+        self.nrna = 0
+        self.n_norna = 0
+        self.nfiltered = 0
+        self.fastq_notfound = 0
+        self.max_hi = 0
+        self.flags_counts = numpy.zeros(len(FLAGS), dtype=numpy.int64)
+        self.nh_filtered = Histogram()
+        self.nh_all = Histogram()
+        self.nm_filtered = Histogram()
+        self.nm_all = Histogram()
+        self.mapq_filtered = Histogram()
+        self.mapq_all = Histogram()
+        self.sparse = sparse
+        self.nrows = 0
+        if sparse:
+            self.setRows(
+                numpy.zeros((1024, sizeof(CountsType)), dtype=numpy.uint8),
+                numpy.zeros(1024, dtype=numpy.int64))
+        else:
+            self.setRows(
+                numpy.zeros((fastq_nreads, sizeof(CountsType)),
+                            dtype=numpy.uint8),
+                None)
+
+    cdef setRows(self, numpy.ndarray fastq_counts,
+                 numpy.ndarray fastq_indices):
+        '''set per read counts and update pointers to them.'''
+        cdef uint8_t[:, ::1] counts_view = fastq_counts
+        cdef int64_t[::1] indices_view
+        self.fastq_counts = fastq_counts
+        self.fastq_indices = fastq_indices
+        self.rows = NULL
+        self.indices = NULL
+        if counts_view.shape[0] > 0:
+            self.rows = <CountsType *>&counts_view[0, 0]
+        if fastq_indices is not None and fastq_indices.shape[0] > 0:
+            indices_view = fastq_indices
+            self.indices = &indices_view[0]
+
+    cdef CountsType * getReadCounts(self, int64_t index) except NULL:
+        '''return the counts of the read with *index*.
+
+        In sparse mode, each call adds a new row for the read.
+        Rows of the same read are combined by :meth:`compact`.
+        '''
+        cdef int64_t nallocated
+        if not self.sparse:
+            return &self.rows[index]
+        nallocated = self.fastq_counts.shape[0]
+        if self.nrows == nallocated:
+            nallocated = max(1024, nallocated)
+            self.setRows(
+                numpy.concatenate(
+                    (self.fastq_counts,
+                     numpy.zeros((nallocated, sizeof(CountsType)),
+                                 dtype=numpy.uint8))),
+                numpy.concatenate(
+                    (self.fastq_indices,
+                     numpy.zeros(nallocated, dtype=numpy.int64))))
+        self.indices[self.nrows] = index
+        self.nrows += 1
+        return &self.rows[self.nrows - 1]
+
+    def compact(self):
+        '''combine the rows of each read in sparse mode.'''
+        if not self.sparse:
+            return
+        indices, inverse = numpy.unique(self.fastq_indices[:self.nrows],
+                                        return_inverse=True)
+        fastq_counts = numpy.zeros((len(indices), sizeof(CountsType)),
+                                   dtype=numpy.uint8)
+        numpy.add.at(fastq_counts, inverse, self.fastq_counts[:self.nrows])
+        self.nrows = len(indices)
+        self.setRows(fastq_counts, indices.astype(numpy.int64))
+
+    def merge(self, AlignmentCounts other):
+        '''add counts in *other* to these counts.'''
+        self.ninput += other.ninput
+        self.nduplicates += other.nduplicates
+        self.nrna += other.nrna
+        self.n_norna += other.n_norna
+        self.nfiltered += other.nfiltered
+        self.fastq_notfound += other.fastq_notfound
+        self.max_hi = max(self.max_hi, other.max_hi)
+        self.flags_counts += other.flags_counts
+        self.nh_filtered.merge(other.nh_filtered)
+        self.nh_all.merge(other.nh_all)
+        self.nm_filtered.merge(other.nm_filtered)
+        self.nm_all.merge(other.nm_all)
+        self.mapq_filtered.merge(other.mapq_filtered)
+        self.mapq_all.merge(other.mapq_all)
+        # all fields in CountsType are 8 bit integers, so
+        # counts can be added byte by byte.
+        if self.sparse:
+            raise ValueError("can not merge into sparse counts")
+        if other.sparse:
+            other.compact()
+            self.fastq_counts[other.fastq_indices[:other.nrows]] += \
+                other.fastq_counts[:other.nrows]
+        else:
+            self.fastq_counts += other.fastq_counts
+
+    cdef CountsType * getFastqCounts(self):
+        return self.rows
+
+    def __reduce__(self):
+        self.compact()
+        return (_buildAlignmentCounts, (
+            self.sparse,
+            self.fastq_counts[:self.nrows] if self.sparse
+            else self.fastq_counts,
+            self.fastq_indices[:self.nrows] if self.sparse else None,
+            dict((key, getattr(self, key)) for key in (
+                "ninput", "nduplicates", "nrna", "n_norna", "nfiltered",
+                "fastq_notfound", "max_hi", "flags_counts",
+                "nh_filtered", "nh_all", "nm_filtered", "nm_all",
+                "mapq_filtered", "mapq_all"))))
 
-    cdef int max_hi = 0
-    # count nh, nm tags
-    nh_filtered = collections.defaultdict(int)
-    nm_filtered = collections.defaultdict(int)
-    nh_all = collections.defaultdict(int)
-    nm_all = collections.defaultdict(int)
-    mapq_filtered = collections.defaultdict(int)
-    mapq_all = collections.defaultdict(int)
 
-    cdef int * flags_counts = <int*>calloc(len(FLAGS), sizeof(int))
+def _buildAlignmentCounts(sparse, fastq_counts, fastq_indices, state):
+    '''rebuild alignment counts, used for unpickling.'''
+    cdef AlignmentCounts counts = AlignmentCounts(sparse=sparse)
+    for key, value in state.items():
+        setattr(counts, key, value)
+    if sparse:
+        counts.nrows = len(fastq_indices)
+    counts.setRows(numpy.ascontiguousarray(fastq_counts),
+                   numpy.ascontiguousarray(fastq_indices)
+                   if sparse else None)
+    return counts
+
+
+cdef countAlignments(AlignmentFile samfile,
+                     alignments,
+                     AlignmentCounts counts,
+                     rna,
+                     bint remove_rna,
+                     ReadNameIndex reads,
+                     int64_t start=-1):
+    '''add counts for *alignments* from *samfile* to *counts*.
+
+    Alignments starting before *start* are skipped.
+    '''
+    cdef AlignedSegment read
 
     # helper variables
     cdef int last_tid = -1
     cdef int last_pos = 0
 
-    duplicates = collections.defaultdict(int)
-    counts = collections.defaultdict(int)
-    cdef int count = 0
+    cdef int64_t[:] flags_counts = counts.flags_counts
+    cdef int64_t ninput = 0
+    cdef int64_t nduplicates = 0
+    cdef int64_t nrna = 0
+    cdef int64_t n_norna = 0
+    cdef int64_t nfiltered = 0
+    cdef int64_t fastq_notfound = 0
+    cdef int32_t max_hi = counts.max_hi
+
+    cdef Histogram nh_filtered = counts.nh_filtered
+    cdef Histogram nh_all = counts.nh_all
+    cdef Histogram nm_filtered = counts.nm_filtered
+    cdef Histogram nm_all = counts.nm_all
+    cdef Histogram mapq_filtered = counts.mapq_filtered
+    cdef Histogram mapq_all = counts.mapq_all
 
-    cdef int tid = -1
     cdef int flag
 
     cdef uint8_t * v
@@ -90,58 +591,18 @@ def count(AlignmentFile samfile,
     cdef int f
 
     # detailed counting
-    cdef FastxRecord fq
-    cdef int64_t index, fastq_nreads
-    cdef CountsType * fastq_counts
+    cdef int64_t index
     cdef CountsType * fastq_count
     cdef char * read_name
     cdef char * position
-    cdef int count_fastq = filename_fastq != None
-    cdef int fastq_notfound = 0
-    cdef int chop = 0
-    
-    cdef bint is_py3 = sys.version_info.major >= 3
-
-    if count_fastq:
-        E.info("reading fastq file")
-        # Using a python dictionary here is due
-        # for a large amount of memory usage.
-        # Alternatives to dictionary
-        # 1. POSIX hash tables (hsearch,...) or trees: very slow
-        # 2. custom hash implementation: worth the effort?
-        # 3. Sorted list and binary search: too slow for many lookups
-        reads = {}
-        fastqfile = FastxFile(filename_fastq)
-        fastq_nreads = 0
-        for fq in fastqfile:
-            if fastq_nreads == 0:
-                # chop off /1 or /2 as mappers usually remove these
-                # suffices. Test only the first.
-                name = fq.name
-                if name.endswith("/1") or name.endswith("/2"):
-                    chop = -2
-                
-            if chop != 0:
-                s = fq.name[:chop]
-            else:
-                s = fq.name
-
-            name = hashlib.md5(force_bytes(s)).digest()
+    cdef bint count_fastq = reads is not None
 
-            reads[name] = fastq_nreads
+    for read in alignments:
 
-            fastq_nreads += 1
-        
-        E.info("read names of %i reads or read pairs" % fastq_nreads)
-
-        E.info("allocating %i bytes" % (fastq_nreads * sizeof(CountsType)))
-
-        fastq_counts = <CountsType *>calloc(fastq_nreads, sizeof(CountsType))
-        if fastq_counts == NULL:
-            raise ValueError("could not allocate memory for %i bytes" %
-                             (fastq_nreads * sizeof(CountsType)))
- 
-    for read in samfile:
+        # reads overlapping the start of a region are
+        # counted in the previous region
+        if read._delegate.core.pos < start:
+            continue
 
         if count_fastq:
             read_name = pysam_bam_get_qname(read._delegate)
@@ -155,12 +616,11 @@ def count(AlignmentFile samfile,
             if position != NULL: 
                 position[0] = '\0'
 
-            md5 = hashlib.md5(read_name).digest()
-            try:
-                fastq_count = &fastq_counts[reads[md5]]
-            except KeyError:
+            index = reads.lookup(read_name)
+            if index < 0:
                 fastq_notfound += 1
                 continue
+            fastq_count = counts.getReadCounts(index)
 
             # book-keeping counts
             if read.is_qcfail: fastq_count.is_qcfail += 1
@@ -204,18 +664,18 @@ def count(AlignmentFile samfile,
         v = bam_aux_get(read._delegate, 'NH')
         if v != NULL:
             nh = <int32_t>bam_aux2i(v)
-            nh_all[nh] += 1
+            nh_all.add(nh)
         else:
             nh = -1
 
         v = bam_aux_get(read._delegate, 'NM')
         if v != NULL:
             nm = <int32_t>bam_aux2i(v)
-            nm_all[nm] += 1
+            nm_all.add(nm)
         else:
             nm = -1
 
-        mapq_all[read.mapq] += 1
+        mapq_all.add(read._delegate.core.qual)
 
         # skip unmapped reads
         if read._delegate.core.flag & 4: continue
@@ -228,48 +688,208 @@ def count(AlignmentFile samfile,
         if rna:
             if rna.contains(contig, read.pos, read.pos + read.alen):
                 nrna += 1
-                if _remove_rna:
+                if remove_rna:
                     continue
             else:
                 n_norna += 1
 
         nfiltered += 1
 
-        if nh >= 0: nh_filtered[nh] += 1
-        if nm >= 0: nm_filtered[nm] += 1
-        mapq_filtered[read.mapq] += 1
+        if nh >= 0: nh_filtered.add(nh)
+        if nm >= 0: nm_filtered.add(nm)
+        mapq_filtered.add(read._delegate.core.qual)
 
         # duplicate analysis - simply count per start position
         # ignoring sequence and strand
         if read.tid == last_tid and read.pos == last_pos:
-            count += 1
             nduplicates += 1
             continue
 
-        if count > 1:
-            counts[count] += 1
-
-        count = 1
         last_tid, last_pos = read.tid, read.pos
 
+    counts.ninput += ninput
+    counts.nduplicates += nduplicates
+    counts.nrna += nrna
+    counts.n_norna += n_norna
+    counts.nfiltered += nfiltered
+    counts.fastq_notfound += fastq_notfound
+    counts.max_hi = max_hi
+
+
+def getShards(AlignmentFile samfile, shard_size):
+    '''split an indexed BAM file into shards that can be
+    counted independently.
+
+    Returns a list of (contig, start, end) tuples. Contigs are split
+    into pieces of *shard_size* bases, the last piece extending to the
+    end of the contig. The final shard with contig ``*`` contains
+    the unplaced unmapped reads.
+    '''
+    shards = []
+    for contig, length in zip(samfile.references, samfile.lengths):
+        for start in range(0, length, shard_size):
+            end = start + shard_size
+            if end >= length:
+                end = None
+            shards.append((contig, start, end))
+    shards.append(("*", None, None))
+    return shards
+
+
+# data shared with the processes counting shards
+SHARED = {}
+
+
+def initShards(filename, filename_rna, remove_rna, reads_state):
+    '''set up data for counting shards in a process.
+
+    The read name index is used from shared memory (see
+    :meth:`ReadNameIndex.share`). The RNA index is built again
+    from *filename_rna*, as it can not be passed between processes.
+    '''
+    if filename_rna:
+        rna = GTF.readAndIndex(
+            GTF.iterator(IOTools.open_file(filename_rna)))
+    else:
+        rna = None
+    if reads_state is not None:
+        reads = attachReadNameIndex(reads_state)
+    else:
+        reads = None
+    SHARED.update({"samfile": AlignmentFile(filename, "rb"),
+                   "rna": rna,
+                   "remove_rna": remove_rna,
+                   "reads": reads})
+
+
+def countShard(shard):
+    '''count alignments in *shard*.
+
+    Returns an :class:`AlignmentCounts` object with sparse
+    per read counts.
+    '''
+    cdef AlignmentFile samfile = SHARED["samfile"]
+    contig, start, end = shard
+    counts = AlignmentCounts(sparse=True)
+    if contig == "*":
+        alignments = samfile.fetch(contig)
+        start = -1
+    else:
+        alignments = samfile.fetch(contig, start, end)
+    countAlignments(samfile,
+                    alignments,
+                    counts,
+                    SHARED["rna"],
+                    SHARED["remove_rna"],
+                    SHARED["reads"],
+                    start)
+    counts.compact()
+    return counts
+
+
+def count(AlignmentFile samfile,
+          remove_rna,
+          rna,
+          filename_fastq=None,
+          outfile_details=None,
+          threads=1,
+          shard_size=10000000,
+          filename_rna=None):
+    '''count alignments in *samfile*.
+
+    If *threads* is larger than 1 and *samfile* is an indexed file,
+    the file is split into shards (see :func:`getShards`) which are
+    counted in parallel. The processes share the read name index and
+    return per read counts only for the reads in each shard. If *rna*
+    is given, the processes build their own index from *filename_rna*.
+    '''
+    cdef int lflags = len(FLAGS)
+    cdef int x, f
+
+    # detailed counting
+    cdef FastxRecord fq
+    cdef int64_t index, fastq_nreads = 0
+    cdef ReadNameIndex reads = None
+    cdef CountsType * fastq_counts
+    cdef CountsType * fastq_count
+    cdef int count_fastq = filename_fastq != None
+    cdef int chop = 0
+    
+    if count_fastq:
+        E.info("reading fastq file")
+        # read names are stored as 64-bit fingerprints in a
+        # compact hash table instead of a python dictionary
+        # of md5 digests, which requires a large amount of memory.
+        reads = ReadNameIndex()
+        fastqfile = FastxFile(filename_fastq)
+        fastq_nreads = 0
+        for fq in fastqfile:
+            if fastq_nreads == 0:
+                # chop off /1 or /2 as mappers usually remove these
+                # suffices. Test only the first.
+                name = fq.name
+                if name.endswith("/1") or name.endswith("/2"):
+                    chop = -2
+                
+            if chop != 0:
+                s = force_bytes(fq.name[:chop])
+            else:
+                s = force_bytes(fq.name)
+
+            reads.add(s)
+
+            fastq_nreads += 1
+        
+        E.info("read names of %i reads or read pairs" % fastq_nreads)
+
+        E.info("allocating %i bytes" % (fastq_nreads * sizeof(CountsType)))
+
+    counts = AlignmentCounts(fastq_nreads)
+
+    if threads > 1 and rna is not None and not filename_rna:
+        E.warn("parallel counting requires the file name of the "
+               "RNA annotations - counting in a single thread")
+        threads = 1
+
+    if threads > 1 and samfile.has_index():
+        shards = getShards(samfile, shard_size)
+        E.info("counting %i shards with %i threads" % (len(shards), threads))
+        pool = multiprocessing.Pool(
+            threads,
+            initializer=initShards,
+            initargs=(force_str(samfile.filename), filename_rna,
+                      remove_rna,
+                      reads.share() if reads is not None else None))
+        for other in pool.imap_unordered(countShard, shards):
+            counts.merge(other)
+        pool.close()
+        pool.join()
+    else:
+        if threads > 1:
+            E.warn("parallel counting requires an indexed BAM file - "
+                   "counting in a single thread")
+        countAlignments(samfile, samfile, counts, rna, remove_rna, reads)
+
     E.info( "finished computing counts" )
 
-    if fastq_notfound:
-        E.warn( "could not match %i records in bam-file to fastq file" % fastq_notfound)
+    if counts.fastq_notfound:
+        E.warn( "could not match %i records in bam-file to fastq file" % counts.fastq_notfound)
+
+    fastq_counts = counts.getFastqCounts()
 
     counter = E.Counter()
 
-    counter.alignments_input = ninput
-    counter.alignments_filtered = nfiltered
-    counter.alignments_rna = nrna
-    counter.alignments_no_rna = n_norna
-    counter.alignments_duplicates = nduplicates
+    counter.alignments_input = counts.ninput
+    counter.alignments_filtered = counts.nfiltered
+    counter.alignments_rna = counts.nrna
+    counter.alignments_no_rna = counts.n_norna
+    counter.alignments_duplicates = counts.nduplicates
 
     # convert flags to labels
     t = {}
     f = 1
     for x from 0 <= x < lflags:
-        t[FLAGS[f]] = flags_counts[x]
+        t[FLAGS[f]] = int(counts.flags_counts[x])
         f = f << 1
 
     # count based on fastq data
@@ -306,7 +926,11 @@ def count(AlignmentFile samfile,
     if count_fastq:
 
         E.info("fastq counting: aggregating counts")
-        for qname, index in reads.items():
+        for index from 0 <= index < fastq_nreads:
+            # skip reads whose name appears again later
+            if not reads.isCurrent(index):
+                continue
+
             fastq_count = &fastq_counts[index]
 
             # paired read data
@@ -443,50 +1067,35 @@ def count(AlignmentFile samfile,
         counter.total_read2_is_missing = total_read2_is_missing
 
         if outfile_details:
-            if outfile_details != sys.stdout:
-                # later: get access FILE * object
-                outfile_details.write(
-                    "read_md5\tis_unmapped\tmate_is_unmapped\tis_paired\tmapped_is_read1\tmapped_is_read2\tis_proper_pair\tis_qcfail\tis_duplicate\n")
-                for qname, index in reads.items():
-                    fastq_count = &fastq_counts[index]
-                    
-                    # remove "\n" from base64 encoded md5
-                    outfile_details.write("%s\t%s\n" % (
-                        force_str(base64.encodestring(qname)[:-1]),
-                        "\t".join( \
-                                   map(str,
-                                       (fastq_count.is_unmapped,
-                                        fastq_count.mate_is_unmapped,
-                                        fastq_count.is_paired,
-                                        fastq_count.mapped_is_read1,
-                                        fastq_count.mapped_is_read2,
-                                        fastq_count.is_proper_pair,
-                                        fastq_count.is_qcfail,
-                                        fastq_count.is_duplicate
-                                    ) )) ))
+            # read names are not kept in memory, so
+            # read them again from the fastq file
+            outfile_details.write(
+                "read_md5\tis_unmapped\tmate_is_unmapped\tis_paired\tmapped_is_read1\tmapped_is_read2\tis_proper_pair\tis_qcfail\tis_duplicate\n")
+            index = 0
+            for fq in FastxFile(filename_fastq):
+                if chop != 0:
+                    s = force_bytes(fq.name[:chop])
+                else:
+                    s = force_bytes(fq.name)
 
-            else:
-                # output to stdout much quicker
-                # use puts to avoid the following error:
-                # format not a string literal and no format arguments
-                puts("read\tis_unmapped\tmate_is_unmapped\tis_paired\tmapped_is_read1\tmapped_is_read2\tis_proper_pair\tis_qcfail\tis_duplicate\n")
-                for qname, index in reads.items():
+                if reads.lookup(s) == index:
                     fastq_count = &fastq_counts[index]
-                    read_name = qname
-                    printf("%s\t%i\t%i\t%i\t%i\t%i\t%i\t%i\t%i\n",
-                           read_name,
-                           fastq_count.is_unmapped,
-                           fastq_count.mate_is_unmapped,
-                           fastq_count.is_paired,
-                           fastq_count.mapped_is_read1,
-                           fastq_count.mapped_is_read2,
-                           fastq_count.is_proper_pair,
-                           fastq_count.is_qcfail,
-                           fastq_count.is_duplicate)
-
+                    outfile_details.write("%s\t%s\n" % (
+                        force_str(base64.b64encode(hashlib.md5(s).digest())),
+                        "\t".join(
+                            map(str,
+                                (fastq_count.is_unmapped,
+                                 fastq_count.mate_is_unmapped,
+                                 fastq_count.is_paired,
+                                 fastq_count.mapped_is_read1,
+                                 fastq_count.mapped_is_read2,
+                                 fastq_count.is_proper_pair,
+                                 fastq_count.is_qcfail,
+                                 fastq_count.is_duplicate)))))
+                index += 1
 
     return (counter, t, 
-            nh_filtered, nh_all, 
-            nm_filtered, nm_all, 
-            mapq_filtered, mapq_all, 
-            max_hi )
+            counts.nh_filtered.asDict(), counts.nh_all.asDict(), 
+            counts.nm_filtered.asDict(), counts.nm_all.asDict(), 
+            counts.mapq_filtered.asDict(), counts.mapq_all.asDict(), 
+            counts.max_hi)
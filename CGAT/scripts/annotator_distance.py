@@ -23,6 +23,12 @@ observed counts.
 
 The script implements various sampling and counting methods.
 
+The samples for a workspace are generated in chunks of array
+operations. Sampling can be distributed over several processes
+with ``--num-threads``. Each workspace uses its own random number
+stream derived from ``--random-seed``, so that results do not depend
+on the number of processes.
+
 Usage
 -----
 
@@ -40,6 +46,7 @@ Command line options
 import os
 import sys
 import collections
+import multiprocessing
 import itertools
 import CGAT.GTF as GTF
 import CGAT.Bed as Bed
@@ -56,9 +63,20 @@ import scipy.stats
 
 import matplotlib.pyplot as plt
 
-normalize_transform = lambda x, y: numpy.array(x, float) / (sum(x) + y)
-cumulative_transform = lambda x, y: numpy.cumsum(
-    numpy.array(x, float) / (sum(x) + y))
+
+def normalize_transform(x, y):
+    """normalize counts *x* by their total plus out-of-bounds counts *y*.
+
+    If *x* is a matrix with one sample per row, *y* is an array with
+    the out-of-bounds counts for each sample.
+    """
+    x = numpy.array(x, float)
+    return x / (x.sum(axis=-1) + y)[..., numpy.newaxis]
+
+
+def cumulative_transform(x, y):
+    """cumulative normalized counts, see :func:`normalize_transform`."""
+    return numpy.cumsum(normalize_transform(x, y), axis=-1)
 
 
 def readWorkspace(infile,
@@ -275,6 +293,17 @@ class Sampler(object):
     def sample(self):
         raise NotImplementedError("define sample() in base classes")
 
+    def sampleBatch(self, num_samples, rng):
+        """return *num_samples* simulated arrangements of the segments.
+
+        Random numbers are taken from the numpy RandomState *rng*.
+
+        Returns two arrays with the start and end coordinates of
+        the simulated segments with one sample per row. Segments
+        within a row are sorted by position.
+        """
+        raise NotImplementedError("define sampleBatch() in base classes")
+
 
 class SamplerPermutation(Sampler):
 
@@ -312,6 +341,23 @@ class SamplerPermutation(Sampler):
 
         return simulated
 
+    def sampleBatch(self, num_samples, rng):
+        """return simulated fragments for *num_samples* samples."""
+        nsegments = len(self.mLengths)
+        # 1. permutate order of segments
+        order = numpy.argsort(
+            rng.random_sample((num_samples, nsegments)), axis=1)
+        lengths = numpy.array(self.mLengths, dtype=numpy.int64)[order]
+        # 2. determine size of space between samples
+        points = numpy.sort(
+            rng.randint(0, self.mFreeLength + 1,
+                        size=(num_samples, nsegments + 1)), axis=1)
+        # 3. move segments to appropriate place
+        starts = self.mWorkStart + points[:, :-1] + \
+            numpy.cumsum(lengths, axis=1) - lengths
+
+        return starts, starts + lengths
+
 
 class SamplerBlocks(Sampler):
     """move blocks of fragments to take into account clustering."""
@@ -347,6 +393,23 @@ class SamplerGaps(Sampler):
 
         return simulated
 
+    def sampleBatch(self, num_samples, rng):
+        """return simulated fragments for *num_samples* samples."""
+        nsegments = len(self.mLengths)
+        # adjacent segments have no gap between them
+        gaps = numpy.zeros(max(nsegments + 1, len(self.mGapLengths)),
+                           dtype=numpy.int64)
+        gaps[:len(self.mGapLengths)] = self.mGapLengths
+        order = numpy.argsort(
+            rng.random_sample((num_samples, len(gaps))), axis=1)
+        gaps = gaps[order][:, :nsegments]
+
+        lengths = numpy.array(self.mLengths, dtype=numpy.int64)
+        starts = self.mWorkStart + numpy.cumsum(gaps, axis=1) + \
+            numpy.cumsum(lengths) - lengths
+
+        return starts, starts + lengths
+
 
 class CountingResults(object):
 
@@ -385,7 +448,7 @@ class CountingResults(object):
 
         for label in self.mLabels:
             pvalue = self.mStats[label].pvalue
-            a = scipy.stats.percentileofscore(sim_palues, pvalue) / 100.0
+            a = scipy.stats.percentileofscore(sim_pvalues, pvalue) / 100.0
             b = scipy.stats.percentileofscore(
                 obs_pvalues, pvalue) / 100.0 * len(obs_pvalues)
             if b >= 0:
@@ -426,24 +489,22 @@ class CountingResults(object):
         return self.mLabels
 
     def getMedians(self, label):
-        """compute medians of all samples."""
-        if label not in self.mMedians:
-
-            num_samples = len(self.mSimulatedCounts)
+        """compute medians of all samples.
 
-            medians = []
+        The median of a sample is the first bin at which the
+        cumulative counts exceed half of the total counts.
+        """
+        if label not in self.mMedians:
 
-            for x in range(num_samples):
-                data = self.mSimulatedCounts[x][label]
-                threshold = self.mSimulatedCounts[x].mTotals[label] / 2
-                t = 0
-                for d in range(len(data)):
-                    if t > threshold:
-                        break
-                    t += data[d]
-                medians.append(d)
+            data = numpy.cumsum(self.mSimulatedCounts[label],
+                                axis=1, dtype=numpy.int64)
+            threshold = self.mSimulatedCounts.mTotals[label] / 2
+            exceeded = data[:, :-1] > threshold[:, numpy.newaxis]
 
-            self.mMedians[label] = medians
+            self.mMedians[label] = numpy.where(
+                exceeded.any(axis=1),
+                exceeded.argmax(axis=1) + 1,
+                data.shape[1] - 1)
 
         return self.mMedians[label]
 
@@ -463,27 +524,13 @@ class CountingResults(object):
 
         E.debug("computing new envelope for transform %s" % str(transform))
 
-        num_samples = len(self.mSimulatedCounts)
-
-        mmin = numpy.array(transform(self.mSimulatedCounts[0][
-                           label], self.mSimulatedCounts[0].mOutOfBounds[label]), numpy.float)
-        msum = numpy.array(transform(self.mSimulatedCounts[0][
-                           label], self.mSimulatedCounts[0].mOutOfBounds[label]), numpy.float)
-        mmax = numpy.array(transform(self.mSimulatedCounts[0][
-                           label], self.mSimulatedCounts[0].mOutOfBounds[label]), numpy.float)
-
-        for x in range(1, num_samples):
-            v = transform(
-                self.mSimulatedCounts[x][label], self.mSimulatedCounts[x].mOutOfBounds[label])
-            mmin = numpy.minimum(mmin, v)
-            mmax = numpy.maximum(mmax, v)
-            msum = msum + v
-
-        msum /= num_samples
+        v = transform(self.mSimulatedCounts[label],
+                      self.mSimulatedCounts.mOutOfBounds[label])
 
         self.mTransform = transform
 
-        self.mEnvelopes[label] = (mmin, mmax, msum)
+        self.mEnvelopes[label] = (v.min(axis=0), v.max(axis=0),
+                                  v.mean(axis=0))
 
         return self.mEnvelopes[label]
 
@@ -494,6 +541,11 @@ class Counter(object):
 
     A counter will implement an addCounts method that expects a sorted
     list of intervals within a region bounded by start,end.
+
+    If *num_samples* is given, the counter collects counts for
+    several samples at once, see :meth:`addCountsBatch`. Counts are
+    then stored in a matrix with one row per sample and totals and
+    out-of-bounds counts in arrays with one element per sample.
     """
 
     # python list is fastest for single value access, but requires a lot of
@@ -502,7 +554,11 @@ class Counter(object):
     mBuildCounts = lambda self, num_bins, dtype: array.array(
         "I", [0] * num_bins)
 
-    def __init__(self, labels, num_bins, resolution=1, dtype=numpy.int8):
+    mBuildBatchCounts = lambda self, num_samples, num_bins, dtype: \
+        numpy.zeros((num_samples, num_bins), numpy.uint32)
+
+    def __init__(self, labels, num_bins, resolution=1, dtype=numpy.int8,
+                 num_samples=None):
 
         self.mCounts = {}
         self.mTotals = {}
@@ -510,14 +566,20 @@ class Counter(object):
         # dtype
         self.mOutOfBounds = {}
 
-        b = self.mBuildCounts
         for l in labels:
-            self.mCounts[l] = self.mBuildCounts(num_bins, dtype)
-            self.mTotals[l] = 0
-            self.mOutOfBounds[l] = 0
+            if num_samples is None:
+                self.mCounts[l] = self.mBuildCounts(num_bins, dtype)
+                self.mTotals[l] = 0
+                self.mOutOfBounds[l] = 0
+            else:
+                self.mCounts[l] = self.mBuildBatchCounts(
+                    num_samples, num_bins, dtype)
+                self.mTotals[l] = numpy.zeros(num_samples, numpy.int64)
+                self.mOutOfBounds[l] = numpy.zeros(num_samples, numpy.int64)
 
         self.mNumBins = num_bins
         self.mResolution = resolution
+        self.mNumSamples = num_samples
 
     def __getitem__(self, key):
         return self.mCounts[key]
@@ -531,6 +593,55 @@ class Counter(object):
         else:
             return value
 
+    def resolveBatch(self, values):
+        """resolve an array of values."""
+        if self.mResolution > 1:
+            return values // self.mResolution
+        else:
+            return values
+
+    def addPositionsBatch(self, samples, positions, labels, counts=1):
+        """add *counts* at bins *positions* of *samples* for *labels*.
+
+        Positions outside the count vector are added to the
+        out-of-bounds counts.
+        """
+        inside = positions < self.mNumBins
+        outside = ~inside
+        if numpy.ndim(counts):
+            counts_outside = counts[outside]
+        else:
+            counts_outside = counts
+
+        for label in labels:
+            numpy.add.at(self.mCounts[label],
+                         (samples[inside], positions[inside]), 1)
+            numpy.add.at(self.mOutOfBounds[label],
+                         samples[outside], counts_outside)
+            numpy.add.at(self.mTotals[label], samples, counts)
+
+    def addCountsBatch(self, starts, ends, start, end,
+                       left_labels, right_labels, first_sample=0):
+        """add counts for segments in several samples.
+
+        *starts* and *ends* are arrays with one sample per row
+        and segments sorted by position within a row. The first
+        row is counted as sample *first_sample*.
+        """
+        raise NotImplementedError(
+            "define addCountsBatch() in base classes")
+
+    def finish(self):
+        """finish counting."""
+        pass
+
+    def merge(self, other):
+        """add counts from *other* to this counter."""
+        for label in self.mCounts:
+            self.mCounts[label] += other.mCounts[label]
+            self.mTotals[label] += other.mTotals[label]
+            self.mOutOfBounds[label] += other.mOutOfBounds[label]
+
 
 class CounterTranscription(Counter):
 
@@ -541,6 +652,9 @@ class CounterTranscription(Counter):
     # numpy is fastest for counting with blocks of data
     mBuildCounts = lambda self, num_bins, dtype: numpy.zeros(num_bins, dtype)
 
+    mBuildBatchCounts = lambda self, num_samples, num_bins, dtype: \
+        numpy.zeros((num_samples, num_bins), dtype)
+
     def addCounts(self, rr, start, end, left_labels, right_labels):
 
         counts = self.mCounts
@@ -572,6 +686,49 @@ class CounterTranscription(Counter):
                     counts[label][pos:pos + l] += 1
                     totals[label] += l
 
+    def addCountsBatch(self, starts, ends, start, end,
+                       left_labels, right_labels, first_sample=0):
+
+        # counts are added to a difference array and accumulated in
+        # finish(). Unsigned overflow cancels out in the cumulative sum.
+        if not hasattr(self, "mDiffs"):
+            self.mDiffs = {}
+            for label in self.mCounts:
+                self.mDiffs[label] = numpy.zeros(
+                    (self.mNumSamples, self.mNumBins + 1),
+                    self.mCounts[label].dtype)
+
+        nbins = self.mNumBins
+        samples = numpy.indices(starts.shape)[0] + first_sample
+        lengths = self.resolveBatch(ends - starts)
+        dl = starts - start
+        dr = end - ends
+
+        for select, distances, labels in ((dl < dr, dl, left_labels),
+                                          (dl > dr, dr, right_labels)):
+            pos = self.resolveBatch(distances[select])
+            lens = lengths[select]
+            s = samples[select]
+            inside = pos < nbins
+            for label in labels:
+                diffs = self.mDiffs[label]
+                numpy.add.at(diffs, (s[inside], pos[inside]), 1)
+                numpy.subtract.at(
+                    diffs,
+                    (s[inside], numpy.minimum(pos[inside] + lens[inside],
+                                              nbins)), 1)
+                numpy.add.at(self.mOutOfBounds[label],
+                             s[~inside], lens[~inside])
+                numpy.add.at(self.mTotals[label], s, lens)
+
+    def finish(self):
+        if not hasattr(self, "mDiffs"):
+            return
+        for label, diffs in self.mDiffs.items():
+            self.mCounts[label] += numpy.cumsum(
+                diffs[:, :-1], axis=1, dtype=diffs.dtype)
+        del self.mDiffs
+
 
 class CounterClosestDistance(Counter):
 
@@ -602,6 +759,15 @@ class CounterClosestDistance(Counter):
         pos = self.resolve(end - rr[-1][1])
         __add(pos, right_labels)
 
+    def addCountsBatch(self, starts, ends, start, end,
+                       left_labels, right_labels, first_sample=0):
+
+        samples = numpy.arange(starts.shape[0]) + first_sample
+        self.addPositionsBatch(
+            samples, self.resolveBatch(starts[:, 0] - start), left_labels)
+        self.addPositionsBatch(
+            samples, self.resolveBatch(end - ends[:, -1]), right_labels)
+
 
 class CounterAllDistances(Counter):
 
@@ -638,6 +804,95 @@ class CounterAllDistances(Counter):
                     counts[label][pos] += 1
                     totals[label] += 1
 
+    def addCountsBatch(self, starts, ends, start, end,
+                       left_labels, right_labels, first_sample=0):
+
+        samples = numpy.indices(starts.shape)[0] + first_sample
+        dl = starts - start
+        dr = end - ends
+
+        left = dl < dr
+        self.addPositionsBatch(
+            samples[left], self.resolveBatch(dl[left]), left_labels)
+        right = dl > dr
+        self.addPositionsBatch(
+            samples[right], self.resolveBatch(dr[right]), right_labels)
+
+
+# number of samples generated per workspace in a single array operation
+SAMPLE_CHUNK_SIZE = 100
+
+
+def sampleWorkspaces(workspaces, sampler, counters, num_samples, seed,
+                     chunk_size=SAMPLE_CHUNK_SIZE):
+    """add counts of randomly arranged segments in *workspaces*
+    to *counters*.
+
+    *workspaces* is a list of tuples (index, work_start, work_end,
+    segments, left_labels, right_labels). The random numbers for a
+    workspace are generated from *seed* and the workspace index.
+
+    Samples are generated *chunk_size* at a time, so that memory
+    usage does not grow with the number of samples.
+    """
+    for index, work_start, work_end, observed, left_labels, right_labels \
+            in workspaces:
+        rng = numpy.random.RandomState([seed, index])
+        s = sampler(observed, work_start, work_end)
+        for first_sample in range(0, num_samples, chunk_size):
+            starts, ends = s.sampleBatch(
+                min(chunk_size, num_samples - first_sample), rng)
+            for counter in counters:
+                counter.addCountsBatch(starts, ends, work_start, work_end,
+                                       left_labels, right_labels,
+                                       first_sample=first_sample)
+
+    for counter in counters:
+        counter.finish()
+
+
+def buildSampleCounters(counter_types, labels, num_bins, resolution,
+                        dtype, num_samples):
+    """return counters collecting counts for *num_samples* samples."""
+    return [counter(labels, num_bins, resolution, dtype=dtype,
+                    num_samples=num_samples)
+            for counter in counter_types]
+
+
+# sampling parameters of a worker process
+SHARED = {}
+
+
+def initSampler(sampler, counter_types, labels, num_bins, resolution,
+                dtype, num_samples, seed):
+    """set up sampling parameters in a worker process."""
+    SHARED.update({"sampler": sampler,
+                   "counter_types": counter_types,
+                   "labels": labels,
+                   "num_bins": num_bins,
+                   "resolution": resolution,
+                   "dtype": dtype,
+                   "num_samples": num_samples,
+                   "seed": seed})
+
+
+def sampleChunk(workspaces):
+    """sample a chunk of *workspaces* in a worker process.
+
+    The counters are built in the worker from the parameters
+    given to :func:`initSampler`. Returns a list of counters,
+    see :func:`sampleWorkspaces`.
+    """
+    counters = buildSampleCounters(SHARED["counter_types"],
+                                   SHARED["labels"],
+                                   SHARED["num_bins"],
+                                   SHARED["resolution"],
+                                   SHARED["dtype"],
+                                   SHARED["num_samples"])
+    sampleWorkspaces(workspaces, SHARED["sampler"], counters,
+                     SHARED["num_samples"], SHARED["seed"])
+    return counters
+
 
 def indexIntervals(intervals, with_values=False):
     """index intervals using bx.
@@ -668,10 +923,10 @@ def plotCounts(counter, options, transform=lambda x: x):
         fig = plt.figure()
 
         if options.plot_samples:
+            counts = transform(counter.mSimulatedCounts[label],
+                               counter.mSimulatedCounts.mOutOfBounds[label])
             for x in range(options.num_samples):
-                counts = transform(counter.mSimulatedCounts[x][
-                                   label], counter.mSimulatedCounts[x].mOutOfBounds[label])
-                plt.plot(bins, counts / t, label="sample_%i" % x)
+                plt.plot(bins, counts[x], label="sample_%i" % x)
 
         if options.plot_envelope:
             # counts per sample are in row
@@ -787,6 +1042,10 @@ def main(argv=sys.argv):
     parser.add_option("--keep-ambiguous", dest="keep_ambiguous", action="store_true",
                       help="keep segments extending to more than one workspace [default=%default]")
 
+    parser.add_option("--num-threads", dest="num_threads", type="int",
+                      help="number of processes to use for sampling "
+                      "[default=%default]")
+
     parser.set_defaults(
         filename_annotations=None,
         filename_workspace="workspace.gff",
@@ -813,6 +1072,7 @@ def main(argv=sys.argv):
         hardcopy="%s.png",
         segments_format="gtf",
         remove_overhangs=False,
+        num_threads=1,
     )
 
     (options, args) = E.start(parser, argv=argv, add_output_options=True)
@@ -891,6 +1151,7 @@ def main(argv=sys.argv):
     ###########################################
     # setup counting containers
     counters = []
+    counter_types = []
     for cc in options.counters:
 
         if cc == "transcription":
@@ -927,15 +1188,10 @@ def main(argv=sys.argv):
         c = CountingResults(labels)
         c.mObservedCounts = counter(
             labels, options.num_bins, options.resolution, dtype=dtype)
-
-        simulated_counts = []
-        for x in range(options.num_samples):
-            simulated_counts.append(
-                counter(labels, options.num_bins, options.resolution, dtype=dtype))
-        c.mSimulatedCounts = simulated_counts
         c.mName = c.mObservedCounts.mName
 
         counters.append(c)
+        counter_types.append(counter)
 
         E.info("allocated memory successfully")
 
@@ -945,7 +1201,8 @@ def main(argv=sys.argv):
     workspaces_per_label = collections.defaultdict(int)
 
     ############################################
-    # get observed and simpulated counts
+    # get observed counts and collect workspaces for sampling
+    sample_workspaces = []
     nworkspaces, nempty_workspaces, nempty_contigs, nmiddle = 0, 0, 0, 0
     iteration2 = 0
     for contig, vv in workspace.items():
@@ -996,15 +1253,47 @@ def main(argv=sys.argv):
                 counter.mObservedCounts.addCounts(
                     observed, work_start, work_end, left_labels, right_labels)
 
-            # create sampler
-            s = sampler(observed, work_start, work_end)
+            sample_workspaces.append(
+                (len(sample_workspaces), work_start, work_end, observed,
+                 left_labels, right_labels))
 
-            # add simulated counts
-            for iteration in range(options.num_samples):
-                simulated = s.sample()
-                for counter in counters:
-                    counter.mSimulatedCounts[iteration].addCounts(
-                        simulated, work_start, work_end, left_labels, right_labels)
+    ############################################
+    # get simulated counts
+    if options.random_seed is not None:
+        seed = options.random_seed
+    else:
+        seed = random.randint(0, 2 ** 31 - 1)
+
+    E.info("sampling %i workspaces with %i processes, seed=%i" %
+           (len(sample_workspaces), options.num_threads, seed))
+
+    if options.num_threads > 1:
+        # the counters are built in the worker processes. The counters
+        # returned first collect the counts of the other workers.
+        chunks = [sample_workspaces[x::options.num_threads]
+                  for x in range(options.num_threads)]
+        pool = multiprocessing.Pool(
+            options.num_threads,
+            initializer=initSampler,
+            initargs=(sampler, counter_types, labels, options.num_bins,
+                      options.resolution, dtype, options.num_samples, seed))
+        for results in pool.imap_unordered(sampleChunk, chunks):
+            for counter, result in zip(counters, results):
+                if counter.mSimulatedCounts is None:
+                    counter.mSimulatedCounts = result
+                else:
+                    counter.mSimulatedCounts.merge(result)
+        pool.close()
+        pool.join()
+    else:
+        simulated = buildSampleCounters(counter_types, labels,
+                                        options.num_bins,
+                                        options.resolution, dtype,
+                                        options.num_samples)
+        for counter, result in zip(counters, simulated):
+            counter.mSimulatedCounts = result
+        sampleWorkspaces(sample_workspaces, sampler, simulated,
+                         options.num_samples, seed)
 
     E.info("counting finished")
     E.info("nworkspaces=%i, nmiddle=%i, nempty_workspaces=%i, nempty_contigs=%i" %
@@ -1075,13 +1364,9 @@ def main(argv=sys.argv):
         outofbounds_sim, totals_sim = 0, 0
         outofbounds_obs, totals_obs = 0, 0
         for label in labels:
-            for sample in range(options.num_samples):
-                if counter.mSimulatedCounts[sample].mOutOfBounds[label]:
-                    E.debug("out of bounds: sample %i, label %s, counts=%i" %
-                            (sample, label, counter.mSimulatedCounts[sample].mOutOfBounds[label]))
-                    outofbounds_sim += counter.mSimulatedCounts[
-                        sample].mOutOfBounds[label]
-                totals_sim += counter.mSimulatedCounts[sample].mTotals[label]
+            outofbounds_sim += counter.mSimulatedCounts.mOutOfBounds[
+                label].sum()
+            totals_sim += counter.mSimulatedCounts.mTotals[label].sum()
 
             outofbounds_obs += counter.mObservedCounts.mOutOfBounds[label]
             totals_obs += counter.mObservedCounts.mTotals[label]
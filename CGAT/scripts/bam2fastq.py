@@ -28,6 +28,22 @@ below will create the same two output files::
 
    cat in.bam cgat bam2fastq --output-filename-pattern=out.%s.fastq.gz
 
+Mates are paired by read name while the :term:`bam` file is read, so
+the input can be sorted by coordinate or by name. Reads whose mate has
+not been seen yet are kept in memory. If there are more than
+``--buffer-size`` of these, they are written to temporary files
+sorted by read name, which are merged at the end. Pairs are output
+in the order in which they are completed, the remaining reads at the
+end sorted by read name. If the mate of a read is missing, it is
+replaced by a read of ``N`` characters.
+
+Reads that are not paired are written to the first file. If the
+:term:`bam` file also contains paired reads, the unpaired reads are
+output at the end in the order in which they were read and are
+paired with a read of ``N`` characters in the second file.
+
+Secondary and supplementary alignments are ignored.
+
 Type::
 
    python bam2fastq.py --help
@@ -41,6 +57,8 @@ Command line options
 
 import os
 import sys
+import heapq
+import itertools
 import tempfile
 import shutil
 import CGATCore.Experiment as E
@@ -49,6 +67,143 @@ import CGATCore.IOTools as IOTools
 import pysam
 
 
+def iterateRun(filename):
+    '''iterate over records in a temporary file written by
+    :meth:`ReadCollator.spill`.'''
+    with open(filename) as inf:
+        for line in inf:
+            yield tuple(line[:-1].split("\t"))
+
+
+class ReadCollator(object):
+    '''pair mates of read pairs by read name and write them to
+    two :term:`fastq` files.
+
+    Reads without a mate are kept in a buffer. If the buffer
+    contains more than *buffer_size* reads, it is written to a
+    temporary file in *tmpdir* sorted by read name. Mates that are
+    not paired while reading are paired in a final merge of these
+    files in :meth:`finish`.
+
+    Reads that are not paired are kept in a temporary file and
+    output in :meth:`finish`.
+
+    Output files are opened when the first read is written.
+    '''
+
+    def __init__(self, filenames, tmpdir, buffer_size=1000000,
+                 counter=None):
+        self.filenames = filenames
+        self.outfiles = [None] * len(filenames)
+        self.tmpdir = tmpdir
+        self.buffer_size = buffer_size
+        self.pending = {}
+        self.runs = []
+        self.unpaired = None
+        self.is_paired = False
+        if counter is None:
+            counter = E.Counter()
+        self.counter = counter
+
+    def write(self, index, name, seq, qual):
+        '''write a read to output file *index*.'''
+        if self.outfiles[index] is None:
+            self.outfiles[index] = IOTools.open_file(
+                self.filenames[index], "w")
+        self.outfiles[index].write("@%s\n%s\n+\n%s\n" % (name, seq, qual))
+
+    def addUnpaired(self, name, seq, qual):
+        '''add read *name* that is not paired.'''
+        if self.unpaired is None:
+            self.unpaired = open(
+                os.path.join(self.tmpdir, "unpaired"), "w")
+        self.unpaired.write("%s\t%s\t%s\n" % (name, seq, qual))
+
+    def add(self, name, mate, seq, qual):
+        '''add read *name*. *mate* is "1" for the first and "2" for
+        the second read in a pair.'''
+        self.is_paired = True
+        if name in self.pending:
+            other, other_seq, other_qual = self.pending[name]
+            if other == mate:
+                self.counter.duplicates += 1
+                return
+            del self.pending[name]
+            if mate == "1":
+                self.write(0, name, seq, qual)
+                self.write(1, name, other_seq, other_qual)
+            else:
+                self.write(0, name, other_seq, other_qual)
+                self.write(1, name, seq, qual)
+            self.counter.pairs += 1
+        else:
+            self.pending[name] = (mate, seq, qual)
+            if len(self.pending) > self.buffer_size:
+                self.spill()
+
+    def sortedPending(self):
+        return [(name, mate, seq, qual) for name, (mate, seq, qual) in
+                sorted(self.pending.items())]
+
+    def spill(self):
+        '''write unpaired reads sorted by name to a temporary file.'''
+        filename = os.path.join(self.tmpdir, "run%i" % len(self.runs))
+        E.debug("writing %i unpaired reads to %s" %
+                (len(self.pending), filename))
+        with open(filename, "w") as outf:
+            for record in self.sortedPending():
+                outf.write("\t".join(record) + "\n")
+        self.runs.append(filename)
+        self.pending = {}
+        self.counter.spilled += 1
+
+    def finish(self, read1_qlen, read2_qlen):
+        '''pair remaining reads and close output files.
+
+        Reads without a mate are paired with a read of length
+        *read1_qlen* or *read2_qlen* consisting of ``N``. Unpaired
+        reads are output last. They are paired with a read of length
+        *read2_qlen* if there are any paired reads.
+        '''
+        streams = [iterateRun(x) for x in self.runs]
+        streams.append(self.sortedPending())
+        self.pending = {}
+
+        for name, records in itertools.groupby(
+                heapq.merge(*streams), key=lambda x: x[0]):
+            mates = {}
+            for record in records:
+                if record[1] in mates:
+                    self.counter.duplicates += 1
+                else:
+                    mates[record[1]] = record[2:]
+
+            if "1" in mates and "2" in mates:
+                self.counter.pairs += 1
+            elif "1" in mates:
+                mates["2"] = ("N" * read2_qlen, "B" * read2_qlen)
+                self.counter.extra2 += 1
+            else:
+                mates["1"] = ("N" * read1_qlen, "B" * read1_qlen)
+                self.counter.extra1 += 1
+
+            self.write(0, name, *mates["1"])
+            self.write(1, name, *mates["2"])
+
+        if self.unpaired is not None:
+            self.unpaired.close()
+            for name, seq, qual in iterateRun(self.unpaired.name):
+                self.write(0, name, seq, qual)
+                if self.is_paired:
+                    self.write(1, name, "N" * read2_qlen, "B" * read2_qlen)
+                    self.counter.extra2 += 1
+            self.unpaired = None
+
+        for outfile in self.outfiles:
+            if outfile is not None:
+                outfile.close()
+
+
 def main(argv=None):
     """script main.
 
@@ -62,7 +217,13 @@ def main(argv=None):
     parser = E.OptionParser(version="%prog version: $Id$",
                             usage=globals()["__doc__"])
 
+    parser.add_option(
+        "--buffer-size", dest="buffer_size", type="int",
+        help="maximum number of reads without a mate to keep in memory "
+        "before writing them to a temporary file [default=%default].")
+
     parser.set_defaults(
+        buffer_size=1000000,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -91,81 +252,46 @@ def main(argv=None):
 
     tmpdir = tempfile.mkdtemp()
 
-    outtemp1 = os.path.join(tmpdir, "pair1.gz")
-    outtemp2 = os.path.join(tmpdir, "pair2.gz")
+    E.info('writing unpaired reads to temporary directory %s' % tmpdir)
 
-    outstream1 = IOTools.open_file(outtemp1, "w")
-    outstream2 = IOTools.open_file(outtemp2, "w")
-
-    E.info('writing fastq files to temporary directory %s' % tmpdir)
-
-    found1, found2 = set(), set()
     read1_qlen, read2_qlen = 0, 0
 
     c = E.Counter()
-    for read in samfile.fetch(until_eof=True):
-        c.input += 1
-        if not read.is_paired:
-            outstream1.write(
-                "\t".join((read.qname, read.seq, read.qual)) + "\n")
-            found1.add(read.qname)
-            if not read1_qlen:
-                read1_qlen = read.qlen
-            c.unpaired += 1
-        elif read.is_read1:
-            outstream1.write(
-                "\t".join((read.qname, read.seq, read.qual)) + "\n")
-            found1.add(read.qname)
-            if not read1_qlen:
-                read1_qlen = read.qlen
-            c.output1 += 1
-        elif read.is_read2:
-            if read.qname not in found2:
-                outstream2.write(
-                    "\t".join((read.qname, read.seq, read.qual)) + "\n")
-                found2.add(read.qname)
+    collator = ReadCollator((fastqfile1, fastqfile2),
+                            tmpdir,
+                            buffer_size=options.buffer_size,
+                            counter=c)
+
+    try:
+        for read in samfile.fetch(until_eof=True):
+            c.input += 1
+            if read.is_secondary or read.is_supplementary:
+                c.skipped += 1
+                continue
+            if not read.is_paired:
+                collator.addUnpaired(read.qname, read.seq, read.qual)
+                c.unpaired += 1
+            elif read.is_read1:
+                collator.add(read.qname, "1", read.seq, read.qual)
+                if not read1_qlen:
+                    read1_qlen = read.qlen
+                c.output1 += 1
+            elif read.is_read2:
+                collator.add(read.qname, "2", read.seq, read.qual)
                 if not read2_qlen:
                     read2_qlen = read.qlen
                 c.output2 += 1
 
-    if c.unpaired == 0 and c.output1 == 0 and c.output2 == 0:
-        E.warn("no reads were found")
-        return
-
-    sort_statement = '''gunzip < %s
-    | sort -k1,1
-    | awk '{printf("@%%s\\n%%s\\n+\\n%%s\\n", $1,$2,$3)}'
-    | gzip > %s'''
-
-    if c.output1 == 0 and c.output2 == 0:
-        # single end data:
-        outstream1.close()
-        outstream2.close()
-        E.info("sorting fastq files")
-        E.run(sort_statement % (outtemp1, fastqfile1))
-
-    else:
-        # paired end data
-        for qname in found2.difference(found1):
-            outstream1.write(
-                "\t".join((qname, "N" * read1_qlen, "B" * read1_qlen)) + "\n")
-            c.extra1 += 1
-
-        for qname in found1.difference(found2):
-            outstream2.write(
-                "\t".join((qname, "N" * read2_qlen, "B" * read2_qlen)) + "\n")
-            c.extra2 += 1
-
-        E.info("%s" % str(c))
-
-        outstream1.close()
-        outstream2.close()
+        if c.unpaired == 0 and c.output1 == 0 and c.output2 == 0:
+            E.warn("no reads were found")
+            return
 
-        E.info("sorting fastq files")
-        E.run(sort_statement % (outtemp1, fastqfile1))
-        E.run(sort_statement % (outtemp2, fastqfile2))
+        E.info("pairing reads from %i temporary files" % len(collator.runs))
+        collator.finish(read1_qlen, read2_qlen)
+    finally:
+        shutil.rmtree(tmpdir)
 
-    shutil.rmtree(tmpdir)
+    E.info("%s" % str(c))
 
     # write footer and output benchmark information.
     E.stop()
@@ -289,6 +289,15 @@ be compressed with and indexed with :file:`tabix`.
    Paired-endedness is ignored. Both ends of a paired-ended read are
    treated individually.
 
+Parallel counting
++++++++++++++++++
+
+With ``--threads``, transcripts are split into chunks that are
+counted in separate processes. A chunk contains at most
+``--chunk-size`` transcripts from a single contig. Each process
+opens the input files itself. The output is identical to counting
+in a single process.
+
 
 Command line options
 --------------------
@@ -297,6 +306,8 @@ Command line options
 
 import os
 import sys
+import optparse
+import multiprocessing
 import CGATCore.Experiment as E
 import CGATCore.IOTools as IOTools
 import pysam
@@ -307,6 +318,284 @@ import pandas
 import CGAT.scripts._bam2geneprofile as _bam2geneprofile
 
 
+def buildRangeCounter(options):
+    '''build a range counter for the bam/bed/bigwig files
+    in *options*.'''
+
+    if options.infiles[0].endswith(".bam"):
+        bamfiles = [pysam.AlignmentFile(x, "rb") for x in options.infiles]
+
+        if options.controlfiles:
+            controlfiles = [pysam.AlignmentFile(x, "rb")
+                            for x in options.controlfiles]
+        else:
+            controlfiles = None
+
+        format = "bam"
+        if options.merge_pairs:
+            range_counter = _bam2geneprofile.RangeCounterBAM(
+                bamfiles,
+                shifts=options.shifts,
+                extends=options.extends,
+                merge_pairs=options.merge_pairs,
+                min_insert_size=options.min_insert_size,
+                max_insert_size=options.max_insert_size,
+                controfiles=controlfiles,
+                control_factor=options.control_factor)
+
+        elif options.shifts or options.extends:
+            range_counter = _bam2geneprofile.RangeCounterBAM(
+                bamfiles,
+                shifts=options.shifts,
+                extends=options.extends,
+                controlfiles=controlfiles,
+                control_factor=options.control_factor)
+
+        elif options.base_accuracy:
+            range_counter = _bam2geneprofile.RangeCounterBAMBaseAccuracy(
+                bamfiles,
+                controlfiles=controlfiles,
+                control_factor=options.control_factor)
+        else:
+            range_counter = _bam2geneprofile.RangeCounterBAM(
+                bamfiles,
+                controlfiles=controlfiles,
+                control_factor=options.control_factor)
+
+    elif options.infiles[0].endswith(".bed.gz"):
+        bedfiles = [pysam.Tabixfile(x) for x in options.infiles]
+
+        if options.controlfiles:
+            controlfiles = [pysam.Tabixfile(x)
+                            for x in options.controlfiles]
+        else:
+            controlfiles = None
+
+        range_counter = _bam2geneprofile.RangeCounterBed(
+            bedfiles,
+            controlfiles=controlfiles,
+            control_factor=options.control_factor)
+
+    elif options.infiles[0].endswith(".bw"):
+        wigfiles = [BigWigFile(file=open(x)) for x in options.infiles]
+        range_counter = _bam2geneprofile.RangeCounterBigWig(wigfiles)
+
+    else:
+        raise NotImplementedError(
+            "can't determine file type for %s" % str(options.infiles))
+
+    return range_counter
+
+
+def buildCounters(options, range_counter):
+    '''build a counter for each method in *options* that
+    collects counts from *range_counter*.'''
+
+    counters = []
+    for method in options.methods:
+        if method == "utrprofile":
+            counters.append(_bam2geneprofile.UTRCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_upstream_utr,
+                options.resolution_cds,
+                options.resolution_downstream_utr,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream,
+            ))
+
+        elif method == "geneprofile":
+            counters.append(_bam2geneprofile.GeneCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_cds,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream,
+                options.scale_flanks))
+
+        elif method == "geneprofilewithintrons":
+            counters.append(_bam2geneprofile.GeneCounterWithIntrons(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_cds,
+                options.resolution_introns,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream,
+                options.scale_flanks))
+
+        elif method == "geneprofileabsolutedistancefromthreeprimeend":
+            # options.extension_exons_absolute_distance_tostartsite,
+            # options.extension_introns_absolute_distance_tostartsite,
+            # Tim 31th Aug 2013: a possible feature for future,  if five prime
+            # bias is of your interest.
+            # (you need to create another class). It is not very difficult to
+            # derive from this class, but is not implemented yet
+            # This future feature is slightly different the TSS profile
+            # already implemented, because in this future feature introns are
+            # skipped,
+            counters.append(
+                _bam2geneprofile.GeneCounterAbsoluteDistanceFromThreePrimeEnd(
+                    range_counter, options.resolution_upstream,
+                    options.resolution_downstream,
+                    options.resolution_exons_absolute_distance_topolya,
+                    options.resolution_introns_absolute_distance_topolya,
+                    options.extension_upstream,
+                    options.extension_downstream,
+                    options.extension_exons_absolute_distance_topolya,
+                    options.extension_introns_absolute_distance_topolya,
+                    options.scale_flanks))
+
+        elif method == "tssprofile":
+            counters.append(_bam2geneprofile.TSSCounter(
+                range_counter,
+                options.extension_outward,
+                options.extension_inward))
+
+        elif method == "intervalprofile":
+            counters.append(_bam2geneprofile.RegionCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_cds,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+        elif method == "midpointprofile":
+            counters.append(_bam2geneprofile.MidpointCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+        # add new method to split 1st and last exons out
+        # requires a representative transcript for reach gene
+        # gtf should be sorted gene-position
+        elif method == "separateexonprofile":
+            counters.append(_bam2geneprofile.SeparateExonCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_first,
+                options.resolution_last,
+                options.resolution_cds,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+        elif method == "separateexonprofilewithintrons":
+            counters.append(_bam2geneprofile.SeparateExonWithIntronCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_first,
+                options.resolution_last,
+                options.resolution_cds,
+                options.resolution_introns,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+    for c in counters:
+        c.setNormalization(options.transcript_normalization)
+
+    return counters
+
+
+def iterateChunks(gtf_iterator, chunk_size):
+    '''group transcripts in *gtf_iterator* into chunks of at most
+    *chunk_size* transcripts. Each chunk contains transcripts from
+    a single contig.'''
+
+    chunk = []
+    for gtf in gtf_iterator:
+        if chunk and (len(chunk) >= chunk_size or
+                      gtf[0].contig != chunk[0][0].contig):
+            yield chunk
+            chunk = []
+        chunk.append(gtf)
+
+    if chunk:
+        yield chunk
+
+
+# input files and options of a worker process, see initWorker()
+WORKER = {}
+
+
+def initWorker(options):
+    '''open input files in a worker process.'''
+    WORKER["options"] = options
+    WORKER["range_counter"] = buildRangeCounter(options)
+
+
+def countChunk(args):
+    '''count transcripts in a chunk in a worker process.
+
+    Returns a list of counters and, if profiles are kept, a list with
+    the counts of each transcript for each counter.
+    '''
+    chunk, keep_profiles = args
+
+    counters = buildCounters(WORKER["options"], WORKER["range_counter"])
+    if keep_profiles:
+        profiles = [[] for x in counters]
+    else:
+        profiles = None
+
+    _bam2geneprofile.countFromGTF(counters, chunk, profiles)
+
+    if profiles is None:
+        profiles = [None] * len(counters)
+
+    return counters, profiles
+
+
+def countInParallel(options, range_counter, counters, gtf_iterator):
+    '''count transcripts in *gtf_iterator* with multiple processes.
+
+    Transcripts are split into chunks that are counted in separate
+    worker processes. Each worker opens its own input files. The
+    counts of each chunk are merged into *counters* in the order of
+    the chunks, so that the output is identical to counting in a
+    single process.
+    '''
+
+    # open files can not be passed to the workers
+    worker_options = optparse.Values(dict(
+        (key, value) for key, value in list(vars(options).items())
+        if not hasattr(value, "read") and not hasattr(value, "write")))
+    # do not recompute the control normalization in each worker
+    worker_options.control_factor = range_counter.control_factor
+
+    # summing the aggregates of each chunk is exact for integer
+    # counts. Otherwise, transcripts are aggregated one by one to
+    # avoid differences due to floating point round-off.
+    keep_profiles = options.output_all_profiles or \
+        options.transcript_normalization in ("max", "sum",
+                                             "total-max", "total-sum")
+
+    pool = multiprocessing.Pool(options.threads,
+                                initializer=initWorker,
+                                initargs=(worker_options,))
+
+    work = ((chunk, keep_profiles) for chunk in
+            iterateChunks(gtf_iterator, options.chunk_size))
+
+    nchunks = 0
+    for partial_counters, profiles in pool.imap(countChunk, work):
+        for counter, partial, p in zip(counters, partial_counters, profiles):
+            counter.merge(partial, p)
+        nchunks += 1
+
+    pool.close()
+    pool.join()
+
+    E.info("counted %i chunks with %i processes" %
+           (nchunks, options.threads))
+
+
 def main(argv=None):
     """script main.
 
@@ -530,6 +819,17 @@ def main(argv=None):
         "to be considered for background meta-gene normalization "
         "[%default]")
 
+    parser.add_option(
+        "--threads", dest="threads", type="int",
+        help="number of processes to use for counting. Transcripts "
+        "are split into chunks by contig that are counted "
+        "in parallel [%default]")
+
+    parser.add_option(
+        "--chunk-size", dest="chunk_size", type="int",
+        help="maximum number of transcripts in a chunk when counting "
+        "with multiple processes [%default]")
+
     parser.set_defaults(
         remove_rna=False,
         ignore_pairs=False,
@@ -579,6 +879,8 @@ def main(argv=None):
         output_all_profiles=False,
         background_region_bins=10,
         input_filename_counts=None,
+        threads=1,
+        chunk_size=500,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -612,184 +914,21 @@ def main(argv=None):
         if methodsRequiresBaseAccuracy in options.methods:
             options.base_accuracy = True
 
+    gtf_entries = GTF.iterator(options.gtffile)
+    if options.threads > 1:
+        # entries are passed to worker processes and need to be picklable
+        gtf_entries = (GTF.Entry().fromGTF(x) for x in gtf_entries)
+
     if options.reporter == "gene":
-        gtf_iterator = GTF.flat_gene_iterator(GTF.iterator(options.gtffile))
+        gtf_iterator = GTF.flat_gene_iterator(gtf_entries)
     elif options.reporter == "transcript":
-        gtf_iterator = GTF.transcript_iterator(GTF.iterator(options.gtffile))
-
-    # Select rangecounter based on file type
-    if len(options.infiles) > 0:
-        if options.infiles[0].endswith(".bam"):
-            bamfiles = [pysam.AlignmentFile(x, "rb") for x in options.infiles]
-
-            if options.controlfiles:
-                controlfiles = [pysam.AlignmentFile(x, "rb")
-                                for x in options.controlfiles]
-            else:
-                controlfiles = None
-
-            format = "bam"
-            if options.merge_pairs:
-                range_counter = _bam2geneprofile.RangeCounterBAM(
-                    bamfiles,
-                    shifts=options.shifts,
-                    extends=options.extends,
-                    merge_pairs=options.merge_pairs,
-                    min_insert_size=options.min_insert_size,
-                    max_insert_size=options.max_insert_size,
-                    controfiles=controlfiles,
-                    control_factor=options.control_factor)
-
-            elif options.shifts or options.extends:
-                range_counter = _bam2geneprofile.RangeCounterBAM(
-                    bamfiles,
-                    shifts=options.shifts,
-                    extends=options.extends,
-                    controlfiles=controlfiles,
-                    control_factor=options.control_factor)
-
-            elif options.base_accuracy:
-                range_counter = _bam2geneprofile.RangeCounterBAMBaseAccuracy(
-                    bamfiles,
-                    controlfiles=controlfiles,
-                    control_factor=options.control_factor)
-            else:
-                range_counter = _bam2geneprofile.RangeCounterBAM(
-                    bamfiles,
-                    controlfiles=controlfiles,
-                    control_factor=options.control_factor)
-
-        elif options.infiles[0].endswith(".bed.gz"):
-            bedfiles = [pysam.Tabixfile(x) for x in options.infiles]
-
-            if options.controlfiles:
-                controlfiles = [pysam.Tabixfile(x)
-                                for x in options.controlfiles]
-            else:
-                controlfiles = None
-
-            range_counter = _bam2geneprofile.RangeCounterBed(
-                bedfiles,
-                controlfiles=controlfiles,
-                control_factor=options.control_factor)
-
-        elif options.infiles[0].endswith(".bw"):
-            wigfiles = [BigWigFile(file=open(x)) for x in options.infiles]
-            range_counter = _bam2geneprofile.RangeCounterBigWig(wigfiles)
-
-        else:
-            raise NotImplementedError(
-                "can't determine file type for %s" % str(options.infiles))
-
-    counters = []
-    for method in options.methods:
-        if method == "utrprofile":
-            counters.append(_bam2geneprofile.UTRCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_upstream_utr,
-                options.resolution_cds,
-                options.resolution_downstream_utr,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream,
-            ))
-
-        elif method == "geneprofile":
-            counters.append(_bam2geneprofile.GeneCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_cds,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream,
-                options.scale_flanks))
-
-        elif method == "geneprofilewithintrons":
-            counters.append(_bam2geneprofile.GeneCounterWithIntrons(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_cds,
-                options.resolution_introns,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream,
-                options.scale_flanks))
-
-        elif method == "geneprofileabsolutedistancefromthreeprimeend":
-            # options.extension_exons_absolute_distance_tostartsite,
-            # options.extension_introns_absolute_distance_tostartsite,
-            # Tim 31th Aug 2013: a possible feature for future,  if five prime
-            # bias is of your interest.
-            # (you need to create another class). It is not very difficult to
-            # derive from this class, but is not implemented yet
-            # This future feature is slightly different the TSS profile
-            # already implemented, because in this future feature introns are
-            # skipped,
-            counters.append(
-                _bam2geneprofile.GeneCounterAbsoluteDistanceFromThreePrimeEnd(
-                    range_counter, options.resolution_upstream,
-                    options.resolution_downstream,
-                    options.resolution_exons_absolute_distance_topolya,
-                    options.resolution_introns_absolute_distance_topolya,
-                    options.extension_upstream,
-                    options.extension_downstream,
-                    options.extension_exons_absolute_distance_topolya,
-                    options.extension_introns_absolute_distance_topolya,
-                    options.scale_flanks))
-
-        elif method == "tssprofile":
-            counters.append(_bam2geneprofile.TSSCounter(
-                range_counter,
-                options.extension_outward,
-                options.extension_inward))
-
-        elif method == "intervalprofile":
-            counters.append(_bam2geneprofile.RegionCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_cds,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
+        gtf_iterator = GTF.transcript_iterator(gtf_entries)
 
-        elif method == "midpointprofile":
-            counters.append(_bam2geneprofile.MidpointCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
+    range_counter = buildRangeCounter(options)
+    counters = buildCounters(options, range_counter)
 
-        # add new method to split 1st and last exons out
-        # requires a representative transcript for reach gene
-        # gtf should be sorted gene-position
-        elif method == "separateexonprofile":
-            counters.append(_bam2geneprofile.SeparateExonCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_first,
-                options.resolution_last,
-                options.resolution_cds,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
-
-        elif method == "separateexonprofilewithintrons":
-            counters.append(_bam2geneprofile.SeparateExonWithIntronCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_first,
-                options.resolution_last,
-                options.resolution_cds,
-                options.resolution_introns,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
-
-    # set normalization
+    # set output of individual profiles
     for c in counters:
-        c.setNormalization(options.transcript_normalization)
         if options.output_all_profiles:
             c.setOutputProfiles(IOTools.open_file(E.getOutputFile(c.name) +
                                                  ".profiles.tsv.gz", "w"))
@@ -811,8 +950,11 @@ def main(argv=None):
 
     else:
         E.info("starting counting with %i counters" % len(counters))
-        feature_names = _bam2geneprofile.countFromGTF(counters,
-                                                      gtf_iterator)
+        if options.threads > 1:
+            countInParallel(options, range_counter, counters, gtf_iterator)
+        else:
+            feature_names = _bam2geneprofile.countFromGTF(counters,
+                                                          gtf_iterator)
 
     # output matrices
     if not options.profile_normalizations:
@@ -100,9 +100,13 @@ Supplying a fastq file
 ++++++++++++++++++++++
 
 If a fastq file is supplied (``--fastq-file``), the script will
-compute some additional summary statistics. However, as it builds a dictionary
-of all sequences, it will also require a good  amount of memory. The additional
-metrics output are:
+compute some additional summary statistics. Read names are not kept
+in memory. Instead, each name is stored as two independent hash values
+of 64 and 32 bits in a compact hash table, which requires about 40
+bytes of memory per read. Two different names with identical hash
+values would be counted as the same read. For n reads the probability
+of this is about n * n / 2 ** 97, less than 1e-9 for 10 billion reads.
+The additional metrics output are:
 
 +-----------------------------+----------------------------------------+
 |*Category*                   |*Content*                               |
@@ -138,6 +142,18 @@ Note that for paired-end data, any ``\1`` or ``/2`` suffixes will be
 removed from the read name in the assumption that these have been removed
 in the bam file as well.
 
+Parallel processing
++++++++++++++++++++
+
+With ``--threads`` larger than 1, an indexed bam file given on the
+command line is split into shards of ``--shard-size`` bases plus a
+shard with the unplaced unmapped reads. Shards are counted in parallel
+and the counts are merged. The read name index of ``--fastq-file``
+is kept in shared memory, and per read counts are returned only for
+the reads in each shard. The output is the same as when counting in a
+single thread. For input from stdin or without an index, the threads
+are used to decompress the bam file.
+
 Usage
 -----
 
@@ -392,7 +408,17 @@ def main(argv=None):
         "-q", "--fastq-file", dest="filename_fastq",
         help="filename with sequences and quality scores. This file is only "
         "used to collect sequence identifiers. Thus, for paired end data a "
-        "single file is sufficient [%default]")
+        "single file is sufficient. Read names are matched by 96-bit hash "
+        "values, so two different names are counted as one read with a "
+        "probability of less than 1e-9 for 10 billion reads [%default]")
+
+    parser.add_option(
+        "--threads", dest="threads", type="int",
+        help="number of threads to use [%default]")
+
+    parser.add_option(
+        "--shard-size", dest="shard_size", type="int",
+        help="size of shards in bases for parallel counting [%default]")
 
     parser.set_defaults(
         filename_rna=None,
@@ -401,6 +427,8 @@ def main(argv=None):
         force_output=False,
         filename_fastq=None,
         output_details=False,
+        threads=1,
+        shard_size=10000000,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -413,11 +441,14 @@ def main(argv=None):
         rna = None
 
     if len(args) > 0:
-        pysam_in = pysam.AlignmentFile(args[0], "rb")
+        pysam_in = pysam.AlignmentFile(args[0], "rb",
+                                       threads=options.threads)
     elif options.stdin == sys.stdin:
-        pysam_in = pysam.AlignmentFile("-", "rb")
+        pysam_in = pysam.AlignmentFile("-", "rb",
+                                       threads=options.threads)
     else:
-        pysam_in = pysam.AlignmentFile(options.stdin, "rb")
+        pysam_in = pysam.AlignmentFile(options.stdin, "rb",
+                                       threads=options.threads)
 
     if options.output_details:
         outfile_details = E.openOutputFile("details", "w")
@@ -433,7 +464,10 @@ def main(argv=None):
                          options.remove_rna,
                          rna,
                          filename_fastq=options.filename_fastq,
-                         outfile_details=outfile_details)
+                         outfile_details=outfile_details,
+                         threads=options.threads,
+                         shard_size=options.shard_size,
+                         filename_rna=options.filename_rna)
 
     if max_hi > 0 and max_hi != max(nh_all.keys()):
         E.warn("max_hi(%i) is inconsistent with max_nh (%i) "
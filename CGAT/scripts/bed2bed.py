@@ -151,11 +151,9 @@ Command line options
 
 import sys
 import CGATCore.Experiment as E
-import CGAT.IndexedFasta as IndexedFasta
 import CGAT.Bed as Bed
 import CGAT.Intervals as Intervals
 from collections import defaultdict as defaultdict
-import pysam
 
 
 def filterNames(iterator, names):
@@ -555,11 +553,15 @@ def main(argv=sys.argv):
     contigs = None
 
     # Why provide full indexed genome, when a tsv of contig sizes would do?
+    # genome and bam file modules are imported only when needed
+    # to keep start-up fast
     if options.genome_file:
+        import CGAT.IndexedFasta as IndexedFasta
         genome_fasta = IndexedFasta.IndexedFasta(options.genome_file)
         contigs = genome_fasta.getContigSizes()
 
     if options.bam_file:
+        import pysam
         samfile = pysam.AlignmentFile(options.bam_file)
         contigs = dict(list(zip(samfile.references, samfile.lengths)))
 
@@ -39,10 +39,18 @@ Then output.tsv will look like::
 Options
 -------
 
-The only option other than the standard cgat options is -i, --bed-file this
-allows the input files to be provided as a comma seperated list to the option
-rather than a space delimited set of positional arguements. It is present
-purely for galaxy compatibility.
+The bed files are merged in a single pass and need to be sorted by
+contig and start position, for example with ``sort -k1,1 -k2,2n``
+or ``bedtools sort``. Bed files that have been indexed with tabix are
+read contig by contig and need not be sorted. Both ``.tbi`` and
+``.csi`` indices are recognized. Unsorted files can be sorted in
+memory with the ``--sort-input`` option.
+
+Intervals that overlap or are book-ended are merged.
+
+The option -i, --bed-file allows the input files to be provided as a
+comma seperated list to the option rather than a space delimited set of
+positional arguements. It is present purely for galaxy compatibility.
 
 Usage
 -----
@@ -53,19 +61,94 @@ Command line options
 --------------------
 
 '''
-import tempfile
+import os
 import sys
-
-try:
-    import pybedtools
-except ImportError:
-    pass
+import heapq
+import pysam
 
 import CGATCore.Experiment as E
-import CGAT.Bed as Bed
-import collections
 import CGATCore.IOTools as IOTools
-import CGAT.IndexedGenome as IndexedGenome
+
+
+def iterateIntervals(filename, sample):
+    '''iterate over intervals in bed file *filename*.
+
+    Yields tuples of (contig, start, end, sample).
+    '''
+    with IOTools.open_file(filename) as inf:
+        for line in inf:
+            if line.startswith(("#", "track", "browser")) or \
+               not line.strip():
+                continue
+            data = line[:-1].split("\t", 3)
+            yield data[0], int(data[1]), int(data[2]), sample
+
+
+def iterateIndexedIntervals(filename, sample, index=None):
+    '''iterate over intervals in tabix indexed bed file *filename*
+    in sorted order.'''
+    tabixfile = pysam.TabixFile(filename, index=index)
+    for contig in sorted(tabixfile.contigs):
+        for data in tabixfile.fetch(contig, parser=pysam.asTuple()):
+            yield contig, int(data[1]), int(data[2]), sample
+    tabixfile.close()
+
+
+def checkSorted(intervals, filename):
+    '''pass through *intervals* and raise a ValueError if they are
+    not sorted by contig and start position.'''
+    last_contig, last_start = None, 0
+    for interval in intervals:
+        contig, start = interval[0], interval[1]
+        if contig == last_contig:
+            if start < last_start:
+                raise ValueError(
+                    "%s is not sorted: %s:%i after %s:%i, please sort the "
+                    "file or use --sort-input" %
+                    (filename, contig, start, contig, last_start))
+        elif last_contig is not None and contig < last_contig:
+            raise ValueError(
+                "%s is not sorted: contig %s after %s, please sort the "
+                "file or use --sort-input" %
+                (filename, contig, last_contig))
+        last_contig, last_start = contig, start
+        yield interval
+
+
+def openSample(filename, sample, sort_input=False):
+    '''return an iterator over the sorted intervals in *filename*.'''
+    for suffix in (".tbi", ".csi"):
+        if os.path.exists(filename + suffix):
+            return iterateIndexedIntervals(filename, sample,
+                                           filename + suffix)
+
+    intervals = iterateIntervals(filename, sample)
+    if sort_input:
+        return iter(sorted(intervals))
+    return checkSorted(intervals, filename)
+
+
+def mergeIntervals(intervals):
+    '''merge sorted *intervals* from several samples.
+
+    Yields tuples of (contig, start, end, count) for each merged
+    interval, where count is the number of samples with an interval
+    in the merged interval.
+    '''
+    last_contig, last_start, last_end = None, 0, 0
+    samples = set()
+    for contig, start, end, sample in intervals:
+        if contig != last_contig or start > last_end:
+            if samples:
+                yield last_contig, last_start, last_end, len(samples)
+            last_contig, last_start, last_end = contig, start, end
+            samples = set()
+        elif end > last_end:
+            last_end = end
+        samples.add(sample)
+
+    if samples:
+        yield last_contig, last_start, last_end, len(samples)
 
 
 def main(argv=None):
@@ -87,7 +170,13 @@ def main(argv=None):
         help="supply list of bed files",
         action="append")
 
-    parser.set_defaults(infiles=[])
+    parser.add_option(
+        "--sort-input", dest="sort_input", action="store_true",
+        help="sort bed files that are not indexed in memory "
+        "[default=%default]")
+
+    parser.set_defaults(infiles=[],
+                        sort_input=False)
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.start(parser, argv=argv)
@@ -96,55 +185,20 @@ def main(argv=None):
     if len(options.infiles) == 0:
         raise ValueError('please provide at least 1 bed file')
 
-    E.info("concatenating bed files")
-    # concatenate the list of files
-    tmp = tempfile.NamedTemporaryFile(delete=False, mode="w")
-    tmp_merge = tempfile.NamedTemporaryFile(delete=False, mode="w")
-    infs = options.infiles
-    for inf in infs:
-        for bed in Bed.iterator(IOTools.open_file(inf)):
-            tmp.write("%s\n" % bed)
-    tmp.close()
-
-    E.info("merging bed entries")
-    # merge the bed entries in the file
-    name = tmp.name
-    tmp_bed = pybedtools.BedTool(name)
-    tmp_bed.sort().merge().saveas(tmp_merge.name)
-    tmp_merge.close()
-
-    E.info("indexing bed entries")
-    # index the bed entries
-    merged = IndexedGenome.Simple()
-    for bed in Bed.iterator(IOTools.open_file(tmp_merge.name)):
-        merged.add(bed.contig, bed.start, bed.end)
-
-    counts = collections.defaultdict(int)
-    # list of samples
-    samples = options.infiles
-
-    E.info("counting no. samples overlapping each interval")
-    for sample in samples:
-        found = set()
-        for bed in Bed.iterator(IOTools.open_file(sample)):
-            if merged.contains(bed.contig, bed.start, bed.end):
-                key = [bed.contig] + \
-                    [x for x in merged.get(bed.contig, bed.start, bed.end)]
-                key = (key[0], key[1][0], key[1][1])
-                if key in found:
-                    continue
-                found.add(key)
-
-                # tuple of interval description as key - (contig, start, end)
-                counts[key] += 1
-
-    # open outfile
+    E.info("merging %i bed files" % len(options.infiles))
+    intervals = heapq.merge(
+        *[openSample(filename, sample, options.sort_input)
+          for sample, filename in enumerate(options.infiles)])
+
     options.stdout.write("contig\tstart\tend\tcount\n")
 
-    E.info("outputting result")
-    for interval, count in sorted(counts.items()):
-        options.stdout.write(
-            "\t".join(map(str, interval)) + "\t" + str(count) + "\n")
+    noutput = 0
+    for contig, start, end, count in mergeIntervals(intervals):
+        options.stdout.write("%s\t%i\t%i\t%i\n" %
+                             (contig, start, end, count))
+        noutput += 1
+
+    E.info("output %i merged intervals" % noutput)
 
     # write footer and output benchmark information.
     E.stop()
@@ -18,8 +18,15 @@ tab-delimited file of kmer counts::
 
 where n is the kmer and contig is the fasta entry.
 
-The user specifies the kmer length that is to be searched. Note that the longer
-the kmer, the longer the script will take to run.
+The user specifies the kmer length that is to be searched. K-mers
+are counted in a single pass over each sequence. Occurrences of a
+k-mer are counted without overlap, i.e., ``AAA`` occurs once in
+``AAAAA``. K-mers containing characters other than upper-case
+``ACGT`` are ignored.
+
+For k-mers up to a length of 8, all possible k-mers are output. For
+longer k-mers (up to 31), only k-mers that have been observed in
+at least one sequence are output.
 
 Note the order of output will not necessarily be the same order as the input.
 
@@ -68,8 +75,7 @@ each four base combination out of the total tetranucleotide occurences.
 
 Options
 -------
-Two options control the behaviour of fasta2kmercontent.py; ``--kmer-size`` and
-``--output-proportion``.
+The following options control the behaviour of fasta2kmercontent.py:
 
 ``--kmer-size``::
   The kmer length to count over in the input fasta file
@@ -77,6 +83,14 @@ Two options control the behaviour of fasta2kmercontent.py; ``--kmer-size`` and
 ``--output-proportion``::
   The output values are proportions rather than absolute counts
 
+``--canonical``::
+  Collapse each k-mer and its reverse complement into a single
+  count reported for the lexicographically smaller of the two.
+
+``--num-threads``::
+  Count k-mers in multiple processes, each processing a subset
+  of the sequences.
+
 
 Type::
 
@@ -91,11 +105,126 @@ Command line options
 '''
 
 import sys
-import re
+import multiprocessing
+import numpy
 import CGAT.FastaIterator as FastaIterator
-import itertools
 import CGATCore.Experiment as E
 
+# maximum kmer size for which counts are kept in a dense array
+# containing all possible kmers.
+MAX_DENSE_KMER = 8
+
+# maximum kmer size so that kmers fit into 64 bits
+MAX_KMER = 31
+
+NUCLEOTIDES = "ACGT"
+
+# map upper-case nucleotides to 2-bit codes. Other characters
+# are marked as invalid.
+ENCODE = numpy.empty(256, dtype=numpy.int8)
+ENCODE.fill(-1)
+for _x, _c in enumerate(NUCLEOTIDES):
+    ENCODE[ord(_c)] = _x
+
+
+def decode(code, kmer):
+    """return kmer string for 2-bit packed *code*."""
+    return "".join(NUCLEOTIDES[(code >> (2 * (kmer - x - 1))) & 3]
+                   for x in range(kmer))
+
+
+def reverse_complement_codes(codes, kmer):
+    """return codes of the reverse complement of kmer *codes*."""
+    codes = numpy.asarray(codes, dtype=numpy.uint64)
+    # complement: A<->T, C<->G is 3 - x
+    rc = numpy.zeros(len(codes), dtype=numpy.uint64)
+    for x in range(kmer):
+        rc = (rc << numpy.uint64(2)) | \
+            (numpy.uint64(3) - ((codes >> numpy.uint64(2 * x)) &
+                                numpy.uint64(3)))
+    return rc
+
+
+def get_kmer_positions(sequence, kmer):
+    """return positions and codes of all valid kmers in *sequence*.
+
+    A kmer is valid if it contains only the characters ACGT.
+    """
+    s = ENCODE[numpy.frombuffer(sequence.encode("ascii"), dtype=numpy.uint8)]
+    nkmers = len(s) - kmer + 1
+    if nkmers <= 0:
+        return (numpy.zeros(0, dtype=numpy.int64),
+                numpy.zeros(0, dtype=numpy.uint64))
+
+    # a kmer is valid if its window does not contain invalid characters
+    invalid = numpy.concatenate(([0], numpy.cumsum(s < 0)))
+    valid = (invalid[kmer:] - invalid[:-kmer]) == 0
+
+    s = numpy.where(s < 0, 0, s).astype(numpy.uint64)
+    codes = numpy.zeros(nkmers, dtype=numpy.uint64)
+    for x in range(kmer):
+        codes = (codes << numpy.uint64(2)) | s[x:x + nkmers]
+
+    positions = numpy.flatnonzero(valid)
+    return positions, codes[positions]
+
+
+def count_kmers(sequence, kmer):
+    """count non-overlapping occurrences of all kmers in *sequence*.
+
+    Returns a tuple of sorted unique kmer codes and their counts.
+    """
+    positions, codes = get_kmer_positions(sequence, kmer)
+    if len(codes) == 0:
+        return codes, numpy.zeros(0, dtype=numpy.int64)
+
+    # group positions by kmer
+    order = numpy.argsort(codes, kind="mergesort")
+    codes, positions = codes[order], positions[order]
+    first = numpy.concatenate(
+        ([0], numpy.flatnonzero(numpy.diff(codes)) + 1))
+    counts = numpy.diff(numpy.append(first, len(codes)))
+
+    # occurrences of the same kmer closer than kmer positions overlap.
+    # Only runs of overlapping occurrences need to be resolved, which
+    # is done greedily from the left.
+    overlap = (numpy.diff(positions) < kmer) & (numpy.diff(codes) == 0)
+    if overlap.any():
+        edges = numpy.flatnonzero(numpy.diff(
+            numpy.concatenate(([0], overlap, [0])).astype(numpy.int8)))
+        run_starts, run_ends = edges[::2], edges[1::2] + 1
+        groups = numpy.searchsorted(first, run_starts, side="right") - 1
+        for start, end, group in zip(run_starts, run_ends, groups):
+            n, last = 0, -kmer
+            for pos in positions[start:end].tolist():
+                if pos >= last + kmer:
+                    n += 1
+                    last = pos
+            counts[group] -= end - start - n
+
+    return codes[first], counts
+
+
+def count_sequence(args):
+    """count kmers in a single sequence, see :func:`count_kmers`.
+
+    This function is the unit of work for parallel counting.
+    """
+    title, sequence, kmer = args
+    codes, counts = count_kmers(sequence, kmer)
+    return title, codes, counts
+
+
+def collapse_canonical(codes, counts, kmer):
+    """collapse kmers and their reverse complements.
+
+    Counts are added to the lexicographically smaller kmer.
+    """
+    canonical = numpy.minimum(codes, reverse_complement_codes(codes, kmer))
+    codes, inverse = numpy.unique(canonical, return_inverse=True)
+    return codes, numpy.bincount(inverse, weights=counts,
+                                 minlength=len(codes)).astype(numpy.int64)
+
 
 def main(argv=None):
     """script main.
@@ -117,46 +246,76 @@ def main(argv=None):
         "-p", "--output-proportion", dest="proportion", action="store_true",
         help="output proportions - overides the default output")
 
+    parser.add_option(
+        "--canonical", dest="canonical", action="store_true",
+        help="collapse kmers with their reverse complement "
+        "[default=%default]")
+
+    parser.add_option(
+        "--num-threads", dest="num_threads", type="int",
+        help="number of processes to use for counting "
+        "[default=%default]")
+
+    parser.set_defaults(
+        canonical=False,
+        num_threads=1)
+
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.start(parser, argv=argv)
 
-    # do not allow greater than octonucleotide
-    assert options.kmer <= 8, "cannot handle kmer of length %i" % options.kmer
+    kmer = options.kmer
+    if kmer is None or kmer < 1 or kmer > MAX_KMER:
+        raise ValueError("kmer size needs to be between 1 and %i, got %s" %
+                         (MAX_KMER, kmer))
 
-    # how we deal with the nucleotides depends on the kmer length
-    nucleotides = []
-    for nucleotide in ["A", "C", "T", "G"]:
-        nucleotides = nucleotides + \
-            [x for x in itertools.repeat(nucleotide, options.kmer)]
+    E.info("matching %imers in file" % kmer)
+    # count the number of kmers in each sequence
 
-    E.info("retrieving %imer sequences" % options.kmer)
-    # get all kmer sequences to query
-    kmers = set()
-    for kmer in itertools.permutations(nucleotides, options.kmer):
-        kmers.add(kmer)
+    work = ((fasta.title, fasta.sequence, kmer)
+            for fasta in FastaIterator.iterate(options.stdin))
 
-    E.info("matching %imers in file" % options.kmer)
-    # count the number of kmers in each sequence
+    if options.num_threads > 1:
+        pool = multiprocessing.Pool(options.num_threads)
+        results = pool.imap(count_sequence, work)
+    else:
+        pool = None
+        results = map(count_sequence, work)
 
     result = {}
-
     # NB assume that non fasta files are caught by FastaIterator
     total_entries = 0
-    for fasta in FastaIterator.iterate(options.stdin):
+    for title, codes, counts in results:
         total_entries += 1
-        result[fasta.title] = {}
-        for kmer in kmers:
-            counts = [m.start()
-                      for m in re.finditer("".join(kmer), fasta.sequence)]
-            result[fasta.title][kmer] = len(counts)
+        if options.canonical:
+            codes, counts = collapse_canonical(codes, counts, kmer)
+        result[title] = (codes, counts)
+
+    if pool:
+        pool.close()
+        pool.join()
 
     E.info("writing results")
-    # write out the results
     headers = sorted(result.keys())
-    rows = set()
-    for kmer_counts in list(result.values()):
-        for kmer, count in kmer_counts.items():
-            rows.add("".join(kmer))
+
+    # build matrix of counts with rows for kmers and columns for sequences
+    if kmer <= MAX_DENSE_KMER and headers:
+        rows = numpy.arange(4 ** kmer, dtype=numpy.uint64)
+        if options.canonical:
+            rows = numpy.unique(numpy.minimum(
+                rows, reverse_complement_codes(rows, kmer)))
+    else:
+        rows = numpy.unique(numpy.concatenate(
+            [result[header][0] for header in headers] +
+            [numpy.zeros(0, dtype=numpy.uint64)]))
+
+    matrix = numpy.zeros((len(rows), len(headers)), dtype=numpy.int64)
+    for column, header in enumerate(headers):
+        codes, counts = result[header]
+        matrix[numpy.searchsorted(rows, codes), column] = counts
+
+    # output in lexicographic order of kmers
+    labels = [decode(int(x), kmer) for x in rows]
+    order = sorted(range(len(labels)), key=lambda x: labels[x])
 
     # write header row
     options.stdout.write("kmer\t" + "\t".join(headers) + "\n")
@@ -164,17 +323,18 @@ def main(argv=None):
     # output proportions if required - normalises by
     # sequence length
     E.info("computing total counts")
-    totals = {}
-    for header in headers:
-        totals[header] = sum([result[header][tuple(row)] for row in rows])
+    totals = [int(x) for x in matrix.sum(axis=0)]
 
-    for row in sorted(rows):
+    for row in order:
+        values = [int(x) for x in matrix[row]]
         if options.proportion:
             options.stdout.write("\t".join(
-                [row] + [str(float(result[header][tuple(row)]) / totals[header]) for header in headers]) + "\n")
+                [labels[row]] + [str(float(value) / total)
+                                 for value, total in zip(values, totals)]) +
+                "\n")
         else:
             options.stdout.write(
-                "\t".join([row] + [str(result[header][tuple(row)]) for header in headers]) + "\n")
+                "\t".join([labels[row]] + [str(x) for x in values]) + "\n")
 
     E.info("written kmer counts for %i contigs" % total_entries)
     # write footer and output benchmark information.
@@ -25,7 +25,28 @@ reads might be missing from one file but not the other. The reconcile
 method will output two files containing only reads that are common to
 both files.
 
-The two files must be sorted by read identifier.
+Three strategies are available to find the common reads
+(``--reconcile-method``):
+
+set
+   Read identifiers of the first file are kept in memory as a
+   python set. The files do not need to be sorted.
+
+hashed
+   Read identifiers are kept as 64-bit fingerprints in a sorted
+   numpy array, which requires 8 bytes per read in the first file.
+   The files do not need to be sorted. Both files are read twice.
+   Fingerprints are hashes of the identifiers, so there is a
+   very small chance that reads without a mate are output.
+
+sorted
+   Both files are read once in parallel and matching reads are
+   output immediately. This requires very little memory, but both
+   files must be sorted by read identifier in the same
+   lexicographical order, for example by ``LC_ALL=C sort``.
+   Unpaired reads from both files are output in the order they
+   are encountered. If a file turns out not to be sorted, the
+   script stops with an error and removes the partial output.
 
 Example input, read2 and read3 are only present in either of the
 files:
@@ -84,8 +105,11 @@ Command line options
 
 '''
 
+import os
 import sys
 import re
+import itertools
+import numpy
 import CGATCore.IOTools as IOTools
 import CGATCore.Experiment as E
 
@@ -103,6 +127,224 @@ def plain_getter(id):
     return id
 
 
+def iterateRecords(infile, id_getter=plain_getter, chop=False,
+                   chunk_size=1000000):
+    '''iterate over fastq records in *infile*.
+
+    The file is read in chunks of lines of about *chunk_size*
+    bytes. If *chop* is set, the last character is removed
+    from the read identifier.
+
+    Yields tuples of the read identifier and a list of the four
+    lines of the record without line endings.
+    '''
+    lines = []
+    while True:
+        chunk = infile.readlines(chunk_size)
+        if not chunk:
+            break
+        lines.extend(chunk)
+        n = len(lines) - len(lines) % 4
+        for x in range(0, n, 4):
+            record = [l.rstrip("\r\n") for l in lines[x:x + 4]]
+            r = id_getter(record[0].split()[0])
+            if chop:
+                r = r[:-1]
+            yield r, record
+        del lines[:n]
+
+    if [l for l in lines if l.strip()]:
+        raise ValueError(
+            "incomplete fastq record at end of file: %s" % lines[0])
+
+
+def iterateChunks(infile, id_getter=plain_getter, chop=False,
+                  chunk_size=100000):
+    '''iterate over fastq records in *infile* in chunks of
+    *chunk_size* records.
+
+    Yields tuples of a list of read identifiers and a list of records.
+    '''
+    records = iterateRecords(infile, id_getter, chop)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        yield [x[0] for x in chunk], [x[1] for x in chunk]
+
+
+def getFingerprints(ids):
+    '''return an array of 64-bit fingerprints for *ids*.
+
+    The fingerprints are python hash values and are only
+    consistent within a process.
+    '''
+    return numpy.fromiter(map(hash, ids), numpy.int64, len(ids))
+
+
+def isMember(fingerprints, ids):
+    '''return a boolean array flagging *ids* with a fingerprint
+    in the sorted array *fingerprints*.'''
+    h = getFingerprints(ids)
+    if len(fingerprints) == 0:
+        return numpy.zeros(len(h), dtype=numpy.bool_)
+    x = numpy.searchsorted(fingerprints, h)
+    x[x == len(fingerprints)] = 0
+    return fingerprints[x] == h
+
+
+def writeRecords(infile, outfile, take, unpaired_file=None,
+                 id_getter=plain_getter, chop=False):
+    '''write records in *infile* to *outfile*.
+
+    *take* is a function that receives a list of read identifiers and
+    returns a list of flags whether the corresponding records should be
+    written. Other records are written to *unpaired_file*, if given.
+    '''
+    for ids, records in iterateChunks(infile, id_getter, chop):
+        for record, flag in zip(records, take(ids)):
+            if flag:
+                outfile.write("\n".join(record) + "\n")
+            elif unpaired_file is not None:
+                unpaired_file.write("\n".join(record) + "\n")
+
+
+def reconcileSet(fn1, fn2, outf1, outf2, unpaired_file, counter,
+                 id1_getter=plain_getter, id2_getter=plain_getter,
+                 chop=False):
+    '''reconcile reads keeping the identifiers of the first file
+    in a set.'''
+    E.info("reading first in pair")
+    ids1 = set()
+    with IOTools.open_file(fn1) as inf:
+        for r, record in iterateRecords(inf, id1_getter, chop):
+            ids1.add(r)
+            counter.input1 += 1
+
+    E.info("reading second in pair")
+    # do not keep the identifiers of the second file, but
+    # lazily evaluate the intersection. This leads to a large
+    # memory saving if the first file is small.
+    take = set()
+    with IOTools.open_file(fn2) as inf:
+        for r, record in iterateRecords(inf, id2_getter, chop):
+            if r in ids1:
+                take.add(r)
+            counter.input2 += 1
+    del ids1
+    counter.shared = len(take)
+
+    E.info("writing first in pair")
+    with IOTools.open_file(fn1) as inf:
+        writeRecords(inf, outf1,
+                     lambda ids: [x in take for x in ids],
+                     unpaired_file, id1_getter, chop)
+    E.info("writing second in pair")
+    with IOTools.open_file(fn2) as inf:
+        writeRecords(inf, outf2,
+                     lambda ids: [x in take for x in ids],
+                     unpaired_file, id2_getter, chop)
+
+
+def reconcileHashed(fn1, fn2, outf1, outf2, unpaired_file, counter,
+                    id1_getter=plain_getter, id2_getter=plain_getter,
+                    chop=False):
+    '''reconcile reads keeping fingerprints of the read identifiers
+    of the first file in a sorted array.'''
+    E.info("reading first in pair")
+    chunks = []
+    with IOTools.open_file(fn1) as inf:
+        for ids, records in iterateChunks(inf, id1_getter, chop):
+            chunks.append(numpy.unique(getFingerprints(ids)))
+            counter.input1 += len(ids)
+    ids1 = numpy.unique(numpy.concatenate(chunks))
+    del chunks
+
+    E.info("reading second in pair")
+    chunks = []
+    with IOTools.open_file(fn2) as inf:
+        for ids, records in iterateChunks(inf, id2_getter, chop):
+            chunks.append(getFingerprints(ids)[isMember(ids1, ids)])
+            counter.input2 += len(ids)
+    del ids1
+    take = numpy.unique(numpy.concatenate(chunks))
+    del chunks
+    counter.shared = len(take)
+
+    E.info("writing first in pair")
+    with IOTools.open_file(fn1) as inf:
+        writeRecords(inf, outf1,
+                     lambda ids: isMember(take, ids),
+                     unpaired_file, id1_getter, chop)
+    E.info("writing second in pair")
+    with IOTools.open_file(fn2) as inf:
+        writeRecords(inf, outf2,
+                     lambda ids: isMember(take, ids),
+                     unpaired_file, id2_getter, chop)
+
+
+def reconcileSorted(fn1, fn2, outf1, outf2, unpaired_file, counter,
+                    id1_getter=plain_getter, id2_getter=plain_getter,
+                    chop=False):
+    '''reconcile reads in a single pass through two files sorted
+    by read identifier.'''
+
+    def _iterate(fn, id_getter):
+        last = None
+        with IOTools.open_file(fn) as inf:
+            for r, record in iterateRecords(inf, id_getter, chop):
+                if last is not None and r < last:
+                    raise ValueError(
+                        "%s is not sorted by read identifier: %s after %s "
+                        "- sort the file or use --reconcile-method=hashed" %
+                        (fn, r, last))
+                last = r
+                yield r, record
+
+    def _unpaired(record):
+        if unpaired_file is not None:
+            unpaired_file.write("\n".join(record) + "\n")
+
+    E.info("reading both files")
+    iter1 = _iterate(fn1, id1_getter)
+    iter2 = _iterate(fn2, id2_getter)
+    try:
+        r1, record1 = next(iter1, (None, None))
+        r2, record2 = next(iter2, (None, None))
+
+        while r1 is not None and r2 is not None:
+            if r1 == r2:
+                outf1.write("\n".join(record1) + "\n")
+                outf2.write("\n".join(record2) + "\n")
+                counter.shared += 1
+                counter.input1 += 1
+                counter.input2 += 1
+                r1, record1 = next(iter1, (None, None))
+                r2, record2 = next(iter2, (None, None))
+            elif r1 < r2:
+                _unpaired(record1)
+                counter.input1 += 1
+                r1, record1 = next(iter1, (None, None))
+            else:
+                _unpaired(record2)
+                counter.input2 += 1
+                r2, record2 = next(iter2, (None, None))
+
+        while r1 is not None:
+            _unpaired(record1)
+            counter.input1 += 1
+            r1, record1 = next(iter1, (None, None))
+
+        while r2 is not None:
+            _unpaired(record2)
+            counter.input2 += 1
+            r2, record2 = next(iter2, (None, None))
+    finally:
+        # close the input files if reading stopped early
+        iter1.close()
+        iter2.close()
+
+
 def main(argv=None):
     """script main.
 
@@ -120,6 +362,12 @@ def main(argv=None):
                       choices=('reconcile',),
                       help="method to apply [default=%default].")
 
+    parser.add_option(
+        "--reconcile-method", dest="reconcile_method", type="choice",
+        choices=("set", "hashed", "sorted"),
+        help="method to find reads common to both files. See the "
+        "documentation for details [default=%default].")
+
     parser.add_option(
         "-c", "--chop-identifier", dest="chop", action="store_true",
         help="whether or not to trim last character of the  "
@@ -151,6 +399,7 @@ def main(argv=None):
 
     parser.set_defaults(
         method="reconcile",
+        reconcile_method="set",
         chop=False,
         unpaired=False,
         output_pattern="%s.fastq.gz",
@@ -164,7 +413,7 @@ def main(argv=None):
             "please supply at least two fastq files on the commandline")
 
     fn1, fn2 = args
-    c = E.Counter()
+    counter = E.Counter()
 
     if options.id_pattern_1:
         id1_getter = PatternGetter(options.id_pattern_1)
@@ -178,83 +427,54 @@ def main(argv=None):
 
     if options.method == "reconcile":
 
-        # IMS: switching to no store second set of read names and only use
-        # lazily. Since generators don't have a size must keep track
-        id_lengths = {fn1: 0, fn2: 0}
-
-        def getIds(infile, id_getter=plain_getter):
-            '''return ids in infile.'''
-            aread = infile.readline
-            while True:
-                l = [aread().rstrip("\r\n") for i in range(4)]
-                if not l[0]:
-                    break
-                r = id_getter(l[0].split()[0])
-                # decide if to chop read number off
-                id_lengths[infile.name] += 1
-                if options.chop:
-                    yield r[:-1]
-                else:
-                    yield r
-
-        def write(outfile, infile, take, unpaired_file=None,
-                  id_getter=plain_getter):
-            '''filter fastq files with ids in take.'''
-            aread = infile.readline
-            while True:
-                l = [aread().rstrip("\r\n") for i in range(4)]
-                if not l[0]:
-                    break
-                r = id_getter(l[0].split()[0])
-                if options.chop:
-                    r = r[:-1]
-                if r not in take:
-                    if unpaired_file is None:
-                        continue
-                    else:
-                        unpaired_file.write("\n".join(l) + "\n")
-                else:
-                    outfile.write("\n".join(l) + "\n")
-
-        E.info("reading first in pair")
-        inf1 = IOTools.open_file(fn1)
-        ids1 = set(getIds(inf1, id1_getter))
-
-        E.info("reading second in pair")
-        inf2 = IOTools.open_file(fn2)
-        # IMS: No longer keep as a set, but lazily evaluate into intersection
-        # leads to large memory saving for large inf2, particularly if
-        # inf1 is small.
-        ids2 = getIds(inf2, id2_getter)
-        take = ids1.intersection(ids2)
-
-        E.info("first pair: %i reads, second pair: %i reads, "
-               "shared: %i reads" %
-               (id_lengths[fn1],
-                id_lengths[fn2],
-                len(take)))
-
         if options.unpaired:
-            unpaired_filename = IOTools.open_file(
+            unpaired_file = IOTools.open_file(
                 options.output_pattern % "unpaired", "w")
         else:
-            unpaired_filename = None
+            unpaired_file = None
 
-        with IOTools.open_file(options.output_pattern % "1", "w") as outf:
-            inf = IOTools.open_file(fn1)
-            E.info("writing first in pair")
-            write(outf, inf, take, unpaired_filename, id1_getter)
+        outfiles = [options.output_pattern % "1",
+                    options.output_pattern % "2"]
+        if options.unpaired:
+            outfiles.append(options.output_pattern % "unpaired")
+
+        outf1 = IOTools.open_file(outfiles[0], "w")
+        outf2 = IOTools.open_file(outfiles[1], "w")
+
+        if options.reconcile_method == "set":
+            reconcile = reconcileSet
+        elif options.reconcile_method == "hashed":
+            reconcile = reconcileHashed
+        elif options.reconcile_method == "sorted":
+            reconcile = reconcileSorted
+
+        try:
+            reconcile(fn1, fn2, outf1, outf2, unpaired_file, counter,
+                      id1_getter, id2_getter, options.chop)
+        except Exception:
+            # do not leave partial output behind, for example if
+            # --reconcile-method=sorted finds an unsorted file.
+            for outf in (outf1, outf2, unpaired_file):
+                if outf is not None:
+                    outf.close()
+            for filename in outfiles:
+                if os.path.exists(filename):
+                    os.unlink(filename)
+            raise
 
-        with IOTools.open_file(options.output_pattern % "2", "w") as outf:
-            inf = IOTools.open_file(fn2)
-            E.info("writing second in pair")
-            write(outf, inf, take, unpaired_filename, id2_getter)
+        E.info("first pair: %i reads, second pair: %i reads, "
+               "shared: %i reads" %
+               (counter.input1,
+                counter.input2,
+                counter.shared))
 
+        outf1.close()
+        outf2.close()
         if options.unpaired:
-            unpaired_filename.close()
+            unpaired_file.close()
 
     # write footer and output benchmark information.
-    E.info("%s" % str(c))
+    E.info("%s" % str(counter))
     E.stop()
 
 if __name__ == "__main__":
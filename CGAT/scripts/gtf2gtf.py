@@ -1176,13 +1176,12 @@ def main(argv=None):
 
         for gffs in GTF.transcript_iterator(GTF.iterator(options.stdin)):
             ninput += 1
-            found = False
-            for e in gffs:
-                if index.contains(e.contig, e.start, e.end):
-                    found = True
-                    break
+            # query all features of a transcript at once
+            counts = index.countBatch(gffs[0].contig,
+                                      [e.start for e in gffs],
+                                      [e.end for e in gffs])
 
-            if found:
+            if counts.any():
                 ndiscarded += 1
             else:
                 noutput += 1
@@ -444,6 +444,17 @@ convention. A summary is `here
 For unstranded protocols, all reads and pairs are considered to matching
 in the sense direction.
 
+The reads of a gene are read from the :term:`bam` files once and
+kept in memory while all counters process the gene or its
+transcripts. The cache can be turned off with ``--no-read-cache``.
+
+Counting can be distributed over several processes with
+``--num-workers``. Gene models are sent to the worker processes in
+chunks of ``--chunk-size`` gene models, each chunk containing gene
+models from a single contig. Each worker opens its own genome, :term:`bam`,
+:term:`bigwig` and annotation files. The output is identical to that of a
+run with a single process.
+
 Usage
 -----
 
@@ -459,6 +470,8 @@ Command line options
 '''
 
 import sys
+import optparse
+import multiprocessing
 import pysam
 
 import CGATCore.Experiment as E
@@ -469,196 +482,12 @@ import CGAT.GeneModelAnalysis as GeneModelAnalysis
 import pyBigWig
 
 
-def main(argv=None):
-
-    parser = E.OptionParser(version="%prog version: $Id$",
-                            usage=globals()["__doc__"])
-
-    parser.add_option("-g", "--genome-file", dest="genome_file", type="string",
-                      help="filename with genome [default=%default].")
-
-    parser.add_option("-q", "--quality-file",
-                      dest="quality_file",
-                      type="string",
-                      help="filename with genomic base quality "
-                      "information [default=%default].")
+def buildCounters(options):
+    '''open input files and build the counters given in *options*.
 
-    parser.add_option("-b", "--bam-file", dest="bam_files",
-                      type="string", metavar="bam",
-                      help="filename with read mapping information. "
-                      "Multiple files can be submitted in a "
-                      "comma-separated list [default=%default].")
-
-    parser.add_option("-i", "--bigwig-file", dest="bigwig_file",
-                      type="string", metavar="bigwig",
-                      help="filename with bigwig information "
-                      "[default=%default].")
-
-    parser.add_option("-f", "--gff-file", dest="filename_gff",
-                      type="string", action="append", metavar='bed',
-                      help="filename with extra gff files. The order "
-                      "is important [default=%default].")
-
-    parser.add_option("--filename-format", dest="filename_format",
-                      type="choice",
-                      choices=("bed", "gff", "gtf"),
-                      help="format of secondary stream [default=%default].")
-
-    parser.add_option("--restrict-source", dest="gff_sources", type="string",
-                      action="append",
-                      help="restrict input to this 'source' in extra "
-                      "gff file (for counter: overlap) [default=%default].")
-
-    parser.add_option("--restrict-feature", dest="gff_features", type="string",
-                      action="append",
-                      help="restrict input to this 'feature' in extra gff "
-                      "file (for counter: overlap) [default=%default].")
-
-    parser.add_option("-r", "--reporter", dest="reporter", type="choice",
-                      choices=("genes", "transcripts"),
-                      help="report results for 'genes' or 'transcripts' "
-                      "[default=%default].")
-
-    parser.add_option("-s", "--section", dest="sections",
-                      type="choice",
-                      action="append",
-                      choices=("exons", "introns"),
-                      help="select range on which counters will operate "
-                      "[default=%default].")
-
-    parser.add_option("-c", "--counter", dest="counters",
-                      type="choice",
-                      action="append",
-                      choices=(	"bigwig-counts",
-                                "binding-pattern",
-                                "classifier",
-                                "classifier-rnaseq",
-                                "classifier-rnaseq-splicing",
-                                "classifier-polii",
-                                "composition-na",
-                                "composition-cpg",
-                                "coverage",
-                                "distance",
-                                "distance-genes",
-                                "distance-tss",
-                                "length",
-                                'neighbours',
-                                "overlap",
-                                "overlap-stranded",
-                                "overlap-transcripts",
-                                "overrun",
-                                "position",
-                                "proximity",
-                                "proximity-exclusive",
-                                "proximity-lengthmatched",
-                                "quality",
-                                "read-coverage",
-                                "read-extension",
-                                "read-overlap",
-                                "read-counts",
-                                "read-fullcounts",
-                                "readpair-counts",
-                                "readpair-fullcounts",
-                                "splice",
-                                "splice-comparison",
-                                "territories"),
-                      help="select counters to apply to input "
-                      "[default=%default].")
-
-    parser.add_option("--add-gtf-source", dest="add_gtf_source",
-                      action="store_true",
-                      help="add gtf field of source to output "
-                      "[default=%default].")
-
-    parser.add_option("--proximal-distance", dest="proximal_distance",
-                      type="int",
-                      help="distance to be considered proximal to "
-                      "an interval [default=%default].")
-
-    parser.add_option("--multi-mapping-method",
-                      dest="multi_mapping",
-                      type="choice",
-                      choices=('all', 'ignore', 'weight'),
-                      help="how to treat multi-mapping reads in "
-                      "bam-files. Requires "
-                      "the NH flag to be set by the mapper "
-                      "[default=%default].")
-
-    parser.add_option("--use-barcodes",
-                      dest="use_barcodes",
-                      action="store_true",
-                      help="Use barcodes to count unique umi's. "
-                      "UMI's are specified in the read identifier "
-                      "as the last field, where fields are separated "
-                      "by underscores, e.g. "
-                      "@READ:ILLUMINA:STUFF_NAMINGSTUFF_UMI. "
-                      "When true, unique counts are returned. "
-                      "Currently only compatible with count-reads")
-
-    parser.add_option("--sample-probability",
-                      dest="sample_probability",
-                      type="float",
-                      help="Specify the probability of whether any"
-                      "given read or read pair in a file bam is counted"
-                      "Currently only compatible with count-reads")
-
-    parser.add_option("--column-prefix", dest="prefixes",
-                      type="string",
-                      action="append",
-                      help="add prefix to column headers - prefixes "
-                      "are used in the same order as the counters "
-                      "[default=%default].")
-
-    parser.add_option("--library-type",
-                      dest="library_type",
-                      type="choice",
-                      choices=("unstranded",
-                               "firststrand",
-                               "secondstrand",
-                               "fr-unstranded",
-                               "fr-firststrand",
-                               "fr-secondstrand"),
-                      help="library type of reads in bam file. "
-                      "[default=%default]")
-
-    parser.add_option("--min-mapping-quality",
-                      dest="minimum_mapping_quality",
-                      type="float",
-                      help="minimum mapping quality. Reads with a quality "
-                      "score of less will be ignored. "
-                      "[default=%default]")
-
-    parser.set_defaults(
-        genome_file=None,
-        reporter="genes",
-        with_values=True,
-        sections=[],
-        counters=[],
-        filename_gff=[],
-        filename_format=None,
-        gff_features=[],
-        gff_sources=[],
-        add_gtf_source=False,
-        proximal_distance=10000,
-        bam_files=None,
-        multi_mapping='all',
-        library_type='fr-unstranded',
-        prefixes=[],
-        minimum_mapping_quality=0,
-        use_barcodes=False,
-        sample_probability=1.0
-    )
-
-    if not argv:
-        argv = sys.argv
-
-    (options, args) = E.start(parser, add_output_options=True, argv=argv)
-
-    if options.prefixes:
-        if len(options.prefixes) != len(options.counters):
-            raise ValueError(
-                "if any prefix is given, the number of prefixes "
-                "must be the same as the number of counters")
+    Returns a list of counters and a list of the bam files used
+    by the counters.
+    '''
 
     # get files
     if options.genome_file:
@@ -676,6 +505,9 @@ def main(argv=None):
         bam_files = []
         for bamfile in options.bam_files.split(","):
             bam_files.append(pysam.AlignmentFile(bamfile, "rb"))
+        if options.read_cache:
+            bam_files = [GeneModelAnalysis.CachedAlignmentFile(x)
+                         for x in bam_files]
     else:
         bam_files = None
 
@@ -686,17 +518,6 @@ def main(argv=None):
 
     counters = []
 
-    if not options.sections:
-        E.info("counters will use the default section (exons)")
-        options.sections.append(None)
-
-    if not options.gff_sources:
-        options.gff_sources.append(None)
-    if not options.gff_features:
-        options.gff_features.append(None)
-
-    cc = E.Counter()
-
     for n, c in enumerate(options.counters):
         if options.prefixes:
             prefix = options.prefixes[n]
@@ -900,45 +721,393 @@ def main(argv=None):
                 options=options,
                 prefix=prefix))
 
+    return counters, bam_files
+
+
+def countGeneModel(gffs, counters, options):
+    '''update *counters* with the gene model *gffs*.
+
+    Returns the output line or None if the gene model has been
+    skipped by all counters.
+    '''
+    for counter in counters:
+        counter.update(gffs)
+
+    if len([x for x in counters if x.skip]) == len(counters):
+        return None
+
+    if options.reporter == "genes":
+        fields = [gffs[0].gene_id]
+    else:
+        fields = [gffs[0].transcript_id]
+
+    if options.add_gtf_source:
+        fields.append(gffs[0].source)
+
+    return "\t".join(fields +
+                     [str(counter) for counter in counters]) + "\n"
+
+
+def iterateChunks(gtf_iterator, chunk_size):
+    '''group gene models into chunks of about *chunk_size* gene models.
+
+    A chunk contains gene models from a single contig only. Gene models
+    of the same gene are kept in the same chunk.
+    '''
+    chunk = []
+    for gffs in gtf_iterator:
+        if chunk:
+            last = chunk[-1][0]
+            if last.contig != gffs[0].contig or \
+               (len(chunk) >= chunk_size and
+                    last.gene_id != gffs[0].gene_id):
+                yield chunk
+                chunk = []
+        chunk.append(gffs)
+
+    if chunk:
+        yield chunk
+
+
+# counters and bam files of a worker process
+WORKER = {}
+
+
+def initWorker(options):
+    '''open files and build counters in a worker process.'''
+    WORKER["options"] = options
+    WORKER["counters"], WORKER["bam_files"] = buildCounters(options)
+
+
+def countChunk(chunk):
+    '''count a chunk of gene models in a worker process.
+
+    Returns the output lines and the counts collected by the
+    counters and read caches while processing the chunk.
+    '''
+    options = WORKER["options"]
+    counters = WORKER["counters"]
+    bam_files = WORKER["bam_files"]
+
+    for counter in counters:
+        counter.counter = E.Counter()
+
+    gtf_iterator = iter(chunk)
+    if bam_files and options.read_cache:
+        for bam_file in bam_files:
+            bam_file.counter = E.Counter()
+        gtf_iterator = GeneModelAnalysis.iterateLoci(gtf_iterator,
+                                                     bam_files)
+
+    lines = [countGeneModel(gffs, counters, options)
+             for gffs in gtf_iterator]
+
+    if bam_files and options.read_cache:
+        cache_counts = [list(x.counter.items()) for x in bam_files]
+    else:
+        cache_counts = []
+
+    return (lines,
+            [list(x.counter.items()) for x in counters],
+            cache_counts)
+
+
+def countInParallel(options, counters, bam_files, gtf_iterator):
+    '''count gene models in *gtf_iterator* using a pool of
+    ``options.num_workers`` processes.
+
+    Output lines are returned in input order. The counts of
+    the workers are added to the counters and read caches of
+    the main process.
+    '''
+    # file handles can not be sent to worker processes
+    worker_options = optparse.Values(dict(
+        (key, value) for key, value in vars(options).items()
+        if not hasattr(value, "read") and not hasattr(value, "write")))
+
+    pool = multiprocessing.Pool(options.num_workers,
+                                initializer=initWorker,
+                                initargs=(worker_options,))
+
+    chunks = iterateChunks(gtf_iterator, options.chunk_size)
+    for lines, counts, cache_counts in pool.imap(countChunk, chunks):
+        for counter, items in zip(counters, counts):
+            counter.counter += dict(items)
+        for bam_file, items in zip(bam_files, cache_counts):
+            bam_file.counter += dict(items)
+        for line in lines:
+            yield line
+
+    pool.close()
+    pool.join()
+
+
+def main(argv=None):
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-g", "--genome-file", dest="genome_file", type="string",
+                      help="filename with genome [default=%default].")
+
+    parser.add_option("-q", "--quality-file",
+                      dest="quality_file",
+                      type="string",
+                      help="filename with genomic base quality "
+                      "information [default=%default].")
+
+    parser.add_option("-b", "--bam-file", dest="bam_files",
+                      type="string", metavar="bam",
+                      help="filename with read mapping information. "
+                      "Multiple files can be submitted in a "
+                      "comma-separated list [default=%default].")
+
+    parser.add_option("-i", "--bigwig-file", dest="bigwig_file",
+                      type="string", metavar="bigwig",
+                      help="filename with bigwig information "
+                      "[default=%default].")
+
+    parser.add_option("-f", "--gff-file", dest="filename_gff",
+                      type="string", action="append", metavar='bed',
+                      help="filename with extra gff files. The order "
+                      "is important [default=%default].")
+
+    parser.add_option("--filename-format", dest="filename_format",
+                      type="choice",
+                      choices=("bed", "gff", "gtf"),
+                      help="format of secondary stream [default=%default].")
+
+    parser.add_option("--restrict-source", dest="gff_sources", type="string",
+                      action="append",
+                      help="restrict input to this 'source' in extra "
+                      "gff file (for counter: overlap) [default=%default].")
+
+    parser.add_option("--restrict-feature", dest="gff_features", type="string",
+                      action="append",
+                      help="restrict input to this 'feature' in extra gff "
+                      "file (for counter: overlap) [default=%default].")
+
+    parser.add_option("-r", "--reporter", dest="reporter", type="choice",
+                      choices=("genes", "transcripts"),
+                      help="report results for 'genes' or 'transcripts' "
+                      "[default=%default].")
+
+    parser.add_option("-s", "--section", dest="sections",
+                      type="choice",
+                      action="append",
+                      choices=("exons", "introns"),
+                      help="select range on which counters will operate "
+                      "[default=%default].")
+
+    parser.add_option("-c", "--counter", dest="counters",
+                      type="choice",
+                      action="append",
+                      choices=(	"bigwig-counts",
+                                "binding-pattern",
+                                "classifier",
+                                "classifier-rnaseq",
+                                "classifier-rnaseq-splicing",
+                                "classifier-polii",
+                                "composition-na",
+                                "composition-cpg",
+                                "coverage",
+                                "distance",
+                                "distance-genes",
+                                "distance-tss",
+                                "length",
+                                'neighbours',
+                                "overlap",
+                                "overlap-stranded",
+                                "overlap-transcripts",
+                                "overrun",
+                                "position",
+                                "proximity",
+                                "proximity-exclusive",
+                                "proximity-lengthmatched",
+                                "quality",
+                                "read-coverage",
+                                "read-extension",
+                                "read-overlap",
+                                "read-counts",
+                                "read-fullcounts",
+                                "readpair-counts",
+                                "readpair-fullcounts",
+                                "splice",
+                                "splice-comparison",
+                                "territories"),
+                      help="select counters to apply to input "
+                      "[default=%default].")
+
+    parser.add_option("--add-gtf-source", dest="add_gtf_source",
+                      action="store_true",
+                      help="add gtf field of source to output "
+                      "[default=%default].")
+
+    parser.add_option("--proximal-distance", dest="proximal_distance",
+                      type="int",
+                      help="distance to be considered proximal to "
+                      "an interval [default=%default].")
+
+    parser.add_option("--multi-mapping-method",
+                      dest="multi_mapping",
+                      type="choice",
+                      choices=('all', 'ignore', 'weight'),
+                      help="how to treat multi-mapping reads in "
+                      "bam-files. Requires "
+                      "the NH flag to be set by the mapper "
+                      "[default=%default].")
+
+    parser.add_option("--use-barcodes",
+                      dest="use_barcodes",
+                      action="store_true",
+                      help="Use barcodes to count unique umi's. "
+                      "UMI's are specified in the read identifier "
+                      "as the last field, where fields are separated "
+                      "by underscores, e.g. "
+                      "@READ:ILLUMINA:STUFF_NAMINGSTUFF_UMI. "
+                      "When true, unique counts are returned. "
+                      "Currently only compatible with count-reads")
+
+    parser.add_option("--sample-probability",
+                      dest="sample_probability",
+                      type="float",
+                      help="Specify the probability of whether any"
+                      "given read or read pair in a file bam is counted"
+                      "Currently only compatible with count-reads")
+
+    parser.add_option("--no-read-cache",
+                      dest="read_cache",
+                      action="store_false",
+                      help="do not keep the reads of a gene in memory. "
+                      "Reads will be fetched from the bam files by each "
+                      "counter separately "
+                      "[default=%default].")
+
+    parser.add_option("--num-workers", dest="num_workers", type="int",
+                      help="number of worker processes to use for "
+                      "counting [default=%default].")
+
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      help="number of gene models sent to a worker "
+                      "process at a time [default=%default].")
+
+    parser.add_option("--column-prefix", dest="prefixes",
+                      type="string",
+                      action="append",
+                      help="add prefix to column headers - prefixes "
+                      "are used in the same order as the counters "
+                      "[default=%default].")
+
+    parser.add_option("--library-type",
+                      dest="library_type",
+                      type="choice",
+                      choices=("unstranded",
+                               "firststrand",
+                               "secondstrand",
+                               "fr-unstranded",
+                               "fr-firststrand",
+                               "fr-secondstrand"),
+                      help="library type of reads in bam file. "
+                      "[default=%default]")
+
+    parser.add_option("--min-mapping-quality",
+                      dest="minimum_mapping_quality",
+                      type="float",
+                      help="minimum mapping quality. Reads with a quality "
+                      "score of less will be ignored. "
+                      "[default=%default]")
+
+    parser.set_defaults(
+        genome_file=None,
+        reporter="genes",
+        with_values=True,
+        sections=[],
+        counters=[],
+        filename_gff=[],
+        filename_format=None,
+        gff_features=[],
+        gff_sources=[],
+        add_gtf_source=False,
+        proximal_distance=10000,
+        bam_files=None,
+        multi_mapping='all',
+        library_type='fr-unstranded',
+        prefixes=[],
+        minimum_mapping_quality=0,
+        use_barcodes=False,
+        sample_probability=1.0,
+        read_cache=True,
+        num_workers=1,
+        chunk_size=1000,
+    )
+
+    if not argv:
+        argv = sys.argv
+
+    (options, args) = E.start(parser, add_output_options=True, argv=argv)
+
+    if options.prefixes:
+        if len(options.prefixes) != len(options.counters):
+            raise ValueError(
+                "if any prefix is given, the number of prefixes "
+                "must be the same as the number of counters")
+
+    if not options.sections:
+        E.info("counters will use the default section (exons)")
+        options.sections.append(None)
+
+    if not options.gff_sources:
+        options.gff_sources.append(None)
+    if not options.gff_features:
+        options.gff_features.append(None)
+
+    counters, bam_files = buildCounters(options)
+
+    cc = E.Counter()
+
     if options.reporter == "genes":
         iterator = GTF.flat_gene_iterator
         header = ["gene_id"]
-        fheader = lambda x: [x[0].gene_id]
     elif options.reporter == "transcripts":
         iterator = GTF.transcript_iterator
         header = ["transcript_id"]
-        fheader = lambda x: [x[0].transcript_id]
 
     if options.add_gtf_source:
         header.append("source")
-        ffields = lambda x: [x[0].source]
-    else:
-        ffields = lambda x: []
 
     options.stdout.write("\t".join(
         header + [x.getHeader() for x in counters]) + "\n")
 
-    for gffs in iterator(GTF.iterator(options.stdin)):
+    if options.num_workers > 1:
+        # pysam GTFProxy objects can not be sent to worker processes
+        gtf_iterator = iterator(
+            (GTF.Entry().copy(x) for x in GTF.iterator(options.stdin)))
+        results = countInParallel(options, counters, bam_files,
+                                  gtf_iterator)
+    else:
+        gtf_iterator = iterator(GTF.iterator(options.stdin))
+        if bam_files and options.read_cache:
+            gtf_iterator = GeneModelAnalysis.iterateLoci(gtf_iterator,
+                                                         bam_files)
+        results = (countGeneModel(gffs, counters, options)
+                   for gffs in gtf_iterator)
+
+    for line in results:
         cc.input += 1
-
-        for counter in counters:
-            counter.update(gffs)
-
-        skip = len([x for x in counters if x.skip]) == len(counters)
-        if skip:
+        if line is None:
             cc.skipped += 1
             continue
-
-        options.stdout.write("\t".join(
-            fheader(gffs) +
-            ffields(gffs) +
-            [str(counter) for counter in counters]) + "\n")
-
+        options.stdout.write(line)
         cc.output += 1
 
     E.info("%s" % str(cc))
     for counter in counters:
         E.info("%s\t%s" % (repr(counter), str(counter.counter)))
+    if bam_files and options.read_cache:
+        for filename, bam_file in zip(options.bam_files.split(","),
+                                      bam_files):
+            E.info("read cache for %s: %s" % (filename,
+                                              str(bam_file.counter)))
     E.stop()
 
 if __name__ == "__main__":
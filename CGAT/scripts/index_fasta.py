@@ -26,6 +26,15 @@ Alternatively, the sequence can be block-compressed using different
 compression methods (gzip, lzo, bzip). These are mostly for research
 purposes.
 
+Nucleotide sequences can be stored in a 2-bit packed format
+(``--compression=twobit``). Runs of ``N`` and soft-masked (lower
+case) residues are kept in separate run-length tables, so that the
+sequence is returned unchanged. Other ambiguity codes are stored as
+``N``. This format requires about a quarter of the disk space and
+page cache of the uncompressed format while still permitting
+random access without decompressing whole blocks, thus
+``--random-access-points`` is not required.
+
 See also http://pypi.python.org/pypi/pyfasta for another
 implementation.  Samtools provides similar functionality with the
 ``samtools faidx`` command and block compression has been implemented
@@ -47,6 +56,13 @@ To retrieve a segment::
 
    python index_fasta.py --extract=chr5:1000:2000 oa_ornAna1_softmasked
 
+Uncompressed databases can be accessed through a memory map, which
+is considerably faster for many small random accesses. To compare
+access times::
+
+   python index_fasta.py --benchmark oa_ornAna1_softmasked
+   python index_fasta.py --benchmark --use-mmap --benchmark-batch-size=1000 oa_ornAna1_softmasked
+
 Indexing from a tar file is possible::
 
    python index_fasta.py oa_ornAna1_softmasked ornAna1.tar.gz > oa_ornAna1_softmasked.log
@@ -62,6 +78,7 @@ Type::
 
    cgat index_genome DATABASE [SOURCE...|-] [OPTIONS]
    cgat index_genome DATABASE [SOURCE...|-] --compression=COMPRESSION --random-access-points=100000
+   cgat index_genome DATABASE [SOURCE...|-] --compression=twobit
 
 To create indexed DATABASE from SOURCE. Supply - as SOURCE to read from stdin.
 If the output is to be compressed, a spacing for the random access points must
@@ -133,6 +150,11 @@ def main(argv=None):
                      dest="benchmark_fragment_size",
                      type="int",
                      help="benchmark: fragment size [default=%default].")
+    group.add_option("--benchmark-batch-size",
+                     dest="benchmark_batch_size",
+                     type="int",
+                     help="benchmark: number of fragments to retrieve "
+                     "per call [default=%default].")
     parser.add_option_group(group)
 
     group = E.OptionGroup(parser, "Validation options")
@@ -170,6 +192,11 @@ def main(argv=None):
                       "identifier from fasta description line "
                       "[default=%default].")
 
+    parser.add_option("--use-mmap", dest="use_mmap", action="store_true",
+                      help="access an uncompressed database through a "
+                      "memory map when extracting, benchmarking or "
+                      "verifying [default=%default].")
+
     parser.add_option("--force-output", dest="force", action="store_true",
                       help="force overwriting of existing files "
                       "[default=%default].")
@@ -182,7 +209,8 @@ def main(argv=None):
                       ", ".join(translator_choices))
 
     group = E.OptionGroup(parser, 'Compression options')
-    compression_choices = ("lzo", "zlib", "gzip", "dictzip", "bzip2", "debug")
+    compression_choices = ("lzo", "zlib", "gzip", "dictzip", "bzip2",
+                           "twobit", "debug")
     group.add_option("-c", "--compression", dest="compression", type="choice",
                      choices=compression_choices,
                      help="compress database, using specified compression "
@@ -210,6 +238,7 @@ def main(argv=None):
         input_format="zero-both-open",
         benchmark_fragment_size=1000,
         benchmark_num_iterations=1000000,
+        benchmark_batch_size=1,
         benchmark=False,
         compression=None,
         random_access_points=0,
@@ -223,6 +252,7 @@ def main(argv=None):
         compress_index=False,
         file_format="auto",
         force=False,
+        use_mmap=False,
         translator=None)
 
     (options, args) = E.start(parser)
@@ -252,7 +282,7 @@ def main(argv=None):
             raise ValueError("unknown translator %s" % options.translator)
 
     if options.extract:
-        fasta = IndexedFasta.IndexedFasta(args[0])
+        fasta = IndexedFasta.IndexedFasta(args[0], mmap=options.use_mmap)
         fasta.setTranslator(options.translator)
         converter = IndexedFasta.getConverter(options.input_format)
 
@@ -266,20 +296,32 @@ def main(argv=None):
 
     elif options.benchmark:
         import timeit
+        if options.benchmark_batch_size > 1:
+            stmt = "IndexedFasta.benchmarkRandomFragments(" \
+                "fasta=fasta, size=%i, num_fragments=%i)" % \
+                (options.benchmark_fragment_size,
+                 options.benchmark_batch_size)
+            number = max(1, options.benchmark_num_iterations
+                         // options.benchmark_batch_size)
+        else:
+            stmt = "IndexedFasta.benchmarkRandomFragment(" \
+                "fasta=fasta, size=%i)" % options.benchmark_fragment_size
+            number = options.benchmark_num_iterations
+
         timer = timeit.Timer(
-            stmt="IndexedFasta.benchmarkRandomFragment(fasta=fasta, size=%i)" %
-            (options.benchmark_fragment_size),
+            stmt=stmt,
             setup="from CGAT import IndexedFasta\n"
-            "fasta=IndexedFasta.IndexedFasta('%s')" % (args[0]))
+            "fasta=IndexedFasta.IndexedFasta('%s', mmap=%s)" %
+            (args[0], options.use_mmap))
 
-        t = timer.timeit(number=options.benchmark_num_iterations)
+        t = timer.timeit(number=number)
         options.stdout.write("iter\tsize\ttime\n")
         options.stdout.write("%i\t%i\t%i\n" % (
             options.benchmark_num_iterations,
             options.benchmark_fragment_size, t))
 
     elif options.verify:
-        fasta1 = IndexedFasta.IndexedFasta(args[0])
+        fasta1 = IndexedFasta.IndexedFasta(args[0], mmap=options.use_mmap)
         fasta2 = IndexedFasta.IndexedFasta(options.verify)
         nerrors1 = IndexedFasta.verify(fasta1, fasta2,
                                        options.verify_num_iterations,
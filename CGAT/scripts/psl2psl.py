@@ -1034,7 +1034,7 @@ def main(argv=None):
             "please supply both indexed query and "
             "target/genome sequence data.")
 
-    iterator = Blat.iterator(options.stdin)
+    iterator = Blat.fast_iterator(options.stdin)
 
     if options.header is not None or options.header != "none":
         if options.header == "table":
@@ -62,7 +62,7 @@ def main(argv=None):
         for start, end in iterator:
             b.set_range(start, end - start)
 
-    for psl in Blat.iterator(options.stdin):
+    for psl in Blat.fast_iterator(options.stdin):
 
         addRange(query_bitsets,
                  psl.mQueryId,
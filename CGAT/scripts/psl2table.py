@@ -150,7 +150,7 @@ def main(argv=None):
         iterator = Blat.iterator_pslx(options.stdin)
         header = "\t".join(Blat.MatchPSLX().getHeaders())
     else:
-        iterator = Blat.iterator(options.stdin)
+        iterator = Blat.fast_iterator(options.stdin)
         header = "\t".join(Blat.Match().getHeaders())
 
     if not options.with_match:
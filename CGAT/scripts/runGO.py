@@ -125,6 +125,11 @@ The command below runs a GO analysis, computing an FDR using 10.000 samples::
         --output-filename-pattern='result/%(set)s.%(go)s.%(section)s'
    > go.log
 
+Samples are processed in batches and can be distributed over
+several processes with the ``--num-threads`` option. Given the same
+``--random-seed``, the results do not depend on the number of
+processes.
+
 The output will be stored in the directory :file:`result` and output
 files will be created according to the pattern
 ``<set>.<go>.<section>``. ``<set>`` is the gene set that is analysed,
@@ -259,6 +264,11 @@ def main(argv=None):
         "--sample-size", dest="sample", type="int",
         help="do sampling (with # samples) [default=%default].")
 
+    parser.add_option(
+        "--num-threads", dest="num_threads", type="int",
+        help="number of processes to use for sampling "
+        "[default=%default].")
+
     parser.add_option(
         "--filename-output-pattern", "--output-filename-pattern",
         dest="output_filename_pattern", type="string",
@@ -320,6 +330,7 @@ def main(argv=None):
                         ontology=[],
                         filename_dump=None,
                         sample=0,
+                        num_threads=1,
                         fdr=False,
                         output_filename_pattern=None,
                         threshold=0.05,
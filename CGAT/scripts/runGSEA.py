@@ -49,6 +49,10 @@ cgat runGSEA -f "Expression_data.tsv" -g "Gene_set.gmt" -n 10 -d 1 -l 4
 Default run conditions:
 cgat runGSEA -f "Expression_data.tsv" -g "Gene_set.gmt"
 
+Enrichment scores of permuted gene sets can be computed with
+several processes:
+cgat runGSEA -f "Expression_data.tsv" -g "Gene_set.gmt" --num-threads=4
+
 --------------
 GSEA Statistics
 ---------------
@@ -128,6 +132,7 @@ import statsmodels.sandbox.stats.multicomp as sm
 from matplotlib.colors import ListedColormap
 import pandas as pd
 import itertools
+import multiprocessing
 import os
 import scipy
 from matplotlib import font_manager
@@ -239,23 +244,47 @@ def calculate_enrichment_score(s_I, ma, value, s, STORE):
     rr1 = value[s_I]
     rr2 = np.sum(np.power(np.absolute(rr1), 0))
     A33 = np.divide(-1, (len(ma) - s))
-    enrich_score = 0
-    for ii in range(0, len(ma)):
-        if(ma[ii] == 1):
-            CC = np.power(np.absolute(value[ii]), 0)
-            CC = np.divide(CC, rr2)
-            CC = CC + enrich_score
-            STORE[ii] = CC
-            enrich_score = CC
-        else:
-            CC = enrich_score + A33
-            STORE[ii] = CC
-            enrich_score = CC
+    CC = np.divide(np.power(np.absolute(value), 0), rr2)
+    # running sum over hits and misses along the ranked list
+    STORE[:] = np.cumsum(np.where(ma == 1, CC, A33))
     del rr1
     del rr2
     return STORE
 
 
+def select_enrichment_score(running_sum):
+    '''return the maximum deviation from zero of each row in
+    *running_sum*. If the maximum and minimum deviation are the
+    same, the maximum is returned.'''
+    A1 = np.max(running_sum, axis=1)
+    A2 = np.min(running_sum, axis=1)
+    return np.where(np.absolute(A1) >= np.absolute(A2), A1, A2)
+
+
+def calculate_permuted_enrichment_scores(args):
+    '''calculate enrichment scores for permuted gene sets.
+
+    *args* is a tuple of a 2-D array of indices into the ranked list
+    with one row per permuted gene set, the length of the ranked list,
+    the size of the gene set and the maximum number of elements of the
+    running sum matrix to compute at once.
+
+    Returns an array with the enrichment score of each row.
+    '''
+    indices, N, S, block_size = args
+    scores = np.zeros((len(indices),), dtype=np.float)
+    A33 = np.divide(-1, (N - S))
+    nrows = max(1, block_size // N)
+    for start in range(0, len(indices), nrows):
+        block = indices[start:start + nrows]
+        ma = np.zeros((len(block), N), dtype=np.bool_)
+        ma[np.arange(len(block))[:, np.newaxis], block] = True
+        CC = np.divide(1.0, np.sum(ma, axis=1))[:, np.newaxis]
+        scores[start:start + len(block)] = select_enrichment_score(
+            np.cumsum(np.where(ma, CC, A33), axis=1))
+    return scores
+
+
 def generate_gen_set_report(EX, IN, m, n, geneset_indicator):
     # Create gene set details
     C = len(EX) + len(IN)
@@ -909,6 +938,20 @@ def main(argv=None):
         help="Number of genesets for leading edge analysis, by default top 11 enriched genesets will be used for this analysis."
         "Minimum number of genesets should be 4. [default=%default].")
 
+    parser.add_option(
+        "--num-threads",
+        dest="num_threads",
+        type="int",
+        help="number of processes to use for computing enrichment scores "
+        "of permuted gene sets [default=%default].")
+
+    parser.add_option(
+        "--chunk-size",
+        dest="chunk_size",
+        type="int",
+        help="number of permutations to process at once. Larger chunks "
+        "are faster but require more memory [default=%default].")
+
     parser.set_defaults(
         file_name=None,
         geneset=None,
@@ -918,6 +961,8 @@ def main(argv=None):
         iteration=1000,
         plot_no=20,
         fdr_num=10,
+        num_threads=1,
+        chunk_size=100,
     )
     (options, args) = E.start(parser, add_database_options=True)
     # Preprocess expression file.
@@ -1014,38 +1059,40 @@ def main(argv=None):
 
     # Random index generation
     np.random.seed(options.seed)
-    id_new = np.array(id)
+    # position of each id in the ranked list
+    id_index = np.array([ind_dict[x] for x in id], dtype=np.int)
 
-    # Calculate enrichment score for permuted genesets
-    count = 0
-    for per in range(0, options.iteration):
-        if((per % 100) == 0):
-            print(per)
-        for i in range(0, len(size_info)):
-            tt = size_info[i]
-            tar = id_new[np.random.randint(len(id), size=(1, tt))]
-            inter = intersect(ind_dict, tar[0])
-            indices = sorted([ind_dict[x] for x in inter])
-            S = len(tar[0])
-            enrich_score = calculate_enrichment_score(
-                indices, temp, expression_value, S, temp_2)
-            del indices
-            del inter
-            a1 = [
-                np.absolute(
-                    np.max(enrich_score)), np.absolute(
-                    np.min(enrich_score))]
-            if(np.absolute(np.max(enrich_score)) == np.absolute(np.min(enrich_score))):
-                store_permute[per, i] = np.max(enrich_score)
-            else:
-                if(a1.index(max(a1)) == 0):
-                    store_permute[per, i] = np.max(enrich_score)
-                else:
-                    store_permute[per, i] = np.min(enrich_score)
-            del a1
-            temp.fill(0)
-            temp_2.fill(0)
-            del enrich_score
+    if options.num_threads > 1:
+        pool = multiprocessing.Pool(options.num_threads)
+        mapper = pool.imap
+    else:
+        mapper = map
+
+    # Calculate enrichment score for permuted genesets in chunks of
+    # permutations. Random indices are drawn in the same order as
+    # one permutation at a time so that results do not depend on
+    # the chunk size.
+    for first in range(0, options.iteration, options.chunk_size):
+        last = min(first + options.chunk_size, options.iteration)
+        E.debug("permutations %i to %i" % (first, last))
+        tar = [np.zeros((last - first, tt), dtype=np.int)
+               for tt in size_info]
+        for per in range(first, last):
+            for i in range(0, len(size_info)):
+                tar[i][per - first] = np.random.randint(
+                    len(id), size=size_info[i])
+
+        args = [(id_index[x], len(id), tt, 2 ** 22)
+                for x, tt in zip(tar, size_info)]
+        for i, scores in enumerate(
+                mapper(calculate_permuted_enrichment_scores, args)):
+            store_permute[first:last, i] = scores
+        del tar
+        del args
+
+    if options.num_threads > 1:
+        pool.close()
+        pool.join()
 
     print("Enrichment score calculation for permuted sets has been successfully completed")
 
@@ -1074,16 +1121,15 @@ def main(argv=None):
 
     # Normalization of enrichment score for each permutation.
 
-    for per in range(0, options.iteration):
-        for i in range(0, len(GG)):
-            if(store_permute[per, i] < 0):
-                A1 = store_permute[:, i] < 0
-                A2 = np.mean(np.absolute(store_permute[A1, i]))
-                permute_nes[per, i] = np.divide(store_permute[per, i], A2)
-            else:
-                A1 = store_permute[:, i] >= 0
-                A2 = np.mean(np.absolute(store_permute[A1, i]))
-                permute_nes[per, i] = np.divide(store_permute[per, i], A2)
+    for i in range(0, len(GG)):
+        A1 = store_permute[:, i] < 0
+        if(np.any(A1)):
+            A2 = np.mean(np.absolute(store_permute[A1, i]))
+            permute_nes[A1, i] = np.divide(store_permute[A1, i], A2)
+        A1 = store_permute[:, i] >= 0
+        if(np.any(A1)):
+            A2 = np.mean(np.absolute(store_permute[A1, i]))
+            permute_nes[A1, i] = np.divide(store_permute[A1, i], A2)
 
     print("Normalization has been successfully completed")
 
@@ -4,6 +4,7 @@
 from pysam.libchtslib cimport *
 from pysam.libcsamfile cimport *
 from pysam.libcfaidx cimport *
+from pysam.libcutils cimport force_str, force_bytes
 from libc.string cimport strchr
 from libc.stdint cimport int8_t
 from libc.stdio cimport puts, printf
@@ -16,6 +17,7 @@ import collections
 import copy
 import hashlib
 import itertools
+import multiprocessing
 import numpy
 import pandas
 import sys
@@ -93,48 +95,215 @@ cdef get_cigar_stats(AlignedSegment read, uint32_t[:] base_counts, uint32_t[:] b
     return base_counts, block_counts
 
 
-def bam2stats_count(AlignmentFile samfile,
-                    is_stdin=True,
-                    filename_fastq=None,
-                    outfile_details=None,
-                    add_alignment_details=False,
-                    outfile_readmap=None,
-                    detailed_count=None):
+# numpy record type with the same layout as CountsType
+COUNTS_DTYPE = numpy.dtype([
+    ("read_length", numpy.int32),
+    ("alignments", numpy.int8),
+    ("is_mapped", numpy.int8),
+    ("is_unmapped", numpy.int8),
+    ("mate_is_unmapped", numpy.int8),
+    ("is_paired", numpy.int8),
+    ("mapped_is_read1", numpy.int8),
+    ("mapped_is_read2", numpy.int8),
+    ("unmapped_is_read1", numpy.int8),
+    ("unmapped_is_read2", numpy.int8),
+    ("is_proper_pair", numpy.int8),
+    ("is_secondary", numpy.int8),
+    ("is_qcfail", numpy.int8),
+    ("is_duplicate", numpy.int8),
+    ("is_supplementary", numpy.int8),
+    ("mean_quality", numpy.int32),
+    ("median_quality", numpy.int32)], align=True)
+
+assert COUNTS_DTYPE.itemsize == sizeof(CountsType)
+
+# fields in CountsType that are set from the primary alignment of a
+# read instead of being incremented
+PRIMARY_FIELDS = ("read_length", "mean_quality", "median_quality")
+
+
+cdef class Histogram:
+    '''histogram of integer values.
+
+    Values from 0 up to *size* are counted in a numpy array, all
+    other values in a dictionary. Histograms collected from different
+    parts of a file can be combined with :meth:`merge`.
     '''
-    '''
-    cdef AlignedSegment read
-    cdef bint _add_alignment_details = add_alignment_details
-    # counters
-    cdef int ninput = 0
-    cdef int nduplicates = 0
-    # number of reads present after filtering
-    cdef int nfiltered = 0
+    cdef readonly numpy.ndarray counts
+    cdef readonly object overflow
+    cdef int64_t[:] counts_view
+    cdef int size
+
+    def __init__(self, size=256):
+        self.size = size
+        self.counts = numpy.zeros(size, dtype=numpy.int64)
+        self.counts_view = self.counts
+        self.overflow = collections.defaultdict(int)
+
+    cdef int add(self, int32_t value) except -1:
+        if 0 <= value < self.size:
+            self.counts_view[value] += 1
+        else:
+            self.overflow[value] += 1
+        return 0
+
+    def merge(self, Histogram other):
+        '''add counts in *other* to this histogram.'''
+        if self.size != other.size:
+            raise ValueError("can not merge histograms of different size")
+        self.counts += other.counts
+        for key, value in other.overflow.items():
+            self.overflow[key] += value
+
+    def asDict(self):
+        '''return histogram as a dictionary of observed values.'''
+        result = collections.defaultdict(int)
+        for key in numpy.flatnonzero(self.counts):
+            result[int(key)] = int(self.counts[key])
+        for key, value in self.overflow.items():
+            result[key] += value
+        return result
+
+    def __reduce__(self):
+        return (_buildHistogram, (self.counts, dict(self.overflow)))
 
-    cdef int max_hi = 0
-    # count nh, nm tags
-    nh_filtered = collections.defaultdict(int)
-    nm_filtered = collections.defaultdict(int)
-    nh_all = collections.defaultdict(int)
-    nm_all = collections.defaultdict(int)
-    mapq_filtered = collections.defaultdict(int)
-    mapq_all = collections.defaultdict(int)
 
-    cdef int * flags_counts = <int*>calloc(len(FLAGS), sizeof(int))
+def _buildHistogram(counts, overflow):
+    '''rebuild a histogram, used for unpickling.'''
+    cdef Histogram histogram = Histogram(len(counts))
+    histogram.counts[:] = counts
+    histogram.overflow.update(overflow)
+    return histogram
+
+
+cdef class AlignmentCounts:
+    '''counts collected from the alignments in a BAM file.
+
+    Counts collected from different parts of a BAM file can
+    be combined with :meth:`merge`.
+    '''
+    cdef public int64_t ninput
+    cdef public int64_t nduplicates
+    # number of reads present after filtering
+    cdef public int64_t nfiltered
+    cdef public int64_t fastq_notfound
+    cdef public int32_t max_hi
+    cdef public int64_t mismatch_counts
+    cdef public int64_t insertion_counts
+    cdef public int64_t deletion_counts
+    cdef public int64_t match_counts
+    cdef public numpy.ndarray flags_counts
+    cdef public Histogram nh_filtered
+    cdef public Histogram nh_all
+    cdef public Histogram nm_filtered
+    cdef public Histogram nm_all
+    cdef public Histogram mapq_filtered
+    cdef public Histogram mapq_all
+    # per read counts, one COUNTS_DTYPE record per read
+    cdef public numpy.ndarray fastq_counts
+    # rank of the shard that set the PRIMARY_FIELDS of a read
+    cdef public numpy.ndarray primary_rank
+    # per read cigar counts, None if not collected
+    cdef public object alignment_details
+
+    def __init__(self, fastq_nreads=0, add_alignment_details=False):
+        self.ninput = 0
+        self.nduplicates = 0
+        self.nfiltered = 0
+        self.fastq_notfound = 0
+        self.max_hi = 0
+        self.mismatch_counts = 0
+        self.insertion_counts = 0
+        self.deletion_counts = 0
+        self.match_counts = 0
+        self.flags_counts = numpy.zeros(len(FLAGS), dtype=numpy.int64)
+        self.nh_filtered = Histogram()
+        self.nh_all = Histogram()
+        self.nm_filtered = Histogram()
+        self.nm_all = Histogram()
+        self.mapq_filtered = Histogram()
+        self.mapq_all = Histogram()
+        self.fastq_counts = numpy.zeros(fastq_nreads, dtype=COUNTS_DTYPE)
+        self.primary_rank = numpy.zeros(fastq_nreads, dtype=numpy.int32)
+        if add_alignment_details:
+            self.alignment_details = numpy.zeros(
+                (fastq_nreads, NCIGAR_CODES + 1), dtype=numpy.uint16)
+        else:
+            self.alignment_details = None
+
+    def merge(self, AlignmentCounts other):
+        '''add counts in *other* to these counts.'''
+        self.ninput += other.ninput
+        self.nduplicates += other.nduplicates
+        self.nfiltered += other.nfiltered
+        self.fastq_notfound += other.fastq_notfound
+        self.max_hi = max(self.max_hi, other.max_hi)
+        self.mismatch_counts += other.mismatch_counts
+        self.insertion_counts += other.insertion_counts
+        self.deletion_counts += other.deletion_counts
+        self.match_counts += other.match_counts
+        self.flags_counts += other.flags_counts
+        self.nh_filtered.merge(other.nh_filtered)
+        self.nh_all.merge(other.nh_all)
+        self.nm_filtered.merge(other.nm_filtered)
+        self.nm_all.merge(other.nm_all)
+        self.mapq_filtered.merge(other.mapq_filtered)
+        self.mapq_all.merge(other.mapq_all)
+        for field in COUNTS_DTYPE.names:
+            if field not in PRIMARY_FIELDS:
+                self.fastq_counts[field] += other.fastq_counts[field]
+        # keep the values of the primary alignment that comes
+        # last in the file, as when counting in a single pass.
+        later = other.primary_rank > self.primary_rank
+        for field in PRIMARY_FIELDS:
+            self.fastq_counts[field][later] = other.fastq_counts[field][later]
+        self.primary_rank[later] = other.primary_rank[later]
+        if self.alignment_details is not None:
+            self.alignment_details += other.alignment_details
+
+    cdef CountsType * getFastqCounts(self):
+        if len(self.fastq_counts) == 0:
+            return NULL
+        return <CountsType *>numpy.PyArray_DATA(self.fastq_counts)
+
+
+cdef countAlignments(AlignmentFile samfile,
+                     alignments,
+                     AlignmentCounts counts,
+                     reads,
+                     int32_t rank=1,
+                     int64_t start=-1,
+                     uint32_t nalignments=0):
+    '''add counts for *alignments* from *samfile* to *counts*.
+
+    *reads* maps read name digests to indices in the per read
+    counts. Per read values taken from primary alignments are
+    marked with *rank*, the position of the alignments within
+    the file. Alignments starting before *start* are skipped.
+    '''
+    cdef AlignedSegment read
 
     # helper variables
     cdef int last_tid = -1
     cdef int last_pos = 0
     cdef int32_t read_index
 
-    duplicates = collections.defaultdict(int)
-    counts = collections.defaultdict(int)
-    cdef int count = 0
+    cdef int64_t ninput = 0
+    cdef int64_t nduplicates = 0
+    cdef int64_t nfiltered = 0
+    cdef int64_t fastq_notfound = 0
+    cdef int32_t max_hi = counts.max_hi
+    cdef int64_t[:] flags_counts = counts.flags_counts
+    cdef Histogram nh_filtered = counts.nh_filtered
+    cdef Histogram nh_all = counts.nh_all
+    cdef Histogram nm_filtered = counts.nm_filtered
+    cdef Histogram nm_all = counts.nm_all
+    cdef Histogram mapq_filtered = counts.mapq_filtered
+    cdef Histogram mapq_all = counts.mapq_all
 
-    cdef int tid = -1
     cdef int flag
     cdef uint32_t iteration = 0
     cdef uint32_t report_step = 1000000
-    cdef uint32_t nalignments = 0
     cdef uint8_t * v
     cdef int32_t nm
     cdef int32_t nh
@@ -147,15 +316,12 @@ def bam2stats_count(AlignmentFile samfile,
     cdef int detail_filter_flags = 2304
 
     # detailed counting
-    cdef PersistentFastqProxy fq
-    cdef int64_t index, fastq_nreads
-    cdef CountsType * fastq_counts
+    cdef CountsType * fastq_counts = counts.getFastqCounts()
     cdef CountsType * fastq_count
+    cdef int32_t[:] primary_rank = counts.primary_rank
     cdef char * read_name
     cdef char * position
-    cdef bint count_fastq = False
-    cdef int fastq_notfound = 0
-    cdef int chop = 0
+    cdef bint count_fastq = reads is not None
     cdef int hash_size = 5
 
     # number of alignment pairs that are nucleotide mismatches
@@ -168,6 +334,7 @@ def bam2stats_count(AlignmentFile samfile,
     # (might be a nucleotide mismatch)
     cdef long match_counts = 0
 
+    cdef bint _add_alignment_details = counts.alignment_details is not None
     cdef uint16_t [:, :] alignment_details_view
 
     cdef int nfields = NCIGAR_CODES + 1
@@ -182,89 +349,10 @@ def bam2stats_count(AlignmentFile samfile,
     cdef uint32_t [:] base_counts_view = base_counts
     cdef uint32_t [:] block_counts_view = block_counts
 
-    if filename_fastq != None:
-        count_fastq = True
-        E.info("reading fastq file")
-        # Using a python dictionary here is due
-        # for a large amount of memory usage.
-        # Alternatives to dictionary
-        # 1. POSIX hash tables (hsearch,...) or trees: very slow
-        # 2. custom hash implementation: worth the effort?
-        # 3. Sorted list and binary search: too slow for many lookups
-        reads = {}
-        fastqfile = FastxFile(filename_fastq)
-        fastq_nreads = 0
-        for fq in fastqfile:
-            if fastq_nreads == 0:
-                # chop off /1 or /2 as mappers usually remove these
-                # suffices. Test only the first.
-                name = fq.name
-                if name.endswith("/1") or name.endswith("/2"):
-                    chop = -2
-                
-            if chop != 0:
-                name = hashlib.md5(fq.name[:chop]).digest()[:hash_size]
-            else:
-                name = hashlib.md5(fq.name).digest()[:hash_size]
-
-            reads[name] = fastq_nreads
-
-            fastq_nreads += 1
-        
-    elif not is_stdin and detailed_count:
-        count_fastq = True
-        old_pos = samfile.tell()
-        E.info("two-pass processing to collect read names")
-        reads = {}
-        fastq_nreads = 0
-        for iteration, read in enumerate(samfile):
-
-            if iteration % report_step == 0:
-                E.info("pre-pass: read {} alignments: {} reads".format(
-                    iteration, len(reads)))
-
-            read_name = pysam_bam_get_qname(read._delegate)
-            
-            # terminate string at first space to
-            # truncate read names containing more than
-            # just the id
-            position = strchr(read_name, ' ')
-            if position != NULL: 
-                position[0] = '\0'
-
-            # compute hash, truncate to half the md5 digest which
-            # should be 64 bits and provides 36,893,488,147,419,103,232
-            # hashes.
-            md5 = hashlib.md5(read_name).digest()[:hash_size]
-            if md5 not in reads:
-                reads[md5] = fastq_nreads
-                fastq_nreads += 1
-                if outfile_readmap:
-                    outfile_readmap.write("{}\t{}\n".format(
-                        read_name,
-                        base64.encodestring(md5)[:-1]))
-
-        samfile.seek(old_pos)
-        nalignments = iteration
-    else:
-        count_fastq = False
-        E.info("simple counting only")
-
-    if count_fastq:
-        E.info("read names of %i reads or read pairs" % fastq_nreads)
-        E.info("allocating %i bytes" % (fastq_nreads * sizeof(CountsType)))
-
-        fastq_counts = <CountsType *>calloc(fastq_nreads, sizeof(CountsType))
-        if fastq_counts == NULL:
-            raise ValueError("could not allocate memory for %i bytes" %
-                             (fastq_nreads * sizeof(CountsType)))
-
     if _add_alignment_details:
-        alignment_details = numpy.zeros((fastq_nreads, NCIGAR_CODES + 1), dtype=numpy.uint16)
-                
-    E.info("starting processing of alignment file")
+        alignment_details_view = counts.alignment_details
 
-    for iteration, read in enumerate(samfile):
+    for iteration, read in enumerate(alignments):
 
         if iteration % report_step == 0:
             if nalignments:
@@ -275,6 +363,11 @@ def bam2stats_count(AlignmentFile samfile,
                 E.info("read {} alignments".format(
                     iteration))
 
+        # reads overlapping the start of a region are
+        # counted in the previous region
+        if read._delegate.core.pos < start:
+            continue
+
         flag = read._delegate.core.flag
         ninput += 1
 
@@ -293,18 +386,18 @@ def bam2stats_count(AlignmentFile samfile,
         v = bam_aux_get(read._delegate, 'NH')
         if v != NULL:
             nh = <int32_t>bam_aux2i(v)
-            nh_all[nh] += 1
+            nh_all.add(nh)
         else:
             nh = -1
 
         v = bam_aux_get(read._delegate, 'NM')
         if v != NULL:
             nm = <int32_t>bam_aux2i(v)
-            nm_all[nm] += 1
+            nm_all.add(nm)
         else:
             nm = -1
 
-        mapq_all[read.mapq] += 1
+        mapq_all.add(read.mapq)
 
         get_cigar_stats(read, base_counts_view, block_counts_view) 
 
@@ -325,12 +418,11 @@ def bam2stats_count(AlignmentFile samfile,
                 position[0] = '\0'
 
             md5 = hashlib.md5(read_name).digest()[:hash_size]
-            read_index = reads[md5]
-            try:
-                fastq_count = &fastq_counts[read_index]
-            except KeyError:
+            read_index = reads.get(md5, -1)
+            if read_index < 0:
                 fastq_notfound += 1
                 continue
+            fastq_count = &fastq_counts[read_index]
 
             # only take primary alignments for read length. read.query_length
             # includes soft-clipped sequence.
@@ -344,6 +436,7 @@ def bam2stats_count(AlignmentFile samfile,
                 else:
                     fastq_count.mean_quality = 0
                     fastq_count.median_quality = 0
+                primary_rank[read_index] = rank
 
             # book-keeping counts
             fastq_count.alignments += 1
@@ -369,7 +462,9 @@ def bam2stats_count(AlignmentFile samfile,
                     fastq_count.is_supplementary += 1
                 if _add_alignment_details:
                     if not (flag & detail_filter_flags):
-                        alignment_details[read_index, :] += base_counts_view
+                        for x from 0 <= x < nfields:
+                            alignment_details_view[read_index, x] += \
+                                base_counts_view[x]
 
         # is paired and read2
         #if flag & 1 and flag & 128:
@@ -382,38 +477,248 @@ def bam2stats_count(AlignmentFile samfile,
         if read._delegate.core.flag & 4:
             continue
 
-        if read.tid != last_tid:
-            contig = samfile.getrname(read.rname)
-
         nfiltered += 1
 
-        if nh >= 0: nh_filtered[nh] += 1
-        if nm >= 0: nm_filtered[nm] += 1
-        mapq_filtered[read.mapq] += 1
+        if nh >= 0: nh_filtered.add(nh)
+        if nm >= 0: nm_filtered.add(nm)
+        mapq_filtered.add(read.mapq)
 
         # duplicate analysis - simply count per start position
         # ignoring sequence and strand
         if read.tid == last_tid and read.pos == last_pos:
-            count += 1
             nduplicates += 1
             continue
 
-        if count > 1:
-            counts[count] += 1
-
-        count = 1
         last_tid, last_pos = read.tid, read.pos
 
+    counts.ninput += ninput
+    counts.nduplicates += nduplicates
+    counts.nfiltered += nfiltered
+    counts.fastq_notfound += fastq_notfound
+    counts.max_hi = max_hi
+    counts.mismatch_counts += mismatch_counts
+    counts.insertion_counts += insertion_counts
+    counts.deletion_counts += deletion_counts
+    counts.match_counts += match_counts
+
+
+def getShards(AlignmentFile samfile, shard_size):
+    '''split an indexed BAM file into shards that can be
+    counted independently.
+
+    Returns a list of (contig, start, end) tuples. Contigs are split
+    into pieces of *shard_size* bases, the last piece extending to the
+    end of the contig. The final shard with contig ``*`` contains
+    the unplaced unmapped reads.
+    '''
+    shards = []
+    for contig, length in zip(samfile.references, samfile.lengths):
+        for start in range(0, length, shard_size):
+            end = start + shard_size
+            if end >= length:
+                end = None
+            shards.append((contig, start, end))
+    shards.append(("*", None, None))
+    return shards
+
+
+# data shared with the processes counting shards
+SHARED = {}
+
+
+def initShards(filename, reads, fastq_nreads, add_alignment_details):
+    '''set up data for counting shards in a process.'''
+    SHARED.update({"filename": filename,
+                   "reads": reads,
+                   "fastq_nreads": fastq_nreads,
+                   "add_alignment_details": add_alignment_details})
+
+
+def countShards(shards):
+    '''count alignments in a list of (rank, shard) tuples.
+
+    Returns an :class:`AlignmentCounts` object.
+    '''
+    cdef AlignmentFile samfile = AlignmentFile(SHARED["filename"], "rb")
+    counts = AlignmentCounts(SHARED["fastq_nreads"],
+                             SHARED["add_alignment_details"])
+    for rank, (contig, start, end) in shards:
+        if contig == "*":
+            alignments = samfile.fetch(contig)
+            start = -1
+        else:
+            alignments = samfile.fetch(contig, start, end)
+        countAlignments(samfile,
+                        alignments,
+                        counts,
+                        SHARED["reads"],
+                        rank,
+                        start)
+    samfile.close()
+    return counts
+
+
+def bam2stats_count(AlignmentFile samfile,
+                    is_stdin=True,
+                    filename_fastq=None,
+                    outfile_details=None,
+                    add_alignment_details=False,
+                    outfile_readmap=None,
+                    detailed_count=None,
+                    threads=1,
+                    shard_size=10000000):
+    '''count alignments in *samfile*.
+
+    If *threads* is larger than 1 and *samfile* is an indexed file
+    that is not read from stdin, the file is split into shards (see
+    :func:`getShards`) which are counted in parallel.
+    '''
+    cdef AlignedSegment read
+    cdef bint _add_alignment_details = add_alignment_details
+
+    cdef uint32_t iteration = 0
+    cdef uint32_t report_step = 1000000
+    cdef uint32_t nalignments = 0
+    cdef int x
+    cdef int lflags = len(FLAGS)
+    cdef uint32_t f
+
+    # detailed counting
+    cdef FastxRecord fq
+    cdef int64_t index, fastq_nreads = 0
+    cdef int32_t read_index
+    cdef CountsType * fastq_counts
+    cdef CountsType * fastq_count
+    cdef char * read_name
+    cdef char * position
+    cdef bint count_fastq = False
+    cdef int chop = 0
+    cdef int hash_size = 5
+
+    cdef uint16_t [:, :] alignment_details_view
+
+    reads = None
+
+    if filename_fastq != None:
+        count_fastq = True
+        E.info("reading fastq file")
+        # Using a python dictionary here is due
+        # for a large amount of memory usage.
+        # Alternatives to dictionary
+        # 1. POSIX hash tables (hsearch,...) or trees: very slow
+        # 2. custom hash implementation: worth the effort?
+        # 3. Sorted list and binary search: too slow for many lookups
+        reads = {}
+        fastqfile = FastxFile(filename_fastq)
+        fastq_nreads = 0
+        for fq in fastqfile:
+            if fastq_nreads == 0:
+                # chop off /1 or /2 as mappers usually remove these
+                # suffices. Test only the first.
+                name = fq.name
+                if name.endswith("/1") or name.endswith("/2"):
+                    chop = -2
+                
+            if chop != 0:
+                name = hashlib.md5(force_bytes(fq.name[:chop])).digest()[:hash_size]
+            else:
+                name = hashlib.md5(force_bytes(fq.name)).digest()[:hash_size]
+
+            reads[name] = fastq_nreads
+
+            fastq_nreads += 1
+        
+    elif not is_stdin and detailed_count:
+        count_fastq = True
+        old_pos = samfile.tell()
+        E.info("two-pass processing to collect read names")
+        reads = {}
+        fastq_nreads = 0
+        for iteration, read in enumerate(samfile):
+
+            if iteration % report_step == 0:
+                E.info("pre-pass: read {} alignments: {} reads".format(
+                    iteration, len(reads)))
+
+            read_name = pysam_bam_get_qname(read._delegate)
+            
+            # terminate string at first space to
+            # truncate read names containing more than
+            # just the id
+            position = strchr(read_name, ' ')
+            if position != NULL: 
+                position[0] = '\0'
+
+            # compute hash, truncate to half the md5 digest which
+            # should be 64 bits and provides 36,893,488,147,419,103,232
+            # hashes.
+            md5 = hashlib.md5(read_name).digest()[:hash_size]
+            if md5 not in reads:
+                reads[md5] = fastq_nreads
+                fastq_nreads += 1
+                if outfile_readmap:
+                    outfile_readmap.write("{}\t{}\n".format(
+                        force_str(read_name),
+                        base64.encodebytes(md5)[:-1].decode("ascii")))
+
+        samfile.seek(old_pos)
+        nalignments = iteration
+    else:
+        count_fastq = False
+        E.info("simple counting only")
+
+    if count_fastq:
+        E.info("read names of %i reads or read pairs" % fastq_nreads)
+        E.info("allocating %i bytes" % (fastq_nreads * sizeof(CountsType)))
+
+    counts = AlignmentCounts(fastq_nreads, _add_alignment_details)
+
+    E.info("starting processing of alignment file")
+
+    if threads > 1 and not is_stdin and samfile.has_index():
+        shards = getShards(samfile, shard_size)
+        E.info("counting %i shards with %i threads" % (len(shards), threads))
+        # shards are ranked by their position in the file. They
+        # are distributed round-robin so that each process returns
+        # a single set of counts.
+        shards = list(enumerate(shards, 1))
+        pool = multiprocessing.Pool(
+            threads,
+            initializer=initShards,
+            initargs=(force_str(samfile.filename), reads, fastq_nreads,
+                      _add_alignment_details))
+        for other in pool.imap(countShards,
+                               [shards[x::threads] for x in range(threads)]):
+            counts.merge(other)
+        pool.close()
+        pool.join()
+    else:
+        if threads > 1:
+            E.warn("parallel counting requires an indexed BAM file - "
+                   "counting in a single thread")
+        countAlignments(samfile, samfile, counts, reads,
+                        1, -1, nalignments)
+
     E.info( "finished computing counts" )
 
-    if fastq_notfound:
-        E.warn( "could not match %i records in bam-file to fastq file" % fastq_notfound)
+    if counts.fastq_notfound:
+        E.warn( "could not match %i records in bam-file to fastq file" % counts.fastq_notfound)
+
+    fastq_counts = counts.getFastqCounts()
+    alignment_details = counts.alignment_details
+    if _add_alignment_details:
+        alignment_details_view = alignment_details
+
+    cdef long mismatch_counts = counts.mismatch_counts
+    cdef long insertion_counts = counts.insertion_counts
+    cdef long deletion_counts = counts.deletion_counts
+    cdef long match_counts = counts.match_counts
 
     counter = E.Counter()
 
-    counter.alignments_input = ninput
-    counter.alignments_filtered = nfiltered
-    counter.alignments_duplicates = nduplicates
+    counter.alignments_input = counts.ninput
+    counter.alignments_filtered = counts.nfiltered
+    counter.alignments_duplicates = counts.nduplicates
 
     if match_counts == 0:
         match_counts = 1
@@ -434,7 +739,7 @@ def bam2stats_count(AlignmentFile samfile,
     t = {}
     f = 1
     for x from 0 <= x < lflags:
-        t[FLAGS[f]] = flags_counts[x]
+        t[FLAGS[f]] = int(counts.flags_counts[x])
         f = f << 1
 
     # count based on fastq data
@@ -663,7 +968,7 @@ def bam2stats_count(AlignmentFile samfile,
                     fastq_count = &fastq_counts[read_index]
                     # remove "\n" from base64 encoded md5
                     outfile_details.write("%s\t%s" % (
-                        base64.encodestring(qname)[:-1].decode("ascii"),
+                        base64.encodebytes(qname)[:-1].decode("ascii"),
                         "\t".join( \
                                    map(str,
                                        (fastq_count.read_length,
@@ -793,13 +1098,13 @@ def bam2stats_count(AlignmentFile samfile,
         details_df = None
 
     return (counter, t, 
-            nh_filtered,
-            nh_all, 
-            nm_filtered,
-            nm_all, 
-            mapq_filtered,
-            mapq_all, 
-            max_hi,
+            counts.nh_filtered.asDict(),
+            counts.nh_all.asDict(),
+            counts.nm_filtered.asDict(),
+            counts.nm_all.asDict(),
+            counts.mapq_filtered.asDict(),
+            counts.mapq_all.asDict(),
+            counts.max_hi,
             details_df)
 
 
@@ -1197,7 +1502,7 @@ def bam2bam_filter_bam(AlignmentFile input_samfile,
                 nm = 0
 
             get_cigar_stats(read, base_counts_view, block_counts_view) 
-            error_rate = (10000 * (nm + base_counts_view[BAM_CINS])) /\
+            error_rate = (10000 * (nm + base_counts_view[BAM_CINS])) //\
                 (base_counts_view[BAM_CMATCH] + base_counts_view[BAM_CINS])
             if error_rate > c_filter_error_rate:
                 nerror_rate += 1
@@ -1421,6 +1726,36 @@ cdef bytes count_md_tag_mismatches(AlignedSegment read):
     return seq
 
 
+def get_window_columns():
+    """return list of column names in window counts.
+
+    The flags come first, followed by alignment and base counts.
+    """
+    cdef int x
+    cdef uint32_t f = 1
+    columns = []
+    for x from 0 <= x < len(FLAGS):
+        columns.append(FLAGS[f])
+        f = f << 1
+
+    columns.extend([
+        "alignment_starts",
+        "alignment_ends",
+        "alignments",
+        "matched_bases",
+        "mismatched_bases",
+        "inserted_bases",
+        "deleted_bases",
+        "hard_clipped_alignments",
+        "hard_clipped_bases",
+        "soft_clipped_alignments",
+        "soft_clipped_bases",
+        "bases_gc",
+        "bases_at"])
+
+    return columns
+
+
 def bam2stats_window_count(AlignmentFile samfile,
                            region=None,
                            chromosomes=None,
@@ -1463,28 +1798,7 @@ def bam2stats_window_count(AlignmentFile samfile,
     cdef int idx_gc = idx_soft_clipped_bases + 1
     cdef int idx_at = idx_gc + 1
 
-    # build list of column names
-    # add flags to cloumns
-    columns = []
-    f = 1
-    for x from 0 <= x < nflags:
-        columns.append(FLAGS[f])
-        f = f << 1
-    
-    columns.extend([
-        "alignment_starts",
-        "alignment_ends",
-        "alignments",
-        "matched_bases",
-        "mismatched_bases",
-        "inserted_bases",
-        "deleted_bases",
-        "hard_clipped_alignments",
-        "hard_clipped_bases",
-        "soft_clipped_alignments",
-        "soft_clipped_bases",
-        "bases_gc",
-        "bases_at"])
+    columns = get_window_columns()
 
     assert idx_at == len(columns) - 1
 
@@ -1493,7 +1807,7 @@ def bam2stats_window_count(AlignmentFile samfile,
     lengths = samfile.lengths
 
     if region is not None:
-        itr = samfile.fetch(region)
+        itr = samfile.fetch(region=region)
         contig, start, end = parse_region_string(region)
 
         pairs = []
@@ -1583,7 +1897,7 @@ def bam2stats_window_count(AlignmentFile samfile,
         ref_pos = read.reference_start
         nmatches = nmismatches = ndeletions = ninsertions = 0
         # border of next window
-        next_window_start = offsets[tid] + ((ref_pos // _window_size + 1) * _window_size)
+        next_window_start = (ref_pos // _window_size + 1) * _window_size
         for code in md_seq:
 
             if code == '=':
@@ -1603,6 +1917,7 @@ def bam2stats_window_count(AlignmentFile samfile,
                 window_counts[idx][idx_mismatches] += nmismatches
                 window_counts[idx][idx_deletions] += ndeletions
                 window_counts[idx][idx_insertions] += ninsertions
+                nmatches = nmismatches = ndeletions = ninsertions = 0
 
                 next_window_start += _window_size
                 idx += 1
@@ -1668,3 +1983,237 @@ def bam2stats_window_count(AlignmentFile samfile,
     window_df.index.names = ["contig", "start", "end"]
 
     return window_df
+
+
+cdef count_contig_windows(itr,
+                          int64_t[:, ::1] counts,
+                          uint32_t window_size):
+    '''count alignments from *itr* into windows of a single contig.
+
+    Flags and alignments are not counted in every window that an
+    alignment overlaps. Instead, flags are recorded in the window
+    an alignment starts in and, in the columns after the output
+    columns, in the window it ends in. Overlap counts at any
+    resolution are then obtained by cumulative sums, see
+    :func:`bam2stats_window_pyramid`.
+    '''
+    cdef AlignedSegment read
+    cdef int nflags = len(FLAGS)
+    cdef int ncolumns = len(get_window_columns())
+    cdef int flag, x
+    cdef uint32_t f
+    cdef int32_t idx, window_start, window_end
+    cdef int64_t ref_pos, next_window_start
+    cdef int64_t nmatches, nmismatches, ndeletions, ninsertions
+    cdef char code
+    cdef bytes md_seq
+
+    cdef int idx_alignment_starts = nflags
+    cdef int idx_alignment_ends = idx_alignment_starts + 1
+    cdef int idx_matches = idx_alignment_ends + 2
+    cdef int idx_mismatches = idx_matches + 1
+    cdef int idx_insertions = idx_mismatches + 1
+    cdef int idx_deletions = idx_insertions + 1
+    cdef int idx_hard_clipped = idx_deletions + 1
+    cdef int idx_hard_clipped_bases = idx_hard_clipped + 1
+    cdef int idx_soft_clipped = idx_hard_clipped_bases + 1
+    cdef int idx_soft_clipped_bases = idx_soft_clipped + 1
+
+    cdef int ninput = 0
+
+    for read in itr:
+        flag = read._delegate.core.flag
+        if read._delegate.core.tid < 0 or flag & 4:
+            continue
+        ninput += 1
+
+        window_start = read.reference_start // window_size
+        window_end = read.reference_end // window_size
+
+        counts[window_start, idx_alignment_starts] += 1
+        counts[window_end, idx_alignment_ends] += 1
+
+        f = 1
+        for x from 0 <= x < nflags:
+            if flag & f:
+                counts[window_start, x] += 1
+                counts[window_end, ncolumns + x] += 1
+            f = f << 1
+
+        # count hard/soft-clipping
+        cigar = read.cigartuples
+        if cigar[0][0] == 5:
+            counts[window_start, idx_hard_clipped] += 1
+            counts[window_start, idx_hard_clipped_bases] += cigar[0][1]
+        elif cigar[0][0] == 4:
+            counts[window_start, idx_soft_clipped] += 1
+            counts[window_start, idx_soft_clipped_bases] += cigar[0][1]
+
+        if cigar[-1][0] == 5:
+            counts[window_end, idx_hard_clipped] += 1
+            counts[window_end, idx_hard_clipped_bases] += cigar[-1][1]
+        elif cigar[-1][0] == 4:
+            counts[window_end, idx_soft_clipped] += 1
+            counts[window_end, idx_soft_clipped_bases] += cigar[-1][1]
+
+        idx = window_start
+        md_seq = count_md_tag_mismatches(read)
+        ref_pos = read.reference_start
+        nmatches = nmismatches = ndeletions = ninsertions = 0
+        # border of next window
+        next_window_start = (ref_pos // window_size + 1) * window_size
+        for code in md_seq:
+            if code == '=':
+                nmatches += 1
+                ref_pos += 1
+            elif code == '+':
+                ninsertions += 1
+            elif code == '-':
+                ndeletions += 1
+                ref_pos += 1
+            elif code == '*':
+                nmismatches += 1
+                ref_pos += 1
+
+            if ref_pos >= next_window_start:
+                counts[idx, idx_matches] += nmatches
+                counts[idx, idx_mismatches] += nmismatches
+                counts[idx, idx_deletions] += ndeletions
+                counts[idx, idx_insertions] += ninsertions
+                nmatches = nmismatches = ndeletions = ninsertions = 0
+
+                next_window_start += window_size
+                idx += 1
+
+        counts[idx, idx_matches] += nmatches
+        counts[idx, idx_mismatches] += nmismatches
+        counts[idx, idx_deletions] += ndeletions
+        counts[idx, idx_insertions] += ninsertions
+
+    return ninput
+
+
+def bam2stats_window_pyramid(AlignmentFile samfile,
+                             window_sizes,
+                             region=None,
+                             fasta=None):
+    '''compute window counts at several resolutions in a single pass.
+
+    Alignments are counted once in windows of the smallest size in
+    *window_sizes*. Counts for the larger window sizes, which need
+    to be multiples of the smallest one, are derived from these by
+    summing blocks of windows. The results are identical to calling
+    :func:`bam2stats_window_count` for each window size.
+
+    Counting proceeds contig by contig, so that only the windows
+    of a single contig are kept in memory.
+
+    Arguments
+    ---------
+    samfile : pysam.AlignmentFile
+        Indexed bam file.
+    window_sizes : list
+        Window sizes to compute.
+    region : string
+        Restrict counting to this region.
+    fasta : pysam.FastaFile
+        If given, count G+C and A+T bases in each window.
+
+    Returns
+    -------
+    iterator : (contig, window_size, pandas.DataFrame)
+        Window counts for each contig and each window size, in
+        order of increasing window size.
+    '''
+    window_sizes = sorted(set(window_sizes))
+    if len(window_sizes) == 0:
+        raise ValueError("no window sizes given")
+
+    cdef uint32_t min_size = window_sizes[0]
+    if min_size == 0:
+        raise ValueError("window size needs to be positive")
+
+    for size in window_sizes:
+        if size % min_size != 0:
+            raise ValueError(
+                "window size {} is not a multiple of {}".format(
+                    size, min_size))
+
+    columns = get_window_columns()
+    cdef int nflags = len(FLAGS)
+    cdef int ncolumns = len(columns)
+    cdef int idx_alignment_starts = columns.index("alignment_starts")
+    cdef int idx_alignment_ends = columns.index("alignment_ends")
+    cdef int idx_alignments = columns.index("alignments")
+    cdef int idx_gc = columns.index("bases_gc")
+    cdef int idx_at = columns.index("bases_at")
+    cdef uint32_t nwindows
+
+    if region is not None:
+        contig, start, end = parse_region_string(region)
+        contigs = [(contig, samfile.get_reference_length(contig), region)]
+    else:
+        contigs = [(contig, length, contig) for contig, length in
+                   zip(samfile.references, samfile.lengths)]
+
+    for contig, length, fetch_region in contigs:
+
+        nwindows = (length + min_size) // min_size
+        window_counts = numpy.zeros((nwindows, ncolumns + nflags),
+                                    dtype=numpy.int64)
+
+        ninput = count_contig_windows(
+            samfile.fetch(region=fetch_region),
+            window_counts,
+            min_size)
+
+        if fasta:
+            sequence = numpy.frombuffer(
+                fasta.fetch(contig).upper().encode("ascii"),
+                dtype=numpy.uint8)[:length]
+            if len(sequence):
+                starts = numpy.arange(0, len(sequence), min_size)
+                window_counts[:len(starts), idx_gc] = numpy.add.reduceat(
+                    (sequence == ord("C")) | (sequence == ord("G")),
+                    starts, dtype=numpy.int64)
+                window_counts[:len(starts), idx_at] = numpy.add.reduceat(
+                    (sequence == ord("A")) | (sequence == ord("T")),
+                    starts, dtype=numpy.int64)
+
+        E.info("counted {} alignments in {} windows on {}".format(
+            ninput, nwindows, contig))
+
+        for size in window_sizes:
+            factor = size // min_size
+            if factor == 1:
+                level = window_counts
+            else:
+                level = numpy.add.reduceat(
+                    window_counts,
+                    numpy.arange(0, nwindows, factor),
+                    axis=0)
+
+            # flags and alignments in a window are the alignments
+            # starting in or before the window minus those ending
+            # before it.
+            counts = level[:, :ncolumns].copy()
+            starts = numpy.cumsum(level[:, :nflags], axis=0)
+            ends = numpy.cumsum(level[:, ncolumns:], axis=0)
+            counts[:, :nflags] = starts
+            counts[1:, :nflags] -= ends[:-1]
+
+            starts = numpy.cumsum(level[:, idx_alignment_starts])
+            ends = numpy.cumsum(level[:, idx_alignment_ends])
+            counts[:, idx_alignments] = starts
+            counts[1:, idx_alignments] -= ends[:-1]
+
+            window_starts = numpy.arange(0, len(counts) * size, size)
+            window_df = pandas.DataFrame(
+                counts,
+                columns=columns,
+                index=[[contig] * len(counts),
+                       window_starts,
+                       window_starts + size])
+            window_df.index.names = ["contig", "start", "end"]
+
+            yield contig, size, window_df
@@ -0,0 +1,3 @@
+from CGAT.tools.BamTools.Bam2Stats import bam2stats_count, \
+    bam2stats_window_count, bam2stats_window_pyramid, \
+    bam2bam_split_reads, bam2bam_filter_bam, SetNH
@@ -16,7 +16,10 @@ import collections
 import hashlib
 import itertools
 import math
+import multiprocessing
 import numpy
+import optparse
+import os
 import pandas
 import re
 import string
@@ -33,8 +36,8 @@ import CGATCore.Experiment as E
 cimport numpy
 
 
-def generate_from_bed(vcf_file, bed_file):
-    for bed in bed_file.fetch(parser=pysam.asBed()):
+def generate_from_bed(vcf_file, bed_file, contig=None):
+    for bed in bed_file.fetch(contig, parser=pysam.asBed()):
         for v in vcf_file.fetch(bed.contig, bed.start, bed.end):
             yield v
 
@@ -46,10 +49,23 @@ def generate_from_region(vcf_file, region):
     for v in vcf_file.fetch(region=region):
         yield v
 
+def generate_from_shard(vcf_file, contig, start, end):
+    for v in vcf_file.fetch(contig, start, end):
+        # records overlapping the start of the shard
+        # belong to the previous shard
+        if start is not None and v.start < start:
+            continue
+        yield v
+
 
 ACGT = str.maketrans("ACGT", "TGCA")
 
 
+def _new_counter(cls):
+    """return an uninitialized counter, used for unpickling."""
+    return cls.__new__(cls)
+
+
 cdef class Counter(object):
 
     cdef int nsamples
@@ -64,25 +80,68 @@ cdef class Counter(object):
     cdef process_record(self, VariantRecord record, bint is_snp):
         raise NotImplementedError("base class must implement process_record")
 
+    def merge(self, Counter other):
+        """add the counts collected by *other* to this counter.
+
+        Counters that processed different parts of a VCF file
+        can be merged to obtain the counts for the whole file.
+        """
+        raise NotImplementedError("base class must implement merge")
+
+    def __getstate__(self):
+        return {"samples": self.samples,
+                "only_variant_positions": self.only_variant_positions}
+
+    def __setstate__(self, state):
+        self.samples = state["samples"]
+        self.nsamples = len(self.samples)
+        self.only_variant_positions = state["only_variant_positions"]
+
+    def __reduce__(self):
+        return (_new_counter, (type(self),), self.__getstate__())
+
     
 cdef class CounterKinship(Counter):
+    """count genotype sharing between all pairs of samples.
+
+    Genotypes of SNPs are buffered in a samples x sites matrix. Once
+    `block_size` sites have been collected, the pairwise counts are
+    updated through matrix products of indicator matrices for
+    heterozygous and homozygous genotypes.
+
+    Pairwise counts are stored as packed lower triangular matrices:
+    the count for samples i and j with j < i is at index
+    i * (i - 1) / 2 + j.
+    """
 
     cdef int32_t * data_genotype_ptr
+    cdef int block_size
+    cdef int nbuffered
+    cdef int tile_size
 
     cdef numpy.ndarray n_Aa
     cdef numpy.ndarray n_AAaa
     cdef numpy.ndarray n_AaAa
-    cdef numpy.ndarray genotype_values
-    
-    def __init__(self, *args, **kwargs):
+    cdef numpy.ndarray genotypes
+
+    def __init__(self, block_size=1000, *args, **kwargs):
         Counter.__init__(self, *args, **kwargs)
 
+        # products are computed in single precision, which
+        # is exact for counts below 2^24
+        if block_size < 1 or block_size >= 2 ** 24:
+            raise ValueError("block size must be between 1 and 2^24")
+
         self.data_genotype_ptr = NULL
+        self.block_size = block_size
+        self.nbuffered = 0
+        # number of rows of the pairwise matrices to update at a time
+        self.tile_size = max(1, 2 ** 22 // max(1, self.nsamples))
         self.n_Aa = numpy.zeros(self.nsamples, dtype=numpy.int64)
-        # if memory becomes an issue, use triangular matrices
-        self.n_AAaa = numpy.zeros((self.nsamples, self.nsamples), dtype=numpy.int64)
-        self.n_AaAa = numpy.zeros((self.nsamples, self.nsamples), dtype=numpy.int64)
-        self.genotype_values = numpy.zeros(self.nsamples, dtype=numpy.int8)
+        npairs = self.nsamples * (self.nsamples - 1) // 2
+        self.n_AAaa = numpy.zeros(npairs, dtype=numpy.int64)
+        self.n_AaAa = numpy.zeros(npairs, dtype=numpy.int64)
+        self.genotypes = numpy.zeros((self.nsamples, block_size), dtype=numpy.int8)
 
     cdef process_record(self, VariantRecord record, bint is_snp):
 
@@ -92,11 +151,12 @@ cdef class CounterKinship(Counter):
         cdef int mdat = 0
         cdef int32_t * ptr = NULL
         cdef int allele
-        cdef bint is_het_i, is_het_j
         cdef int nret
         cdef int _i, _j
+        cdef int8_t value
 
-        cdef int8_t [:] genotype_values_view = self.genotype_values
+        cdef int8_t [:, :] genotypes_view = self.genotypes
+        cdef int column = self.nbuffered
 
         nret = bcf_get_genotypes(
             record.header.ptr,
@@ -112,46 +172,99 @@ cdef class CounterKinship(Counter):
         for _i from 0 <= _i < self.nsamples:
             # sum up alleles. Missing alleles or more than 2 alleles 
             # will set the value to a large negative value
-            genotype_values_view[_i] = 0
+            value = 0
             for _j from 0 <= _j < nret:
                 if bcf_gt_is_missing(ptr[_j]):
-                    genotype_values_view[_i] = -10
+                    value = -10
                     continue
                 if ptr[_j]==bcf_int32_vector_end:
                     break
                 allele = bcf_gt_allele(ptr[_j])
                 if allele > 1:
-                    genotype_values_view[_i] = -10
-                genotype_values_view[_i] += allele
+                    value = -10
+                value += allele
+            genotypes_view[_i, column] = value
             ptr += nret
 
-        for _i from 0 <= _i < self.nsamples:
-            if genotype_values_view[_i] < 0:
-                continue
-            is_het_i = genotype_values_view[_i] == 1
-            if is_het_i:
-                self.n_Aa[_i] += 1
-            for _j from 0 <= _j < _i:
-                if genotype_values_view[_j] < 0:
-                    continue
-                is_het_j = genotype_values_view[_j] == 1
-                if is_het_i and is_het_j:
-                    self.n_AaAa[_i][_j] += 1
-                elif (not is_het_i and
-                      not is_het_j and
-                      genotype_values_view[_i] != genotype_values_view[_j]):
-                    self.n_AAaa[_i][_j] += 1
+        self.nbuffered += 1
+        if self.nbuffered == self.block_size:
+            self.flush()
+
+    def flush(self):
+        """update pairwise counts with the buffered genotypes."""
+        if self.nbuffered == 0:
+            return
+
+        genotypes = self.genotypes[:, :self.nbuffered]
+        self.nbuffered = 0
+
+        is_het = genotypes == 1
+        self.n_Aa += is_het.sum(axis=1)
+        is_het = is_het.astype(numpy.float32)
+
+        # samples with two different homozygous genotypes. Genotypes
+        # other than 0 and 2 are possible for non-diploid sites and
+        # are counted the same way.
+        values = numpy.unique(genotypes)
+        is_hom = [(genotypes == x).astype(numpy.float32)
+                  for x in values if x >= 0 and x != 1]
+
+        cdef int start, end
+        for start in range(1, self.nsamples, self.tile_size):
+            end = min(start + self.tile_size, self.nsamples)
+            # select pairs (i, j) with j < i for rows start to end
+            lower = (numpy.arange(end)[numpy.newaxis, :] <
+                     numpy.arange(start, end)[:, numpy.newaxis])
+            first, last = start * (start - 1) // 2, end * (end - 1) // 2
+
+            counts = numpy.dot(is_het[start:end], is_het[:end].T)
+            self.n_AaAa[first:last] += counts[lower].astype(numpy.int64)
+
+            counts = numpy.zeros((end - start, end), dtype=numpy.float32)
+            for x in is_hom:
+                for y in is_hom:
+                    if x is not y:
+                        counts += numpy.dot(x[start:end], y[:end].T)
+            self.n_AAaa[first:last] += counts[lower].astype(numpy.int64)
+
+    def merge(self, CounterKinship other):
+        self.flush()
+        other.flush()
+        self.n_Aa += other.n_Aa
+        self.n_AAaa += other.n_AAaa
+        self.n_AaAa += other.n_AaAa
+
+    def __getstate__(self):
+        self.flush()
+        state = Counter.__getstate__(self)
+        state.update({"block_size": self.block_size,
+                      "n_Aa": self.n_Aa,
+                      "n_AAaa": self.n_AAaa,
+                      "n_AaAa": self.n_AaAa})
+        return state
+
+    def __setstate__(self, state):
+        Counter.__setstate__(self, state)
+        self.block_size = state["block_size"]
+        self.nbuffered = 0
+        self.tile_size = max(1, 2 ** 22 // max(1, self.nsamples))
+        self.n_Aa = state["n_Aa"]
+        self.n_AAaa = state["n_AAaa"]
+        self.n_AaAa = state["n_AaAa"]
+        self.genotypes = numpy.zeros((self.nsamples, self.block_size), dtype=numpy.int8)
 
     def output(self):
 
         cdef int _i, _j
+        cdef int64_t idx = 0
+        self.flush()
         with E.open_output_file("kinship") as outf:
             outf.write("sample_i\tsample_j\twithin_kinship\t"
                        "between_kinship\tn_het_i\tn_het_j\tn_homhom\tn_hethet\n")
             for _i from 0 <= _i < self.nsamples:
                 for _j from 0 <= _j < _i:
                     try:
-                        between_kinship = (self.n_AaAa[_i][_j] - 2.0 * self.n_AAaa[_i][_j]) \
+                        between_kinship = (self.n_AaAa[idx] - 2.0 * self.n_AAaa[idx]) \
                             / (2.0 * self.n_Aa[_i]) \
                             + 0.5 - 0.25 * (self.n_Aa[_i] + self.n_Aa[_j]) / self.n_Aa[_i]
                         between_kinship_f = "{:6.4f}".format(between_kinship)
@@ -159,7 +272,7 @@ cdef class CounterKinship(Counter):
                         between_kinship_f = ""
 
                     try:
-                        within_kinship = (self.n_AaAa[_i][_j] - 2.0 * self.n_AAaa[_i][_j]) \
+                        within_kinship = (self.n_AaAa[idx] - 2.0 * self.n_AAaa[idx]) \
                             / (self.n_Aa[_i] + self.n_Aa[_j])
                         within_kinship_f = "{:6.4f}".format(within_kinship)
                     except ZeroDivisionError:
@@ -173,8 +286,9 @@ cdef class CounterKinship(Counter):
                          between_kinship_f,
                          self.n_Aa[_i],
                          self.n_Aa[_j],
-                         self.n_AAaa[_i][_j],
-                         self.n_AaAa[_i][_j]))) + "\n")
+                         self.n_AAaa[idx],
+                         self.n_AaAa[idx]))) + "\n")
+                    idx += 1
 
     def __dealloc__(self):
         if self.data_genotype_ptr is not NULL:
@@ -258,6 +372,34 @@ cdef class CounterFormatDistributions(Counter):
         for code_idx, ival in enumerate(unset_view):
             unset_sites_view[code_idx][ival] += 1
 
+    def merge(self, CounterFormatDistributions other):
+        if self.codes != other.codes or self.nbins != other.nbins:
+            raise ValueError("can not merge counters for different FORMAT fields")
+        self.counts += other.counts
+        self.unset_samples += other.unset_samples
+        self.unset_sites += other.unset_sites
+
+    def __getstate__(self):
+        state = Counter.__getstate__(self)
+        state.update({"codes": self.codes,
+                      "nbins": self.nbins,
+                      "counts": self.counts,
+                      "unset_samples": self.unset_samples,
+                      "unset_sites": self.unset_sites})
+        return state
+
+    def __setstate__(self, state):
+        Counter.__setstate__(self, state)
+        self.codes = state["codes"]
+        self.ncodes = len(self.codes)
+        self.nbins = state["nbins"]
+        self.counts = state["counts"]
+        self.unset_samples = state["unset_samples"]
+        self.unset_sites = state["unset_sites"]
+        self.values = numpy.zeros(
+            self.nsamples,
+            dtype=numpy.int32)
+
     def output(self):
 
         str_codes = [x.decode("ascii") for x in self.codes]
@@ -349,9 +491,21 @@ cdef class CounterMutationalSignature(Counter):
         }
         assert len(self.profile.keys()) == 12
 
-        self.signatures = collections.defaultdict(
+        self.signatures = self.build_signatures()
+
+    def build_signatures(self, signatures=None):
+        """return nested dictionary of counts per sample,
+        profile class and context, filled with *signatures*.
+        """
+        result = collections.defaultdict(
             lambda: collections.defaultdict(
                 lambda: collections.defaultdict(int)))
+        if signatures is not None:
+            for s, dd in signatures.items():
+                for cls, d in dd.items():
+                    for context, count in d.items():
+                        result[s][cls][context] += count
+        return result
 
     cdef process_record(self, VariantRecord record, bint is_snp):
 
@@ -401,6 +555,28 @@ cdef class CounterMutationalSignature(Counter):
         if is_unique:
             self.signatures["unique"][profile_class][c] += 1
 
+    def merge(self, CounterMutationalSignature other):
+        for s, dd in other.signatures.items():
+            for cls, d in dd.items():
+                for context, count in d.items():
+                    self.signatures[s][cls][context] += count
+
+    def __getstate__(self):
+        state = Counter.__getstate__(self)
+        # convert to plain dictionaries for pickling
+        state.update({
+            "profile": self.profile,
+            "signatures": dict(
+                (s, dict((cls, dict(d)) for cls, d in dd.items()))
+                for s, dd in self.signatures.items())})
+        return state
+
+    def __setstate__(self, state):
+        Counter.__setstate__(self, state)
+        self.fasta_in = None
+        self.profile = state["profile"]
+        self.signatures = self.build_signatures(state["signatures"])
+
     def output(self):
 
         with E.open_output_file("mutation_profile") as outf:
@@ -446,6 +622,17 @@ cdef class CounterMutationalSignatureProfile(CounterMutationalSignature):
 
         self.signatures_database = "signatures.cosmic"
         self.counts_method = "genome"
+
+    def __getstate__(self):
+        state = CounterMutationalSignature.__getstate__(self)
+        state.update({"signatures_database": self.signatures_database,
+                      "counts_method": self.counts_method})
+        return state
+
+    def __setstate__(self, state):
+        CounterMutationalSignature.__setstate__(self, state)
+        self.signatures_database = state["signatures_database"]
+        self.counts_method = state["counts_method"]
         
     def output(self):
 
@@ -548,6 +735,23 @@ cdef class CounterGCContext(Counter):
 
             self.counts[idx][gc_content] += 1
 
+    def merge(self, CounterGCContext other):
+        self.counts += other.counts
+
+    def __getstate__(self):
+        state = Counter.__getstate__(self)
+        state.update({"nbins": self.nbins,
+                      "window_size": self.window_size,
+                      "counts": self.counts})
+        return state
+
+    def __setstate__(self, state):
+        Counter.__setstate__(self, state)
+        self.fasta_in = None
+        self.nbins = state["nbins"]
+        self.window_size = state["window_size"]
+        self.counts = state["counts"]
+
     def output(self):
         with E.open_output_file("gc_context") as outf:
             outf.write("percent_gc\t{}\n".format("\t".join(self.samples) ))
@@ -609,6 +813,25 @@ cdef class CounterGCDepthProfile(Counter):
                 depth = min(depth, self.nbins_dp)
                 self.counts[idx][depth][gc_content] += 1
 
+    def merge(self, CounterGCDepthProfile other):
+        self.counts += other.counts
+
+    def __getstate__(self):
+        state = Counter.__getstate__(self)
+        state.update({"nbins_gc": self.nbins_gc,
+                      "nbins_dp": self.nbins_dp,
+                      "window_size": self.window_size,
+                      "counts": self.counts})
+        return state
+
+    def __setstate__(self, state):
+        Counter.__setstate__(self, state)
+        self.fasta_in = None
+        self.nbins_gc = state["nbins_gc"]
+        self.nbins_dp = state["nbins_dp"]
+        self.window_size = state["window_size"]
+        self.counts = state["counts"]
+
     def output(self):
         with E.open_output_file("gc_dp_prof") as outf:
             gc_bins = numpy.arange(0, self.nbins_gc + 1, 1)
@@ -647,19 +870,7 @@ cdef class CounterGCDepthProfile(Counter):
                     outf.write("{}\t{}\t{:.2f}\n".format(sample, gc_bin, mean))
 
 
-def vcf2stats_count(VariantFile vcf_in,
-                    FastaFile fasta_in,
-                    TabixFile bed_in,
-                    options):
-
-    if options.region is not None:
-        vcf_records = generate_from_region(vcf_in, options.region)
-    elif bed_in is not None:
-        vcf_records = generate_from_bed(vcf_in, bed_in)
-    else:
-        vcf_records = generate_from_vcf(vcf_in)
-
-    samples = list(vcf_in.header.samples)
+def build_counters(samples, fasta_in, options):
 
     counters = []
 
@@ -674,7 +885,8 @@ def vcf2stats_count(VariantFile vcf_in,
                 samples=samples))
         elif method == "kinship":
             counters.append(CounterKinship(
-                samples=samples))
+                samples=samples,
+                block_size=options.kinship_block_size))
         elif method == "format-distribution":
             counters.append(CounterFormatDistributions(
                 nbins=options.format_distribution_nbins,
@@ -691,6 +903,11 @@ def vcf2stats_count(VariantFile vcf_in,
                 gc_window_size=options.gc_window_size,
                 only_variant_positions=options.only_variant_positions))
 
+    return counters
+
+
+def count_records(vcf_records, counters, options):
+
     cdef bint is_snp
 
     cdef int report_step = options.report_step
@@ -719,5 +936,121 @@ def vcf2stats_count(VariantFile vcf_in,
         for counter in counters:
             counter.process_record(record, is_snp)
 
+
+# options required to build and run counters within a shard
+SHARD_OPTIONS = ("methods",
+                 "kinship_block_size",
+                 "format_distribution_nbins",
+                 "format_distributions",
+                 "gc_window_size",
+                 "only_variant_positions",
+                 "report_step")
+
+
+def build_shards(VariantFile vcf_in, TabixFile bed_in, shard_size):
+    """split input into shards that can be processed independently.
+
+    Returns a list of tuples (contig, start, end). If `bed_in` is
+    given, there is one shard per contig in `bed_in` with start and
+    end set to None. Otherwise, contigs in the index of `vcf_in`
+    are split into pieces of `shard_size` bases. The last piece on a
+    contig extends to the end of the contig.
+    """
+    if bed_in is not None:
+        return [(contig, None, None) for contig in bed_in.contigs]
+
+    if vcf_in.index is None:
+        raise ValueError("{} needs to be indexed to be split into shards".format(
+            os.fsdecode(vcf_in.filename)))
+
+    shards = []
+    for contig in vcf_in.index:
+        length = None
+        if contig in vcf_in.header.contigs:
+            length = vcf_in.header.contigs[contig].length
+        if length is None:
+            shards.append((contig, None, None))
+            continue
+        for start in range(0, length, shard_size):
+            end = start + shard_size
+            if end >= length:
+                end = None
+            shards.append((contig, start, end))
+    return shards
+
+
+def count_shards(args):
+    """count records within a list of shards.
+
+    Files are opened separately within each process. Returns a list
+    of counters with the counts summed over all shards.
+    """
+    vcf_filename, fasta_filename, bed_filename, shards, options = args
+
+    vcf_in = VariantFile(vcf_filename)
+    if fasta_filename is not None:
+        fasta_in = FastaFile(fasta_filename)
+    else:
+        fasta_in = None
+
+    if bed_filename is not None:
+        bed_in = TabixFile(bed_filename)
+
+    counters = build_counters(list(vcf_in.header.samples), fasta_in, options)
+    for contig, start, end in shards:
+        if bed_filename is not None:
+            vcf_records = generate_from_bed(vcf_in, bed_in, contig)
+        else:
+            vcf_records = generate_from_shard(vcf_in, contig, start, end)
+        count_records(vcf_records, counters, options)
+    return counters
+
+
+def vcf2stats_count(VariantFile vcf_in,
+                    FastaFile fasta_in,
+                    TabixFile bed_in,
+                    options):
+
+    samples = list(vcf_in.header.samples)
+    counters = build_counters(samples, fasta_in, options)
+
+    num_threads = getattr(options, "num_threads", 1)
+
+    if num_threads > 1 and vcf_in.index is None:
+        E.warn("{} is not indexed, processing in a single thread".format(
+            os.fsdecode(vcf_in.filename)))
+        num_threads = 1
+
+    if num_threads > 1 and options.region is None:
+        shards = build_shards(vcf_in, bed_in, options.shard_size)
+        E.info("processing {} shards with {} threads".format(
+            len(shards), num_threads))
+
+        shard_options = optparse.Values(
+            dict([(x, getattr(options, x, None)) for x in SHARD_OPTIONS]))
+        # distribute shards round-robin so that each process
+        # returns a single set of counters
+        args = [(os.fsdecode(vcf_in.filename),
+                 os.fsdecode(fasta_in.filename) if fasta_in is not None else None,
+                 os.fsdecode(bed_in.filename) if bed_in is not None else None,
+                 shards[x::num_threads],
+                 shard_options) for x in range(num_threads)]
+
+        pool = multiprocessing.Pool(num_threads)
+        for shard_counters in pool.imap(count_shards, args):
+            for counter, other in zip(counters, shard_counters):
+                counter.merge(other)
+        pool.close()
+        pool.join()
+    else:
+        if options.region is not None:
+            vcf_records = generate_from_region(vcf_in, options.region)
+        elif bed_in is not None:
+            vcf_records = generate_from_bed(vcf_in, bed_in)
+        else:
+            vcf_records = generate_from_vcf(vcf_in)
+
+        count_records(vcf_records, counters, options)
+
     for counter in counters:
         counter.output()
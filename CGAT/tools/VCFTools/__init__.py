@@ -0,0 +1 @@
+from CGAT.tools.VCFTools.VCF2Stats import vcf2stats_count
@@ -125,6 +125,16 @@ Note that for paired-end data, any ``\1`` or ``/2`` suffixes will be
 removed from the read name in the assumption that these have been removed
 in the bam file as well.
 
+Parallel processing
++++++++++++++++++++
+
+With ``--threads`` larger than 1, an indexed bam file given on the
+command line is split into shards of ``--shard-size`` bases plus a
+shard with the unplaced unmapped reads. Shards are counted in parallel
+and the counts are merged. The output is the same as when counting
+in a single thread. Input from stdin or without an index is counted
+in a single thread.
+
 Usage
 -----
 
@@ -310,7 +320,7 @@ import numpy
 import pandas
 import pysam
 
-from CGATCore.tools.BamTools import bam2stats_count
+from CGAT.tools.BamTools import bam2stats_count
 
 FLAGS = {
     1: 'paired',
@@ -414,6 +424,14 @@ def main(argv=None):
         "This is more memory efficient and faster stats computation, "
         "but only a summary counts table is output [%default]")
 
+    parser.add_option(
+        "--threads", dest="threads", type="int",
+        help="number of threads to use [%default]")
+
+    parser.add_option(
+        "--shard-size", dest="shard_size", type="int",
+        help="size of shards in bases for parallel counting [%default]")
+
     parser.set_defaults(
         input_reads=0,
         force_output=False,
@@ -422,6 +440,8 @@ def main(argv=None):
         output_details=False,
         output_readmap=False,
         add_alignment_details=False,
+        threads=1,
+        shard_size=10000000,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -463,7 +483,9 @@ def main(argv=None):
                         outfile_details=outfile_details,
                         add_alignment_details=options.add_alignment_details,
                         outfile_readmap=outfile_readmap,
-                        detailed_count=options.detailed_count)
+                        detailed_count=options.detailed_count,
+                        threads=options.threads,
+                        shard_size=options.shard_size)
 
     if max_hi > 0 and max_hi != max(nh_all.keys()):
         E.warn("max_hi(%i) is inconsistent with max_nh (%i) "
@@ -847,3 +869,7 @@ def main(argv=None):
 
     # write footer and output benchmark information.
     E.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,11 +6,46 @@ Purpose
 This script takes a bam file as input and computes a few metrics by
 iterating over the file. The metrics output are:
 
+Multiple resolutions
+--------------------
+
+With ``--window-sizes``, for example ``--window-sizes=500,5000,100000``,
+windows are counted at several resolutions in a single pass through
+the bam file. Counts are computed for the smallest window size and
+the larger window sizes, which need to be multiples of the smallest,
+are derived from these. Output is written contig by contig and
+includes a column ``window_size``.
+
+With ``--output-store``, all windows are additionally saved in a
+:file:`.npz` file with one array per contig and window size, for
+example ``store["chr1/5000"]``. Row ``i`` of an array is the window
+starting at ``i * window_size``, and the column names are in
+``store["columns"]``. The arrays can be loaded with :func:`numpy.load`
+without parsing the tab-separated output.
+
 '''
+import sys
+import zipfile
+import numpy
 import pysam
 
 import CGATCore.Experiment as E
-from CGATCore.tools.BamTools import bam2stats_window_count
+from CGAT.tools.BamTools import bam2stats_window_count, \
+    bam2stats_window_pyramid
+
+
+def write_array(store, key, array):
+    '''write *array* as *key* into the zip archive *store*.'''
+    with store.open(key + ".npy", "w", force_zip64=True) as outf:
+        numpy.lib.format.write_array(outf, numpy.asarray(array),
+                                     allow_pickle=False)
+
+
+def add_gc(counts_df):
+    '''add G+C content to *counts_df*.'''
+    counts_df["percent_gc"] = 100.0 * counts_df.bases_gc / (
+        counts_df.bases_gc + counts_df.bases_at)
+    counts_df.fillna(0, inplace=True)
 
 
 def main(argv=None):
@@ -34,6 +69,17 @@ def main(argv=None):
         "--window-size", dest="window_size", type="int",
         help="window size to use [%default]")
 
+    parser.add_option(
+        "--window-sizes", dest="window_sizes", type="string",
+        help="comma-separated list of window sizes to compute in a "
+        "single pass. Sizes need to be multiples of the smallest size "
+        "[%default]")
+
+    parser.add_option(
+        "--output-store", dest="output_store", type="string",
+        help="save counts for all windows in a .npz file. Requires "
+        "--window-sizes [%default]")
+
     parser.add_option(
         "--output-all-windows", dest="output_all_windows", action="store_true",
         help="output all windows. By default, windows without reads are skipped "
@@ -50,6 +96,8 @@ def main(argv=None):
         region=None,
         output_all_windows=False,
         window_size=500,
+        window_sizes=None,
+        output_store=None,
         input_filename_fasta=None,
     )
 
@@ -73,6 +121,51 @@ def main(argv=None):
     else:
         fasta = None
 
+    if options.window_sizes:
+        window_sizes = [int(x) for x in options.window_sizes.split(",")]
+        if options.output_store:
+            store = zipfile.ZipFile(options.output_store, "w",
+                                    zipfile.ZIP_DEFLATED)
+        else:
+            store = None
+
+        header = True
+        for contig, window_size, counts_df in bam2stats_window_pyramid(
+                pysam_in,
+                window_sizes,
+                region=options.region,
+                fasta=fasta):
+
+            if store is not None:
+                if header:
+                    write_array(store, "columns",
+                                numpy.array(counts_df.columns, dtype=str))
+                write_array(store,
+                            "{}/{}".format(contig, window_size),
+                            counts_df.values)
+
+            if not options.output_all_windows:
+                counts_df = counts_df[counts_df.alignments > 0].copy()
+
+            if fasta:
+                add_gc(counts_df)
+
+            counts_df.insert(0, "window_size", window_size)
+            counts_df.to_csv(
+                options.stdout,
+                sep="\t",
+                header=header)
+            header = False
+
+        if store is not None:
+            store.close()
+
+        E.stop()
+        return
+
+    elif options.output_store:
+        raise ValueError("--output-store requires --window-sizes")
+
     counts_df = bam2stats_window_count(
         pysam_in,
         region=options.region,
@@ -84,11 +177,14 @@ def main(argv=None):
 
     # add G+C content
     if fasta:
-        counts_df["percent_gc"] = 100.0 * counts_df.bases_gc / (counts_df.bases_gc + counts_df.bases_at)
-        counts_df.fillna(0, inplace=True)
+        add_gc(counts_df)
 
     counts_df.to_csv(
         options.stdout,
         sep="\t")
 
     E.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
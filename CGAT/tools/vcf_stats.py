@@ -53,6 +53,11 @@ N_{Aa,Aa}: # of variants where both individuals are heterozygous
 N_{AA,aa}: # of variants where both individuals are homozygous different
 N_{Aa}(i): # of heterozygous variants in individual i
 
+Genotypes are processed in blocks of SNPs (``--kinship-block-size``)
+and the pairwise counts are updated with matrix products. Larger
+blocks are faster at the expense of memory. Pairwise counts are
+kept in packed triangular matrices.
+
 format-distribution
 -------------------
 
@@ -82,6 +87,15 @@ gc-depth-profile
 gc-context
 ----------
 
+Parallel processing
+===================
+
+With ``--num-threads`` larger than 1, the VCF file is split into
+shards that are processed in parallel. Each shard is a piece of
+``--shard-size`` bases of a contig or, if ``--input-bed`` is given,
+all intervals on a contig. The counts of all shards are merged before
+output. The output is the same as with a single thread. If
+``--region`` is given, the file is processed in a single thread.
 
 
 """
@@ -92,7 +106,7 @@ import pysam
 
 import CGATCore.Experiment as E
 
-from CGATCore.tools.VCFTools import vcf2stats_count
+from CGAT.tools.VCFTools import vcf2stats_count
 
 
 def main(argv=sys.argv):
@@ -150,6 +164,20 @@ def main(argv=sys.argv):
         "of 50 means that 50 bases on either side of the variant are "
         "used to compute the G+C content [%default]")
 
+    parser.add_option(
+        "--kinship-block-size", dest="kinship_block_size", type="int",
+        help="number of SNPs to process together when computing "
+        "kinship coefficients [%default]")
+
+    parser.add_option(
+        "--num-threads", dest="num_threads", type="int",
+        help="number of threads to use. The VCF file is processed "
+        "in shards in parallel [%default]")
+
+    parser.add_option(
+        "--shard-size", dest="shard_size", type="int",
+        help="size of shards in bases for parallel processing [%default]")
+
     parser.set_defaults(
         methods=[],
         input_vcf_file=None,
@@ -159,6 +187,9 @@ def main(argv=sys.argv):
         format_distributions=[],
         format_distribution_nbins=1000,
         gc_window_size=50,
+        kinship_block_size=1000,
+        num_threads=1,
+        shard_size=10000000,
         report_step=1000000,
     )
 
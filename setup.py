@@ -54,6 +54,7 @@ if LooseVersion(setuptools.__version__) < LooseVersion('1.1'):
     raise ImportError(
         "the CGAT code collection requires setuptools 1.1 higher")
 
+from setuptools.command.build_py import build_py
 from Cython.Distutils import build_ext
 
 ########################################################################
@@ -220,6 +221,25 @@ Timeseries = Extension(
     language="c",
 )
 
+# Compiled GTF parser
+cgtf = Extension(
+    "CGAT.cgtf",
+    ["CGAT/cgtf.pyx"],
+    library_dirs=[],
+    libraries=[],
+    language="c",
+)
+
+# Compiled PSL parser
+cblat = Extension(
+    "CGAT.cblat",
+    ["CGAT/cblat.pyx"],
+    include_dirs=[numpy.get_include()],
+    library_dirs=[],
+    libraries=[],
+    language="c",
+)
+
 # Nested containment lists
 GeneModelAnalysis = Extension(
     "CGAT.GeneModelAnalysis",
@@ -256,8 +276,42 @@ for pyx_file in pyx_files:
                   define_macros=pysam.get_defines())
     )
 
+# Tools in CGAT/tools
+BamTools = Extension(
+    "CGAT.tools.BamTools.Bam2Stats",
+    ["CGAT/tools/BamTools/Bam2Stats.pyx"],
+    extra_link_args=extra_link_args,
+    include_dirs=include_dirs,
+    define_macros=pysam.get_defines(),
+    language="c",
+)
+
+VCFTools = Extension(
+    "CGAT.tools.VCFTools.VCF2Stats",
+    ["CGAT/tools/VCFTools/VCF2Stats.pyx"],
+    extra_link_args=extra_link_args,
+    include_dirs=include_dirs,
+    define_macros=pysam.get_defines(),
+    language="c",
+)
+
+
+class build_py_with_index(build_py):
+    '''build python modules and the registry of scripts used by the
+    cgat command line launcher.'''
+
+    def run(self):
+        build_py.run(self)
+        if not self.dry_run:
+            import cgat
+            outdir = os.path.join(self.build_lib, "CGAT")
+            self.mkpath(outdir)
+            cgat.buildScriptIndex(
+                filename=os.path.join(outdir, "cgat_index.json"))
+
 
-ext_modules = [Components, NCL, Timeseries, GeneModelAnalysis] + script_extensions
+ext_modules = [Components, NCL, Timeseries, cgtf, cblat,
+               GeneModelAnalysis, BamTools, VCFTools] + script_extensions
 
 setup(
     # package information
@@ -284,7 +338,8 @@ setup(
     dependency_links=dependency_links,
     # extension modules
     ext_modules=ext_modules,
-    cmdclass={'build_ext': build_ext},
+    cmdclass={'build_ext': build_ext,
+              'build_py': build_py_with_index},
     # other options
     zip_safe=False,
     test_suite="tests",
@@ -0,0 +1,118 @@
+"""test parsing of psl formatted files."""
+
+import unittest
+import io
+import copy
+import numpy
+import CGAT.Blat as Blat
+
+PSL = """psLayout version 3
+
+match	mis- 	rep. 	N's	Q gap	Q gap	T gap	T gap	strand	Q        	Q   	Q    	Q  	T        	T   	T    	T  	block	blockSizes 	qStarts	 tStarts
+     	match	match	   	count	bases	count	bases	      	name     	size	start	end	name     	size	start	end	count
+---------------------------------------------------------------------------------------------------------------------------------------------------------------
+90	10	0	0	1	5	1	100	+	query1	120	10	115	chr1	10000	500	700	2	50,50,	10,65,	500,650,
+20	0	0	0	0	0	0	0	-	query2	20	0	20	chr2	5000	100	120	1	20,	0,	100,
+0	0	0	0	0	0	0	0	+	query3	0	0	0	chr1	10000	800	800	1	0,	0,	800,
+"""
+
+FIELDS = ("mNMatches", "mNMismatches", "mNRepMatches", "mNns",
+          "mQueryNGapsCounts", "mQueryNGapsBases",
+          "mSbjctNGapsCounts", "mSbjctNGapsBases",
+          "strand", "mQueryId", "mQueryLength", "mQueryFrom", "mQueryTo",
+          "mSbjctId", "mSbjctLength", "mSbjctFrom", "mSbjctTo",
+          "mNBlocks", "mBlockSizes", "mQueryBlockStarts",
+          "mSbjctBlockStarts", "mQueryCoverage", "mSbjctCoverage", "mPid")
+
+
+class TestIterator(unittest.TestCase):
+
+    def test_blocks_are_decoded(self):
+        match = next(Blat.iterator(io.StringIO(PSL)))
+        self.assertEqual(match.mBlockSizes, [50, 50])
+        self.assertEqual(match.mQueryBlockStarts, [10, 65])
+        self.assertEqual(match.mSbjctBlockStarts, [500, 650])
+        self.assertEqual(match.getBlocks(),
+                         [(10, 500, 50), (65, 650, 50)])
+
+    def test_output_is_identical_to_input(self):
+        lines = PSL.splitlines()[5:]
+        self.assertEqual([str(x) for x in Blat.iterator(io.StringIO(PSL))],
+                         lines)
+
+    def test_blocks_can_be_modified(self):
+        match = next(Blat.iterator(io.StringIO(PSL)))
+        match.mBlockSizes = [40, 60]
+        self.assertEqual(match.mQueryBlockStarts, [10, 65])
+        self.assertTrue(str(match).endswith("40,60,\t10,65,\t500,650,"))
+        match.switchTargetStrand()
+        self.assertEqual(match.mSbjctBlockStarts, [9290, 9460])
+
+    def test_copy_and_attributes(self):
+        match = next(Blat.iterator(io.StringIO(PSL)))
+        match.mMapQuery2Target = None
+        other = copy.copy(match)
+        self.assertEqual(str(other), str(match))
+        self.assertEqual(other.mMapQuery2Target, None)
+
+
+class TestFastIterator(unittest.TestCase):
+
+    def test_records_are_identical(self):
+        references = list(Blat.iterator(io.StringIO(PSL)))
+        records = list(Blat.fast_iterator(io.StringIO(PSL)))
+        self.assertEqual(len(records), 3)
+        for record, reference in zip(records, references):
+            self.assertEqual(str(record), str(reference))
+            for field in FIELDS:
+                self.assertEqual(getattr(record, field),
+                                 getattr(reference, field))
+
+    def test_missing_fields_raise_error(self):
+        self.assertRaises(Blat.ParsingError, list,
+                          Blat.fast_iterator(io.StringIO("1\t2\t3\n")))
+
+    def test_invalid_integer_raises_error(self):
+        text = PSL.replace("\t120\t", "\tabc\t")
+        self.assertRaises(ValueError, list,
+                          Blat.fast_iterator(io.StringIO(text)))
+
+
+class TestBatchIterator(unittest.TestCase):
+
+    def test_columns_are_identical(self):
+        references = list(Blat.iterator(io.StringIO(PSL)))
+        for batch_size in (1, 2, 100):
+            records = []
+            for batch in Blat.iterator_batch(io.StringIO(PSL),
+                                             batch_size=batch_size):
+                self.assertEqual(sorted(batch.keys()), sorted(Blat.FIELDS))
+                offsets = numpy.concatenate(
+                    [[0], numpy.cumsum(batch["blockCount"])])
+                for x in range(len(batch["qName"])):
+                    start, end = offsets[x], offsets[x + 1]
+                    records.append((
+                        batch["qName"][x],
+                        batch["strand"][x],
+                        batch["tName"][x],
+                        batch["matches"][x],
+                        batch["qSize"][x],
+                        batch["tEnd"][x],
+                        list(batch["blockSizes"][start:end]),
+                        list(batch["qStarts"][start:end]),
+                        list(batch["tStarts"][start:end])))
+
+            self.assertEqual(records, [
+                (x.mQueryId, x.strand, x.mSbjctId, x.mNMatches,
+                 x.mQueryLength, x.mSbjctTo, x.mBlockSizes,
+                 x.mQueryBlockStarts, x.mSbjctBlockStarts)
+                for x in references])
+
+    def test_block_count_mismatch_raises_error(self):
+        text = PSL.replace("\t2\t50,50,", "\t3\t50,50,")
+        self.assertRaises(Blat.ParsingError, list,
+                          Blat.iterator_batch(io.StringIO(text)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+"""test batch parsing and quality score conversion of fastq files."""
+
+import unittest
+import io
+import CGAT.Fastq as Fastq
+
+SANGER = """@read1 first
+ACGTACGTAC
++
+IIIII#####
+@read2
+ACGTA
++read2
+!+5?I
+@read3
+ACGTACGTACGT
++
+%%%%%%%%%%%%
+"""
+
+PHRED64 = """@read1
+ACGTACGTAC
++
+hhhhhBBBBB
+@read2
+ACGTA
++
+@JT^h
+"""
+
+
+class TestBatch(unittest.TestCase):
+
+    def checkSame(self, text, batch_size):
+        records = "".join(
+            ["%s\n" % x for x in Fastq.iterate(io.StringIO(text))])
+        batches = "".join(
+            [str(x) for x in Fastq.iterate_batch(io.StringIO(text),
+                                                 batch_size=batch_size)])
+        self.assertEqual(records, batches)
+
+    def testIterate(self):
+        for batch_size in (1, 10, 50, 1000):
+            self.checkSame(SANGER, batch_size)
+            self.checkSame(PHRED64, batch_size)
+
+    def testRecords(self):
+        batch = next(Fastq.iterate_batch(io.StringIO(SANGER)))
+        self.assertEqual(len(batch), 3)
+        for record, other in zip(batch, Fastq.iterate(io.StringIO(SANGER))):
+            self.assertEqual(record.identifier, other.identifier)
+            self.assertEqual(record.seq, other.seq)
+            self.assertEqual(record.quals, other.quals)
+
+    def testTrim(self):
+        for trim3, trim5 in ((0, 0), (3, 0), (3, 2), (20, 0), (0, 20)):
+            batch = next(Fastq.iterate_batch(io.StringIO(SANGER)))
+            batch.trim(trim3, trim5)
+            expected = []
+            for record in Fastq.iterate(io.StringIO(SANGER)):
+                record.trim(trim3, trim5)
+                expected.append("%s\n" % record)
+            self.assertEqual(str(batch), "".join(expected))
+
+    def testTrim5(self):
+        for trim5 in (0, 3, 20):
+            batch = next(Fastq.iterate_batch(io.StringIO(SANGER)))
+            batch.trim5(trim5)
+            expected = []
+            for record in Fastq.iterate(io.StringIO(SANGER)):
+                record.trim5(trim5)
+                expected.append("%s\n" % record)
+            self.assertEqual(str(batch), "".join(expected))
+
+    def testGuessFormat(self):
+        batch = next(Fastq.iterate_batch(io.StringIO(PHRED64)))
+        self.assertEqual(sorted(batch.guessFormat()),
+                         ["phred64", "solexa"])
+
+    def testConvert(self):
+        for text in (SANGER, PHRED64):
+            for target in ("sanger", "illumina-1.8", "phred64", "solexa"):
+                try:
+                    expected = "".join(
+                        ["%s\n" % x for x in Fastq.iterate_convert(
+                            io.StringIO(text), target, guess="sanger")])
+                except ValueError:
+                    self.assertRaises(
+                        ValueError, list, Fastq.iterate_batch_convert(
+                            io.StringIO(text), target, guess="sanger"))
+                    continue
+
+                for batch_size in (1, 50, 1000):
+                    result = "".join(
+                        [str(x) for x in Fastq.iterate_batch_convert(
+                            io.StringIO(text), target, guess="sanger",
+                            batch_size=batch_size)])
+                    self.assertEqual(result, expected)
+
+    def testConvertToInteger(self):
+        batch = next(Fastq.iterate_batch(io.StringIO(SANGER)))
+        batch.format = "sanger"
+        self.assertRaises(ValueError, batch.convert, "integer")
+
+    def testIncomplete(self):
+        text = SANGER + "@read4\nACGT\n+\n"
+        self.assertRaises(ValueError, list,
+                          Fastq.iterate_batch(io.StringIO(text)))
+
+    def testMalformed(self):
+        text = SANGER.replace("+read2", "read2")
+        self.assertRaises(ValueError, list,
+                          Fastq.iterate_batch(io.StringIO(text)))
+        text = SANGER.replace("@read2", "read2")
+        self.assertRaises(ValueError, list,
+                          Fastq.iterate_batch(io.StringIO(text)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+"""unit testing module for GO.py."""
+
+import collections
+import optparse
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import CGAT.GO as GO
+
+
+class TestComputeGOProbabilities(unittest.TestCase):
+
+    # (scount, stotal, bcount) combinations with a background of 100 genes
+    cases = ((0, 10, 5),
+             (1, 10, 5),
+             (5, 10, 5),
+             (3, 20, 40),
+             (10, 10, 100),
+             (0, 0, 7),
+             (2, 50, 2))
+
+    background_total = 100
+
+    def check(self, sample_counts, sample_totals, background_counts):
+
+        overs, unders = GO.computeGOProbabilities(
+            sample_counts, sample_totals,
+            background_counts, self.background_total)
+
+        self.assertEqual(overs.shape, numpy.shape(sample_counts))
+        self.assertEqual(unders.shape, numpy.shape(sample_counts))
+
+        for row, stotal in enumerate(sample_totals):
+            for column, bcount in enumerate(background_counts):
+                result = GO.GOResult("GO:%07i" % column)
+                result.mSampleCountsCategory = sample_counts[row][column]
+                result.mSampleCountsTotal = stotal
+                result.mBackgroundCountsCategory = bcount
+                result.mBackgroundCountsTotal = self.background_total
+                result.UpdateProbabilities()
+
+                self.assertEqual(overs[row, column],
+                                 result.mProbabilityOverRepresentation)
+                self.assertEqual(unders[row, column],
+                                 result.mProbabilityUnderRepresentation)
+
+    def test_single_categories(self):
+        for scount, stotal, bcount in self.cases:
+            self.check([[scount]], [stotal], [bcount])
+
+    def test_matrix(self):
+        sample_counts = [[0, 1, 2],
+                         [3, 0, 2],
+                         [1, 1, 0]]
+        self.check(sample_counts, [10, 20, 5], [5, 40, 2])
+
+    def test_cache_gives_same_result(self):
+        cache = {}
+        sample_counts = numpy.array([[0, 1], [1, 0], [0, 1]])
+        sample_totals = numpy.array([10, 10, 10])
+        background_counts = numpy.array([5, 40])
+
+        first = GO.computeGOProbabilities(
+            sample_counts, sample_totals,
+            background_counts, self.background_total, cache=cache)
+        self.assertEqual(len(cache), 4)
+
+        second = GO.computeGOProbabilities(
+            sample_counts, sample_totals,
+            background_counts, self.background_total, cache=cache)
+        self.assertEqual(len(cache), 4)
+
+        for x, y in zip(first, second):
+            self.assertTrue(numpy.array_equal(x, y))
+
+
+class TestGetSamples(unittest.TestCase):
+
+    sample_size = 250
+    num_genes = 200
+    num_categories = 30
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        rng = random.Random(1)
+        self.gene2go = {}
+        for x in range(self.num_genes):
+            # leave some genes without GO assignments
+            if x % 7 == 0:
+                continue
+            self.gene2go["gene%i" % x] = [
+                GO.GOMatch("GO:%07i" % y, "biol_process", "go %i" % y, "NA")
+                for y in rng.sample(range(self.num_categories),
+                                    rng.randint(1, 5))]
+
+        self.background = ["gene%i" % x for x in range(self.num_genes)]
+        self.foreground = self.background[:40]
+        self.go2info = collections.defaultdict(GO.GOInfo)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def getSamples(self, num_threads):
+        options = optparse.Values(dict(
+            sample=self.sample_size,
+            num_threads=num_threads,
+            random_seed=1,
+            output_filename_pattern=os.path.join(
+                self.tmpdir, "%(go)s_%(section)s_" + str(num_threads))))
+
+        samples, pvalues = GO.getSamples(
+            self.gene2go, self.foreground, self.background,
+            options, "biol_process", self.go2info)
+
+        with open(options.output_filename_pattern % {
+                "go": "biol_process", "section": "samples"}) as inf:
+            output = inf.read()
+
+        return samples, pvalues, output
+
+    def test_threads_give_identical_output(self):
+        samples1, pvalues1, output1 = self.getSamples(1)
+        samples2, pvalues2, output2 = self.getSamples(2)
+
+        self.assertEqual(output1, output2)
+        self.assertTrue(numpy.array_equal(pvalues1, pvalues2))
+        self.assertEqual(sorted(samples1.keys()), sorted(samples2.keys()))
+
+        for key, sample1 in samples1.items():
+            sample2 = samples2[key]
+            self.assertEqual(sample1.mCounts, sample2.mCounts)
+            self.assertTrue(numpy.array_equal(
+                sample1.mProbabilitiesOverRepresentation,
+                sample2.mProbabilitiesOverRepresentation))
+            self.assertTrue(numpy.array_equal(
+                sample1.mProbabilitiesUnderRepresentation,
+                sample2.mProbabilitiesUnderRepresentation))
+
+    def test_samples_cover_all_categories(self):
+        samples, pvalues, output = self.getSamples(1)
+        self.assertEqual(len(samples), self.num_categories)
+        self.assertEqual(len(pvalues),
+                         self.sample_size * self.num_categories)
+        for sample in samples.values():
+            self.assertEqual(len(sample.mCounts), self.sample_size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,10 @@
 import unittest
 import os
+import shutil
+import tempfile
 
 import CGAT.GTF as GTF
-import CGAT.IOTools as IOTools
+import CGATCore.IOTools as IOTools
 
 
 class TestIteration(unittest.TestCase):
@@ -18,5 +20,168 @@ class TestIteration(unittest.TestCase):
                          100)
 
 
+class TestFastIterator(unittest.TestCase):
+
+    filename = os.path.join("data", "hg19.small.gtf.gz")
+
+    def test_number_of_intervals_is_correct(self):
+
+        with IOTools.openFile(self.filename) as inf:
+            records = list(GTF.fast_iterator(inf))
+
+        self.assertEqual(len(records),
+                         100)
+
+    def test_output_is_identical_to_entry(self):
+
+        with IOTools.openFile(self.filename) as inf:
+            records = list(GTF.fast_iterator(inf))
+
+        with IOTools.openFile(self.filename) as inf:
+            references = list(GTF.track_iterator(inf))
+
+        self.assertEqual([str(x) for x in records],
+                         [str(x) for x in references])
+
+    def test_attributes_are_accessible(self):
+
+        with IOTools.openFile(self.filename) as inf:
+            references = list(GTF.track_iterator(inf))
+
+        with IOTools.openFile(self.filename) as inf:
+            for record, reference in zip(GTF.fast_iterator(inf), references):
+                self.assertEqual(record.gene_id, reference.gene_id)
+                self.assertEqual(record.transcript_id,
+                                 reference.transcript_id)
+                self.assertEqual(record.attributes, reference.attributes)
+                for key, value in reference.attributes.items():
+                    self.assertEqual(record[key], value)
+                    self.assertEqual(getattr(record, key), value)
+
+    def test_transcript_iterator_is_identical(self):
+
+        with IOTools.openFile(self.filename) as inf:
+            records = [[str(y) for y in x] for x in
+                       GTF.transcript_iterator(GTF.fast_iterator(inf))]
+
+        with IOTools.openFile(self.filename) as inf:
+            references = [[str(y) for y in x] for x in
+                          GTF.transcript_iterator(GTF.track_iterator(inf))]
+
+        self.assertEqual(records, references)
+
+
+class TestGenesetCache(unittest.TestCase):
+
+    filename = os.path.join("data", "hg19.small.gtf.gz")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.gtf = os.path.join(self.tmpdir, os.path.basename(self.filename))
+        shutil.copy(self.filename, self.gtf)
+        self.cache_filename = self.gtf + GTF.GENESET_CACHE_SUFFIX
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_fields(self, gtfs):
+        return [(x.contig, x.start, x.end, x.strand, x.feature,
+                 x.gene_id, x.transcript_id) for x in gtfs]
+
+    def test_cache_is_created_and_loaded(self):
+
+        cache = GTF.readGenesetCache(self.gtf)
+        self.assertTrue(os.path.exists(self.cache_filename))
+        self.assertEqual(len(cache), 100)
+
+        mtime = os.path.getmtime(self.cache_filename)
+        cache = GTF.readGenesetCache(self.gtf)
+        self.assertEqual(len(cache), 100)
+        self.assertEqual(os.path.getmtime(self.cache_filename), mtime)
+
+    def test_stale_cache_is_rebuilt(self):
+
+        GTF.readGenesetCache(self.gtf)
+        # make cache older than source
+        mtime = os.path.getmtime(self.gtf) - 100
+        os.utime(self.cache_filename, (mtime, mtime))
+        GTF.readGenesetCache(self.gtf)
+        self.assertGreaterEqual(os.path.getmtime(self.cache_filename),
+                                os.path.getmtime(self.gtf))
+
+    def test_corrupt_cache_is_rebuilt(self):
+
+        for data in (b"", b"PK\x03\x04truncated"):
+            with open(self.cache_filename, "wb") as outf:
+                outf.write(data)
+            cache = GTF.readGenesetCache(self.gtf)
+            self.assertEqual(len(cache), 100)
+            self.assertEqual(len(GTF.GenesetCache.load(self.cache_filename)),
+                             100)
+
+    def test_records_are_identical(self):
+
+        cache = GTF.readGenesetCache(self.gtf)
+        cache = GTF.readGenesetCache(self.gtf)
+
+        with IOTools.openFile(self.filename) as inf:
+            references = list(GTF.iterator(inf))
+
+        self.assertEqual(self.get_fields(cache.iterator()),
+                         self.get_fields(references))
+
+    def test_transcripts_are_identical(self):
+
+        cache = GTF.readGenesetCache(self.gtf)
+
+        with IOTools.openFile(self.filename) as inf:
+            references = list(GTF.transcript_iterator(GTF.iterator(inf)))
+
+        transcripts = list(cache.transcript_iterator())
+        self.assertEqual(len(transcripts), len(references))
+        for transcript, reference in zip(transcripts, references):
+            self.assertEqual(self.get_fields(transcript),
+                             self.get_fields(reference))
+
+        codes, contigs, strands, starts, ends = cache.getRanges()
+        for code, start, end in zip(codes, starts, ends):
+            transcript_id = cache.transcript_ids[code]
+            reference = [x for x in references
+                         if x[0].transcript_id == transcript_id][0]
+            self.assertEqual(start, min(x.start for x in reference))
+            self.assertEqual(end, max(x.end for x in reference))
+
+    def test_transcripts_are_split_by_contig(self):
+
+        # the same transcript in the pseudo-autosomal regions of chrX
+        # and chrY, separated by another transcript
+        gtf = os.path.join(self.tmpdir, "par.gtf")
+        with open(gtf, "w") as outf:
+            for contig, start, end, transcript_id in (
+                    ("chrX", 1, 100, "T1"),
+                    ("chrX", 201, 300, "T1"),
+                    ("chrX", 1001, 1100, "T2"),
+                    ("chrY", 11, 110, "T1"),
+                    ("chrY", 211, 310, "T1")):
+                outf.write("\t".join((
+                    contig, "test", "exon", str(start), str(end), ".",
+                    "+", ".",
+                    'gene_id "G%s"; transcript_id "%s";' % (
+                        transcript_id, transcript_id))) + "\n")
+
+        cache = GTF.readGenesetCache(gtf)
+        with IOTools.openFile(gtf) as inf:
+            references = list(GTF.transcript_iterator(GTF.iterator(inf),
+                                                      strict=False))
+
+        transcripts = list(cache.transcript_iterator())
+        self.assertEqual(len(transcripts), 3)
+        self.assertEqual([self.get_fields(x) for x in transcripts],
+                         [self.get_fields(x) for x in references])
+
+        genes = list(cache.gene_iterator())
+        self.assertEqual([len(x) for x in genes], [2, 1])
+
+
 if __name__ == "__main__":
     unittest.main()
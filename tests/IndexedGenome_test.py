@@ -0,0 +1,137 @@
+"""test saving and opening of IndexedGenome indices."""
+
+import unittest
+import tempfile
+import shutil
+import os
+import pickle
+import CGAT.IndexedGenome as IndexedGenome
+
+
+class TestIndexedGenomeSave(unittest.TestCase):
+
+    factory = IndexedGenome.IndexedGenome
+
+    def setUp(self):
+        self.intervals = [("chr1", 10, 20, "a"),
+                          ("chr1", 15, 25, "b"),
+                          ("chr1", 30, 50, "a"),
+                          ("chr2", 5, 100, ("c", 1))]
+
+        self.queries = [("chr1", 10, 15),
+                        ("chr1", 10, 30),
+                        ("chr1", 0, 10),
+                        ("chr1", 10, 50),
+                        ("chr2", 0, 200),
+                        ("chr2", 100, 200)]
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "index")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def buildIndex(self):
+        index = self.factory()
+        for contig, start, end, value in self.intervals:
+            if self.factory.has_values:
+                index.add(contig, start, end, value)
+            else:
+                index.add(contig, start, end)
+        return index
+
+    def checkIndex(self, index, other):
+        self.assertEqual(len(index), len(other))
+        for contig, start, end in self.queries:
+            self.assertEqual(sorted(index.get(contig, start, end)),
+                             sorted(other.get(contig, start, end)))
+        self.assertRaises(KeyError, other.get, "chr3", 0, 10)
+
+    def checkBatch(self, index):
+        for contig in ("chr1", "chr2"):
+            starts = [x[1] for x in self.queries]
+            ends = [x[2] for x in self.queries]
+            indptr, intervals = index.getBatch(contig, starts, ends)
+            counts = index.countBatch(contig, starts, ends)
+            for x, (start, end) in enumerate(zip(starts, ends)):
+                expected = sorted(index.get(contig, start, end))
+                rows = intervals[indptr[x]:indptr[x + 1]]
+                self.assertEqual(counts[x], len(expected))
+                result = list(zip(
+                    rows[:, 0], rows[:, 1],
+                    index.getValues(contig, rows[:, 2])))
+                self.assertEqual(sorted(result), expected)
+
+        self.assertEqual(list(index.countBatch("chr3", [0], [10])), [0])
+        indptr, intervals = index.getBatch("chr3", [0, 5], [10, 20])
+        self.assertEqual(list(indptr), [0, 0, 0])
+        self.assertEqual(intervals.shape, (0, 3))
+
+    def testBatch(self):
+        self.checkBatch(self.buildIndex())
+
+    def testBatchOpened(self):
+        self.buildIndex().save(self.path)
+        self.checkBatch(self.factory.open(self.path))
+
+    def testSaveAndOpen(self):
+        index = self.buildIndex()
+        index.save(self.path)
+        self.checkIndex(index, self.factory.open(self.path))
+
+    def testPickle(self):
+        index = self.buildIndex()
+        index.save(self.path)
+        other = pickle.loads(pickle.dumps(self.factory.open(self.path)))
+        self.checkIndex(index, other)
+
+    def testSaveOpened(self):
+        index = self.buildIndex()
+        index.save(self.path)
+        path = os.path.join(self.tmpdir, "other")
+        self.factory.open(self.path).save(path)
+        other = self.factory.open(path)
+        self.checkIndex(index, other)
+        self.checkBatch(other)
+
+    def testAddToOpened(self):
+        self.buildIndex().save(self.path)
+        other = self.factory.open(self.path)
+        if self.factory.has_values:
+            self.assertRaises(ValueError, other.add, "chr1", 0, 10, "a")
+        else:
+            self.assertRaises(ValueError, other.add, "chr1", 0, 10)
+
+
+class TestSimpleSave(TestIndexedGenomeSave):
+
+    factory = IndexedGenome.Simple
+
+
+class TestQuicksect(TestIndexedGenomeSave):
+
+    factory = IndexedGenome.Quicksect
+
+    def testAddToOpened(self):
+        self.buildIndex().save(self.path)
+        other = self.factory.open(self.path)
+        other.add("chr3", 0, 10, "d")
+        self.assertEqual(other.get("chr3", 5, 6), [(0, 10, "d")])
+
+    def testSaveKeepsValuesOfEmptyIntervals(self):
+        # a zero-length interval is not found by any query and
+        # must not shift the values of later intervals
+        index = self.factory()
+        index.add("chr1", 0, 0, "empty")
+        for contig, start, end, value in self.intervals:
+            index.add(contig, start, end, value)
+        index.save(self.path)
+        other = self.factory.open(self.path)
+        self.checkIndex(index, other)
+        self.assertEqual(other.mValues["chr1"][0], "empty")
+        other = pickle.loads(pickle.dumps(index))
+        self.checkIndex(index, other)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,7 +5,7 @@ import random
 import tempfile
 import shutil
 import os
-from CGAT.NCL import *
+from CGAT.NCL.cnestedlist import IntervalDB, IntervalFileDB
 
 
 class TestIntervalDB(unittest.TestCase):
@@ -74,17 +74,28 @@ class TestIntervalDB(unittest.TestCase):
 
         index = self.buildIndex(self.l)
 
-        for x in xrange(0, len(bits)):
+        for x in range(0, len(bits)):
             r = len(list(index.find_overlap(x, x + 1)))
             self.assertEqual(
                 r > 0, bits[x], "invalid return at position %i (expected %i, got %i)" % (x, bits[x], r))
 
+    def testBatch(self):
+        index = self.buildIndex(self.l)
+        starts = [a[0] for a, b in self.tests]
+        ends = [a[1] for a, b in self.tests]
+        indptr, intervals = index.find_overlap_batch(starts, ends)
+        counts = index.count_overlap_batch(starts, ends)
+        for x, (a, b) in enumerate(self.tests):
+            result = tuple(sorted(intervals[indptr[x]:indptr[x + 1], 2]))
+            self.assertEqual(result, b)
+            self.assertEqual(counts[x], len(b))
+
     def testEmptyIntervals(self):
         bits = [0] * 100
 
         index = self.buildIndex(self.l)
 
-        for x in xrange(0, len(bits)):
+        for x in range(0, len(bits)):
             self.assertRaises(IndexError, index.find_overlap, x, x)
 
 
@@ -93,7 +104,7 @@ class TestIntervalFileDB(TestIntervalDB):
     def setUp(self):
         TestIntervalDB.setUp(self)
         self.tmpdir = tempfile.mkdtemp()
-        self.tmpfile = os.path.join(self.tmpdir, "tmp")
+        self.tmpfile = os.path.join(self.tmpdir, "tmp").encode("utf-8")
 
     def buildIndex(self, l):
         tmp = IntervalDB()
@@ -8,6 +8,10 @@ subdirectories. Test data for scripts are contained in a directory
 with the name of the script and described in a :file:`tests.yaml`
 within that directory.
 
+Tests for the tools in :file:`CGAT/tools` are in the :file:`tests/tools`
+subdirectory. These are run directly with python instead of through
+the ``cgat`` front-end.
+
 To permit the parallelization of running tests, tests can be run in
 chunks (tasks). The script will look for the following environment variables:
 
@@ -46,6 +50,9 @@ JENKINS = os.environ.get("USER", "") == "jenkins"
 
 SUBDIRS = ("gpipe", "optic")
 
+# subdirectory with tests for tools in CGAT/tools
+TOOLS_SUBDIR = "tools"
+
 # Setup logging
 LOGFILE = open("test_scripts.log", "a")
 DEBUG = os.environ.get("CGAT_DEBUG", False)
@@ -124,10 +131,13 @@ def check_script(test_name, script, stdin,
         options = ""
 
     options = re.sub("\n", "", options)
-    short_name = os.path.basename(script)[:-3]
+    if os.path.basename(os.path.dirname(script)) == TOOLS_SUBDIR:
+        command = "python %s" % script
+    else:
+        command = "cgat %s" % os.path.basename(script)[:-3]
 
     # use /bin/bash in order to enable "<( )" syntax in shells
-    statement = ("/bin/bash -c '%(stdin)s cgat %(short_name)s "
+    statement = ("/bin/bash -c '%(stdin)s %(command)s "
                  " %(options)s"
                  " > %(stdout)s'") % locals()
 
@@ -265,6 +275,10 @@ def test_scripts():
 
     test_dirs.sort()
 
+    # tests for tools are in a separate directory
+    test_dirs.extend(sorted(
+        glob.glob(os.path.join(testing_dir, TOOLS_SUBDIR, "*.py"))))
+
     # restrict tests run according to chunk parameters
     starting_test_number = os.getenv('CGAT_TASK_ID', None)
     test_increment = os.getenv('CGAT_TASK_STEPSIZE', None)
@@ -281,10 +295,15 @@ def test_scripts():
     for test_script in test_dirs:
 
         script_name = os.path.basename(test_script)
+        if os.path.basename(os.path.dirname(test_script)) == TOOLS_SUBDIR:
+            script_dir = os.path.join(os.path.dirname(scripts_dir),
+                                      TOOLS_SUBDIR)
+        else:
+            script_dir = scripts_dir
 
         check_main.description = os.path.join(script_name, "def_main")
         yield (check_main,
-               os.path.abspath(os.path.join(scripts_dir, script_name)))
+               os.path.abspath(os.path.join(script_dir, script_name)))
 
         fn = '%s/tests.yaml' % test_script
         if not os.path.exists(fn):
@@ -317,7 +336,7 @@ def test_scripts():
 
             yield(check_script,
                   test,
-                  os.path.abspath(os.path.join(scripts_dir, script_name)),
+                  os.path.abspath(os.path.join(script_dir, script_name)),
                   values.get('stdin', None),
                   values['options'],
                   values['outputs'],